@@ -11,6 +11,9 @@
 # The Apache Avro Python module is available at: 
 # https://avro.apache.org/docs/1.8.1/gettingstartedpython.html
 #
+# fastavro, a faster Avro implementation, is used instead if available:
+# https://pypi.python.org/pypi/fastavro
+#
 # Binding to the routing key specified by amqp_routing_key (by default 'acct')
 # allows to receive messages published by an 'amqp' plugin, in JSON format.
 # Similarly for BGP daemon bgp_*_routing_key and BMP daemon bmp_*_routing_key.
@@ -31,8 +34,13 @@
 # Two data encoding formats are supported in this script:
 # * JSON
 # * Apache Avro
+#
+# Up to -f messages are delivered before being acknowledged, and they are
+# acknowledged together every -A messages (or when the queue is idle). REST
+# posts go over a keep-alive HTTP connection, as JSON arrays of up to -b
+# records with -b > 1. Avro records are decoded to JSON.
 
-import sys, os, getopt, pika, StringIO, time
+import sys, os, getopt, pika, StringIO, time, httplib, socket, urlparse
 import ujson as json
 
 try:
@@ -43,8 +51,16 @@ try:
 except ImportError:
 	avro_available = False
 
-avro_schema = None
-http_url_post = None
+try:
+	import fastavro
+	fastavro_available = True
+except ImportError:
+	fastavro_available = False
+
+avro_decoder = None
+http_poster = None
+http_batch = 1
+http_pending = []
 print_stdout = 0
 print_stdout_num = 0
 print_stdout_max = 0
@@ -70,45 +86,119 @@ def usage(tool):
 	print "  -n, --num".ljust(25) + "Number of rows to print to stdout [default: 0, ie. forever]"
 	print "  -u, --url".ljust(25) + "Define a URL to HTTP POST data to" 
 	print "  -a, --to-json-array".ljust(25) + "Convert list of newline-separated JSON objects in a JSON array"
+	print "  -b, --batch".ljust(25) + "Records per HTTP POST, as a JSON array [default: 1, ie. one message per POST]"
+	print "  -f, --prefetch".ljust(25) + "Messages delivered before they are acknowledged [default: 1000]"
+	print "  -A, --ack-every".ljust(25) + "Acknowledge messages together, every N messages [default: 100]"
+	print "  -N, --no-ack".ljust(25) + "Do not acknowledge messages (they are considered acknowledged once delivered)"
 	print "  -s, --stats-interval".ljust(25) + "Define a time interval, in secs, to get statistics to stdout"
 	print "  -P, --pidfile".ljust(25) + "Set a pidfile to record active processes PID"
-	if avro_available:
+	if avro_available or fastavro_available:
 		print "  -d, --decode-with-avro".ljust(25) + "Define the file with the " \
 		      "schema to use for decoding Avro messages"
 
-def post_to_url(http_req, value):
-	try:
-		urllib2.urlopen(http_req, value)
-	except urllib2.HTTPError, err:
-		print "WARN: urlopen() returned HTTP error code:", err.code
-		sys.stdout.flush()
-	except urllib2.URLError, err:
-		print "WARN: urlopen() returned URL error reason:", err.reason
-		sys.stdout.flush()
 
-def callback(ch, method, properties, body):
-        global avro_schema
-        global http_url_post
-        global print_stdout
-        global print_stdout_num
-        global print_stdout_max
-        global convert_to_json_array
-        global stats_interval
-        global time_count
-        global elem_count
+class HttpPoster:
+	# Keeps a keep-alive connection to the URL, reconnecting when it fails.
+	def __init__(self, url, timeout=30):
+		parsed = urlparse.urlparse(url)
+		if parsed.scheme == "https":
+			self.connection_class = httplib.HTTPSConnection
+		else:
+			self.connection_class = httplib.HTTPConnection
+		self.netloc = parsed.netloc
+		self.path = parsed.path or "/"
+		if parsed.query:
+			self.path += "?" + parsed.query
+		self.timeout = timeout
+		self.connection = None
+		self.headers = { 'Content-Type': 'application/json', 'Connection': 'keep-alive' }
+
+	def close(self):
+		if self.connection:
+			self.connection.close()
+			self.connection = None
+
+	def post(self, value):
+		# a connection closed by the server is only noticed when used, so retry once
+		for attempt in (1, 2):
+			if self.connection is None:
+				self.connection = self.connection_class(self.netloc, timeout=self.timeout)
+			try:
+				self.connection.request("POST", self.path, value, self.headers)
+				response = self.connection.getresponse()
+				# the response must be read before reusing the connection
+				response.read()
+			except (httplib.HTTPException, socket.error), err:
+				self.close()
+				if attempt == 2:
+					print "WARN: HTTP POST failed, reason:", err
+					sys.stdout.flush()
+				continue
+			if response.status >= 300:
+				print "WARN: HTTP POST returned HTTP error code:", response.status
+				sys.stdout.flush()
+			if response.getheader('connection', '').lower() == 'close':
+				self.close()
+			return
 
-	if stats_interval:
-		time_now = int(time.time())
 
-	if avro_schema:
+class AvroDecoder:
+	# The schema is parsed (and, with fastavro, compiled) once, and the
+	# reader is reused for all the messages.
+	def __init__(self, schema_text):
+		if fastavro_available:
+			self.schema = fastavro.parse_schema(json.loads(schema_text))
+			self.read = self.read_fastavro
+		else:
+			self.reader = avro.io.DatumReader(avro.schema.parse(schema_text))
+			self.read = self.read_avro
+
+	def read_fastavro(self, inputio):
+		return fastavro.schemaless_reader(inputio, self.schema)
+
+	def read_avro(self, inputio):
+		return self.reader.read(avro.io.BinaryDecoder(inputio))
+
+	def decode(self, body):
 		inputio = StringIO.StringIO(body)
-		decoder = avro.io.BinaryDecoder(inputio)
-		datum_reader = avro.io.DatumReader(avro_schema)
+		records = []
+		while inputio.tell() < len(body):
+			records.append(self.read(inputio))
+		return records
+
+
+def post_pending():
+	global http_pending
+
+	if not http_pending:
+		return
+	if http_batch == 1:
+		for value in http_pending:
+			http_poster.post(value)
+	else:
+		for start in range(0, len(http_pending), http_batch):
+			http_poster.post("[" + ",".join(http_pending[start:start + http_batch]) + "]")
+	http_pending = []
+
+def report_stats():
+	global time_count
+	global elem_count
+
+	time_now = time.time()
+	if time_now >= (time_count + stats_interval):
+		print("INFO: stats: [ interval=%d records=%d records/s=%.1f ]" % (stats_interval, elem_count,
+			elem_count / (time_now - time_count)))
+		sys.stdout.flush()
+		time_count = time_now
+		elem_count = 0
+
+# returns True once -n rows were printed, main stops after the message is accounted for
+def callback(ch, method, properties, body):
+	global print_stdout_num
+	global elem_count
 
-		avro_data = []
-		while inputio.tell() < len(inputio.getvalue()):
-			x = datum_reader.read(decoder)
-			avro_data.append(str(x))
+	if avro_decoder:
+		avro_data = [json.dumps(x) for x in avro_decoder.decode(body)]
 
 		#
 		# XXX: data enrichments, manipulations, correlations, filtering etc. go here
@@ -121,13 +211,12 @@ def callback(ch, method, properties, body):
 			print " [x] Received %r" % (",".join(avro_data),)
 			sys.stdout.flush()
 			print_stdout_num += 1
-			if (print_stdout_max == print_stdout_num):
-				sys.exit(0)
 
-		if http_url_post:
-			http_req = urllib2.Request(http_url_post)
-			http_req.add_header('Content-Type', 'application/json')
-			post_to_url(http_req, ("\n".join(avro_data)))
+		if http_poster:
+			if http_batch == 1:
+				http_pending.append("\n".join(avro_data))
+			else:
+				http_pending.extend(avro_data)
 	else:
 		value = body
 
@@ -145,6 +234,10 @@ def callback(ch, method, properties, body):
 			elem_count += value.count('\n')
 			elem_count += 1
 
+		if http_poster and http_batch > 1:
+			# one record per line
+			http_pending.extend([line for line in value.split('\n') if line.strip()])
+
 		if convert_to_json_array:
 			value = "[" + value + "]"
 			value = value.replace('\n', ',\n')
@@ -154,36 +247,31 @@ def callback(ch, method, properties, body):
 			print " [x] Received %r" % (value,)
 			sys.stdout.flush()
 			print_stdout_num += 1
-			if (print_stdout_max == print_stdout_num):
-				sys.exit(0)
 
-		if http_url_post:
-			http_req = urllib2.Request(http_url_post)
-			http_req.add_header('Content-Type', 'application/json')
-			post_to_url(http_req, value)
+		if http_poster and http_batch == 1:
+			http_pending.append(value)
 
-	if stats_interval:
-		if time_now >= (time_count + stats_interval):
-			print("INFO: stats: [ interval=%d records=%d ]" % (stats_interval, elem_count))
-			sys.stdout.flush()
-			time_count = time_now
-			elem_count = 0
+	if len(http_pending) >= http_batch:
+		post_pending()
+
+	return print_stdout and print_stdout_max == print_stdout_num
 
 def main():
-        global avro_schema
-        global http_url_post
-        global print_stdout
-        global print_stdout_num
-        global print_stdout_max
-        global convert_to_json_array
-        global stats_interval
-        global time_count
-        global elem_count
+	global avro_decoder
+	global http_poster
+	global http_batch
+	global print_stdout
+	global print_stdout_max
+	global convert_to_json_array
+	global stats_interval
+	global time_count
+	global elem_count
 
 	try:
-		opts, args = getopt.getopt(sys.argv[1:], "he:k:q:H:u:d:pn:as:P:", ["help",
+		opts, args = getopt.getopt(sys.argv[1:], "he:k:q:H:u:d:pn:ab:f:A:Ns:P:", ["help",
 				"exchange=", "routing_key=", "queue=", "host=", "url=",
 				"decode-with-avro=", "print=", "num=", "to-json-array=",
+				"batch=", "prefetch=", "ack-every=", "no-ack",
 				"stats-interval=", "pidfile="])
 	except getopt.GetoptError as err:
 		# print help information and exit:
@@ -191,10 +279,15 @@ def main():
 		usage(sys.argv[0])
 		sys.exit(2)
 
+	mypid = os.getpid()
 	amqp_exchange = None
 	amqp_routing_key = None
 	amqp_queue = None
 	amqp_host = "localhost"
+	http_url_post = None
+	prefetch_count = 1000
+	ack_every = 100
+	no_ack = False
 	pidfile = None
  	
 	required_cl = 0
@@ -205,15 +298,15 @@ def main():
 			sys.exit()
 		elif o in ("-e", "--exchange"):
 			required_cl += 1
-            		amqp_exchange = a
+			amqp_exchange = a
 		elif o in ("-k", "--routing_key"):
 			required_cl += 1
-            		amqp_routing_key = a
+			amqp_routing_key = a
 		elif o in ("-q", "--queue"):
 			required_cl += 1
-            		amqp_queue = a
+			amqp_queue = a
 		elif o in ("-H", "--host"):
-            		amqp_host = a
+			amqp_host = a
 		elif o in ("-u", "--url"):
 			http_url_post = a
 		elif o in ("-p", "--print"):
@@ -222,26 +315,43 @@ def main():
 			print_stdout_max = int(a)
 		elif o in ("-a", "--to-json-array"):
 			convert_to_json_array = 1
+		elif o in ("-b", "--batch"):
+			http_batch = int(a)
+			if http_batch < 1:
+				sys.stderr.write("ERROR: `--batch` must be at least 1\n")
+				sys.exit(1)
+		elif o in ("-f", "--prefetch"):
+			prefetch_count = int(a)
+			if prefetch_count < 0:
+				sys.stderr.write("ERROR: `--prefetch` must be positive\n")
+				sys.exit(1)
+		elif o in ("-A", "--ack-every"):
+			ack_every = int(a)
+			if ack_every < 1:
+				sys.stderr.write("ERROR: `--ack-every` must be at least 1\n")
+				sys.exit(1)
+		elif o in ("-N", "--no-ack"):
+			no_ack = True
 		elif o in ("-s", "--stats-interval"):
 			stats_interval = int(a)
 			if stats_interval < 0:
 				sys.stderr.write("ERROR: `--stats-interval` must be positive\n")
 				sys.exit(1)
 		elif o in ("-d", "--decode-with-avro"):
-			if not avro_available:
+			if not avro_available and not fastavro_available:
 				sys.stderr.write("ERROR: `--decode-with-avro` given but Avro package was "
 						"not found\n")
 				sys.exit(1)
 
-                        if not os.path.isfile(a):
+			if not os.path.isfile(a):
 				sys.stderr.write("ERROR: '%s' does not exist or is not a file\n" % (a,))
 				sys.exit(1)
 
 			with open(a) as f:
-				avro_schema = avro.schema.parse(f.read())
+				avro_decoder = AvroDecoder(f.read())
 		elif o in ("-P", "--pidfile"):
 			pidfile = a
-	        else:
+		else:
 			assert False, "unhandled option"
 
 	amqp_type = "direct"
@@ -257,6 +367,13 @@ def main():
 		pidfile_f.write("\n")
 		pidfile_f.close()
 
+	if http_url_post:
+		http_poster = HttpPoster(http_url_post)
+
+	if prefetch_count and not no_ack and ack_every > prefetch_count:
+		# the broker would stop delivering before the acknowledgement
+		ack_every = prefetch_count
+
 	connection = pika.BlockingConnection(pika.ConnectionParameters(host=amqp_host))
 	channel = connection.channel()
 
@@ -266,6 +383,9 @@ def main():
 
 	channel.queue_bind(exchange=amqp_exchange, routing_key=amqp_routing_key, queue=amqp_queue)
 
+	if not no_ack:
+		channel.basic_qos(prefetch_count=prefetch_count)
+
 	if print_stdout:
 		print ' [*] Example inspired from: http://www.rabbitmq.com/getstarted.html'
 		print ' [*] Waiting for messages on E =', amqp_exchange, ',', amqp_type, 'RK =', amqp_routing_key, 'Q =', amqp_queue, 'H =', amqp_host, '. Edit code to change any parameter. To exit press CTRL+C'
@@ -273,11 +393,43 @@ def main():
 
 	if stats_interval:
 		elem_count = 0
-		time_count = int(time.time())
+		time_count = time.time()
 
-	channel.basic_consume(callback, queue=amqp_queue, no_ack=True)
-
-	channel.start_consuming()
+	unacked = 0
+	last_tag = None
+	try:
+		# yields (None, None, None) after a second without messages
+		for method, properties, body in channel.consume(amqp_queue, no_ack=no_ack, inactivity_timeout=1):
+			done = False
+			if method is not None:
+				done = callback(channel, method, properties, body)
+				unacked += 1
+				last_tag = method.delivery_tag
+
+			# the pending records are posted and acknowledged on the way out
+			if done:
+				break
+
+			idle = method is None
+			if idle:
+				post_pending()
+
+			# a message is acknowledged once it was posted
+			if not no_ack and unacked and (unacked >= ack_every or idle):
+				post_pending()
+				channel.basic_ack(delivery_tag=last_tag, multiple=True)
+				unacked = 0
+
+			if stats_interval:
+				report_stats()
+	finally:
+		post_pending()
+		if not no_ack and unacked and channel.is_open:
+			channel.basic_ack(delivery_tag=last_tag, multiple=True)
+		if http_poster:
+			http_poster.close()
+		if connection.is_open:
+			connection.close()
 
 if __name__ == "__main__":
     main()
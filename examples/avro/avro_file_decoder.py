@@ -2,75 +2,351 @@
 #
 # If missing 'avro' read how to download it at: 
 # https://avro.apache.org/docs/1.8.1/gettingstartedpython.html
+#
+# fastavro, a faster Avro implementation, is used instead if available:
+# https://pypi.python.org/pypi/fastavro
+#
+# Records are written as JSON lines. Input files are memory-mapped and read
+# as a stream, they are never loaded in memory. Avro container files are
+# split into groups of blocks (at the sync markers), and the groups and the
+# files are decoded in parallel by -j processes; the output keeps the order
+# of the input. At most two tasks per process are in flight, so neither the
+# tasks nor the decoded lines pile up when the output is slower. Files without
+# the schema (-s) cannot be split: they are decoded one process per file, and
+# the lines are written as they are decoded (with -j 1) or spooled to a
+# temporary file by the process (otherwise), never kept in memory.
 
-import sys, os, getopt, io
-from avro.datafile import DataFileReader
-from avro.io import DatumReader
+import sys, os, getopt, io, mmap, zlib, multiprocessing, collections, shutil, tempfile
+import avro.io
 import avro.schema
 
+try:
+	import ujson as json
+except ImportError:
+	import json
+
+try:
+	import fastavro
+	fastavro_available = True
+except ImportError:
+	fastavro_available = False
+
+try:
+	import snappy
+	snappy_available = True
+except ImportError:
+	snappy_available = False
+
+CONTAINER_MAGIC = b'Obj\x01'
+SYNC_SIZE = 16
+# bytes of blocks decoded by a single task
+DEFAULT_CHUNK_SIZE = 32 * 1024 * 1024
+# records of a file without schema written at once
+SCHEMALESS_RECORDS = 10000
+
+# readers per schema, in each process
+readers = {}
+
 def usage(tool):
 	print ""
-	print "Usage: %s [Args]" % tool
+	print "Usage: %s [Args] [input files]" % tool
 	print ""
 
 	print "Mandatory Args:"
-	print "  -i, --input-file".ljust(25) + "Input file in Avro format"
+	print "  -i, --input-file".ljust(25) + "Input file in Avro format (can be repeated)"
 	print "  -s, --schema".ljust(25) + "Schema to decode input file (if not included)"
 	print ""
 	print "Optional Args:"
 	print "  -h, --help".ljust(25) + "Print this help"
+	print "  -o, --output-file".ljust(25) + "Write the JSON lines to this file [default: stdout]"
+	print "  -j, --jobs".ljust(25) + "Decoding processes [default: number of CPUs]"
+	print "  -c, --chunk-size".ljust(25) + "MBytes of container blocks decoded per task [default: 32]"
+
+
+def read_long(buf, pos):
+	# zig-zag varint
+	b = ord(buf[pos])
+	pos += 1
+	n = b & 0x7F
+	shift = 7
+	while (b & 0x80) != 0:
+		b = ord(buf[pos])
+		pos += 1
+		n |= (b & 0x7F) << shift
+		shift += 7
+	return (n >> 1) ^ -(n & 1), pos
+
+def read_bytes(buf, pos):
+	size, pos = read_long(buf, pos)
+	return buf[pos:pos + size], pos + size
+
+def read_container_header(buf):
+	"""
+	Returns (metadata, sync marker, position of the first block) of an Avro
+	container file, None if it is not one.
+	"""
+	if buf[0:4] != CONTAINER_MAGIC:
+		return None
+	pos = 4
+	metadata = {}
+	while True:
+		count, pos = read_long(buf, pos)
+		if count == 0:
+			break
+		if count < 0:
+			count = -count
+			_, pos = read_long(buf, pos)
+		for i in range(count):
+			key, pos = read_bytes(buf, pos)
+			value, pos = read_bytes(buf, pos)
+			metadata[key] = value
+	sync = buf[pos:pos + SYNC_SIZE]
+	return metadata, sync, pos + SYNC_SIZE
+
+def container_chunks(buf, pos, sync, chunk_size):
+	"""
+	Splits the blocks from pos into (start, end) ranges of about chunk_size
+	bytes. Only the block headers are read.
+	"""
+	size = len(buf)
+	start = pos
+	while pos < size:
+		_, pos = read_long(buf, pos)
+		block_size, pos = read_long(buf, pos)
+		pos += block_size
+		if buf[pos:pos + SYNC_SIZE] != sync:
+			raise ValueError("Invalid sync marker at %d" % pos)
+		pos += SYNC_SIZE
+		if pos - start >= chunk_size:
+			yield start, pos
+			start = pos
+	if start < size:
+		yield start, size
+
+def get_reader(schema_json):
+	reader = readers.get(schema_json)
+	if reader is None:
+		if fastavro_available:
+			parsed = fastavro.parse_schema(json.loads(schema_json))
+			reader = lambda inputio: fastavro.schemaless_reader(inputio, parsed)
+		else:
+			datum_reader = avro.io.DatumReader(avro.schema.parse(schema_json))
+			reader = lambda inputio: datum_reader.read(avro.io.BinaryDecoder(inputio))
+		readers[schema_json] = reader
+	return reader
+
+def decompress(codec, data):
+	if codec == 'null':
+		return data
+	if codec == 'deflate':
+		return zlib.decompress(data, -15)
+	if codec == 'snappy':
+		if not snappy_available:
+			raise ValueError("snappy codec but the snappy module was not found")
+		# the last 4 bytes are a CRC32 of the uncompressed data
+		return snappy.decompress(data[:-4])
+	raise ValueError("Unsupported codec %s" % codec)
+
+def to_json(record):
+	return json.dumps(record) + "\n"
+
+def open_map(path):
+	with open(path, "rb") as f:
+		if os.fstat(f.fileno()).st_size == 0:
+			return ""
+		return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def decode_blocks(task):
+	"""
+	Decodes the container blocks of a (path, start, end, schema, codec) task.
+	Returns the JSON lines.
+	"""
+	path, start, end, schema_json, codec = task
+	reader = get_reader(schema_json)
+	buf = open_map(path)
+	out = []
+	pos = start
+	try:
+		while pos < end:
+			count, pos = read_long(buf, pos)
+			data, pos = read_bytes(buf, pos)
+			pos += SYNC_SIZE
+			inputio = io.BytesIO(decompress(codec, data))
+			for i in range(count):
+				out.append(to_json(reader(inputio)))
+	finally:
+		if not isinstance(buf, str):
+			buf.close()
+	return "".join(out)
+
+def iter_schemaless(task):
+	"""
+	Decodes a file of concatenated records (path, schema) task. The records
+	are read from the memory map, as a stream. Yields the JSON lines, up to
+	SCHEMALESS_RECORDS at a time.
+	"""
+	path, schema_json = task
+	reader = get_reader(schema_json)
+	buf = open_map(path)
+	if isinstance(buf, str):
+		return
+	try:
+		size = len(buf)
+		out = []
+		while buf.tell() < size:
+			out.append(to_json(reader(buf)))
+			if len(out) >= SCHEMALESS_RECORDS:
+				yield "".join(out)
+				out = []
+		if out:
+			yield "".join(out)
+	finally:
+		buf.close()
+
+def spool_schemaless(task):
+	"""
+	Decodes a (path, schema) task into a temporary file. Returns its name.
+	"""
+	spool = tempfile.NamedTemporaryFile("w", prefix="avro_file_decoder-", delete=False)
+	try:
+		for lines in iter_schemaless(task):
+			spool.write(lines)
+	except:
+		spool.close()
+		os.remove(spool.name)
+		raise
+	spool.close()
+	return spool.name
+
+def decode_task(task):
+	"""
+	Returns (JSON lines, None) for container blocks, (None, spooled file) for
+	files without schema.
+	"""
+	if len(task) == 2:
+		return None, spool_schemaless(task)
+	return decode_blocks(task), None
+
+def write_result(output, result):
+	lines, spool_name = result
+	if spool_name is None:
+		output.write(lines)
+		return
+	try:
+		with open(spool_name, "r") as spool:
+			shutil.copyfileobj(spool, output)
+	finally:
+		os.remove(spool_name)
+
+def make_tasks(avro_files, schema_json, chunk_size):
+	for path in avro_files:
+		if schema_json:
+			yield (path, schema_json)
+			continue
+		buf = open_map(path)
+		try:
+			header = read_container_header(buf)
+			if header is None:
+				raise ValueError("%s is not an Avro container file, the schema (-s) is needed" % path)
+			metadata, sync, pos = header
+			codec = metadata.get('avro.codec', 'null') or 'null'
+			writer_schema = metadata['avro.schema']
+			for start, end in container_chunks(buf, pos, sync, chunk_size):
+				yield (path, start, end, writer_schema, codec)
+		finally:
+			if not isinstance(buf, str):
+				buf.close()
 
 def main():
 	try:
-		opts, args = getopt.getopt(sys.argv[1:], "hi:s:", ["help", "input-file=",
-						"schema="])
+		opts, args = getopt.getopt(sys.argv[1:], "hi:s:o:j:c:", ["help", "input-file=",
+						"schema=", "output-file=", "jobs=", "chunk-size="])
 	except getopt.GetoptError as err:
 		# print help information and exit:
 		print str(err) # will print something like "option -a not recognized"
 		usage(sys.argv[0])
 		sys.exit(2)
 
-	avro_file = None
+	avro_files = []
 	avro_schema_file = None
-
-	required_cl = 0
+	output_file = None
+	jobs = multiprocessing.cpu_count()
+	chunk_size = DEFAULT_CHUNK_SIZE
 
 	for o, a in opts:
 		if o in ("-h", "--help"):
 			usage(sys.argv[0])
 			sys.exit()
 		elif o in ("-i", "--input-file"):
-			required_cl += 1
-            		avro_file = a
+			avro_files.append(a)
 		elif o in ("-s", "--schema"):
 			avro_schema_file = a
+		elif o in ("-o", "--output-file"):
+			output_file = a
+		elif o in ("-j", "--jobs"):
+			jobs = int(a)
+			if jobs < 1:
+				sys.stderr.write("ERROR: `--jobs` must be at least 1\n")
+				sys.exit(1)
+		elif o in ("-c", "--chunk-size"):
+			chunk_size = int(a) * 1024 * 1024
+			if chunk_size < 1:
+				sys.stderr.write("ERROR: `--chunk-size` must be at least 1\n")
+				sys.exit(1)
 		else:
 			assert False, "unhandled option"
 
-	if (required_cl < 1): 
+	avro_files.extend(args)
+
+	if not avro_files: 
 		print "ERROR: Missing required argument"
 		usage(sys.argv[0])
 		sys.exit(1)
 
-	if not avro_schema_file:
-		reader = DataFileReader(open(avro_file, "r"), DatumReader())
-		for datum in reader:
-			print datum
-		reader.close()
-	else:
-		reader_schema = open(avro_schema_file, "r")
-		avro_schema = reader_schema.read()
-		reader_schema.close()
-		parsed_avro_schema = avro.schema.parse(avro_schema)
-
-		with open(avro_file, "rb") as reader_data:
-			inputio = io.BytesIO(reader_data.read())
-			decoder = avro.io.BinaryDecoder(inputio)
-			reader = avro.io.DatumReader(parsed_avro_schema)
-			while inputio.tell() < len(inputio.getvalue()):
-				avro_datum = reader.read(decoder)
-				print avro_datum
-		reader_data.close()
+	schema_json = None
+	if avro_schema_file:
+		with open(avro_schema_file, "r") as reader_schema:
+			schema_json = reader_schema.read()
+		# fail early on an invalid schema
+		avro.schema.parse(schema_json)
+
+	output = sys.stdout
+	if output_file:
+		output = open(output_file, "w")
+
+	tasks = make_tasks(avro_files, schema_json, chunk_size)
+	try:
+		if jobs == 1:
+			for task in tasks:
+				if len(task) == 2:
+					for lines in iter_schemaless(task):
+						output.write(lines)
+				else:
+					output.write(decode_blocks(task))
+		else:
+			pool = multiprocessing.Pool(jobs)
+			try:
+				# unlike imap, which reads all the tasks and keeps all the
+				# results, at most 2 * jobs tasks are in flight. The results
+				# are written in the order of the tasks.
+				pending = collections.deque()
+				for task in tasks:
+					pending.append(pool.apply_async(decode_task, (task,)))
+					if len(pending) >= 2 * jobs:
+						write_result(output, pending.popleft().get())
+				while pending:
+					write_result(output, pending.popleft().get())
+				pool.close()
+			except:
+				pool.terminate()
+				raise
+			finally:
+				pool.join()
+	finally:
+		if output_file:
+			output.close()
+		else:
+			output.flush()
 
 if __name__ == "__main__":
     main()
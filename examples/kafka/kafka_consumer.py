@@ -17,8 +17,12 @@
 #
 # A single data encoding format is supported in this script:
 # * JSON
+#
+# Messages are read in batches (consume()). REST posts go over a keep-alive
+# HTTP connection, as JSON arrays of up to -b records (a single record, as
+# is, with -b 1), and Kafka produces are delivered by the producer in batches.
 
-import sys, os, getopt, StringIO, time, urllib2
+import sys, os, getopt, StringIO, time, urllib2, httplib, socket, urlparse
 import confluent_kafka
 import ujson as json
 import uuid
@@ -41,25 +45,102 @@ def usage(tool):
 	print "  -T, --produce-topic".ljust(25) + "Define a topic to produce to"
 	print "  -u, --url".ljust(25) + "Define a URL to HTTP POST data to"
 	print "  -a, --to-json-array".ljust(25) + "Convert list of newline-separated JSON objects in a JSON array"
+	print "  -b, --batch".ljust(25) + "Records per HTTP POST, as a JSON array, not with -a [default: 1, ie. one record per POST]"
+	print "  -c, --consume-batch".ljust(25) + "Messages read per consume() call [default: 500]"
 	print "  -s, --stats-interval".ljust(25) + "Define a time interval, in secs, to get statistics to stdout"
 	print "  -P, --pidfile".ljust(25) + "Set a pidfile to record active processes PID"
 
 
-def post_to_url(http_req, value):
-	try:
-		urllib2.urlopen(http_req, value)
-	except urllib2.HTTPError, err:
-		print "WARN: urlopen() returned HTTP error code:", err.code
-		sys.stdout.flush()
-	except urllib2.URLError, err:
-		print "WARN: urlopen() returned URL error reason:", err.reason
+class HttpPoster:
+	# Keeps a keep-alive connection to the URL, reconnecting when it fails.
+	def __init__(self, url, timeout=30):
+		parsed = urlparse.urlparse(url)
+		if parsed.scheme == "https":
+			self.connection_class = httplib.HTTPSConnection
+		else:
+			self.connection_class = httplib.HTTPConnection
+		self.netloc = parsed.netloc
+		self.path = parsed.path or "/"
+		if parsed.query:
+			self.path += "?" + parsed.query
+		self.timeout = timeout
+		self.connection = None
+		self.headers = { 'Content-Type': 'application/json', 'Connection': 'keep-alive' }
+
+	def close(self):
+		if self.connection:
+			self.connection.close()
+			self.connection = None
+
+	def post(self, value):
+		# a connection closed by the server is only noticed when used, so retry once
+		for attempt in (1, 2):
+			if self.connection is None:
+				self.connection = self.connection_class(self.netloc, timeout=self.timeout)
+			try:
+				self.connection.request("POST", self.path, value, self.headers)
+				response = self.connection.getresponse()
+				# the response must be read before reusing the connection
+				response.read()
+			except (httplib.HTTPException, socket.error), err:
+				self.close()
+				if attempt == 2:
+					print "WARN: HTTP POST failed, reason:", err
+					sys.stdout.flush()
+				continue
+			if response.status >= 300:
+				print "WARN: HTTP POST returned HTTP error code:", response.status
+				sys.stdout.flush()
+			if response.getheader('connection', '').lower() == 'close':
+				self.close()
+			return
+
+
+class Stats:
+	# Records per interval and latency, from the timestamp of the Kafka message
+	# (creation time by the producer) to its processing.
+	def __init__(self, interval, mypid):
+		self.interval = interval
+		self.mypid = mypid
+		self.time_count = time.time()
+		self.reset()
+
+	def reset(self):
+		self.elem_count = 0
+		self.latency_sum = 0
+		self.latency_count = 0
+		self.latency_max = 0
+
+	def add(self, message, now):
+		self.elem_count += 1
+		ts_type, ts = message.timestamp()
+		if ts_type != confluent_kafka.TIMESTAMP_NOT_AVAILABLE and ts > 0:
+			latency = now * 1000 - ts
+			self.latency_sum += latency
+			self.latency_count += 1
+			if latency > self.latency_max:
+				self.latency_max = latency
+
+	def report(self, now):
+		if now < self.time_count + self.interval:
+			return
+		elapsed = now - self.time_count
+		latency_avg = 0
+		if self.latency_count:
+			latency_avg = self.latency_sum / self.latency_count
+		print("INFO: stats: [ time=%s interval=%d records=%d records/s=%.1f latency_avg_ms=%.1f latency_max_ms=%.1f pid=%d ]" %
+			(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)), self.interval, self.elem_count,
+			self.elem_count / elapsed, latency_avg, self.latency_max, self.mypid))
 		sys.stdout.flush()
+		self.time_count = now
+		self.reset()
+
 
 def main():
 	try:
-		opts, args = getopt.getopt(sys.argv[1:], "ht:T:pin:g:H:d:eu:as:r:P:", ["help", "topic=",
+		opts, args = getopt.getopt(sys.argv[1:], "ht:T:pin:g:H:d:eu:ab:c:s:r:P:", ["help", "topic=",
 				"group_id=", "host=", "earliest=", "url=", "produce-topic=", "print=",
-				"num=", "to-json-array=", "stats-interval=", "pidfile="])
+				"num=", "to-json-array=", "batch=", "consume-batch=", "stats-interval=", "pidfile="])
 	except getopt.GetoptError as err:
 		# print help information and exit:
 		print str(err) # will print something like "option -a not recognized"
@@ -74,9 +155,11 @@ def main():
 	topic_offset = "latest"
 	http_url_post = None
 	print_stdout = 0
-        print_stdout_num = 0
-        print_stdout_max = 0
+	print_stdout_num = 0
+	print_stdout_max = 0
 	convert_to_json_array = 0
+	http_batch = 1
+	consume_batch = 500
 	stats_interval = 0
 	pidfile = None
  	
@@ -88,23 +171,33 @@ def main():
 			sys.exit()
 		elif o in ("-t", "--topic"):
 			required_cl += 1
-            		kafka_topic = a
+			kafka_topic = a
 		elif o in ("-T", "--produce-topic"):
-            		kafka_produce_topic = a
+			kafka_produce_topic = a
 		elif o in ("-p", "--print"):
-            		print_stdout = 1
+			print_stdout = 1
 		elif o in ("-n", "--num"):
 			print_stdout_max = int(a)
 		elif o in ("-g", "--group_id"):
-            		kafka_group_id = a
+			kafka_group_id = a
 		elif o in ("-H", "--host"):
-            		kafka_host = a
+			kafka_host = a
 		elif o in ("-e", "--earliest"):
 			topic_offset = "earliest"
 		elif o in ("-u", "--url"):
 			http_url_post = a
 		elif o in ("-a", "--to-json-array"):
 			convert_to_json_array = 1
+		elif o in ("-b", "--batch"):
+			http_batch = int(a)
+			if http_batch < 1:
+				sys.stderr.write("ERROR: `-b`, `--batch` must be at least 1\n")
+				sys.exit(1)
+		elif o in ("-c", "--consume-batch"):
+			consume_batch = int(a)
+			if consume_batch < 1:
+				sys.stderr.write("ERROR: `-c`, `--consume-batch` must be at least 1\n")
+				sys.exit(1)
 		elif o in ("-s", "--stats-interval"):
 			stats_interval = int(a)
 			if stats_interval < 0:
@@ -120,6 +213,11 @@ def main():
 		usage(sys.argv[0])
 		sys.exit(1)
 
+	# a batch is already posted as a JSON array, it would be an array of arrays
+	if convert_to_json_array and http_batch > 1:
+		sys.stderr.write("ERROR: `-a`, `--to-json-array` can not be used with `-b`, `--batch` above 1\n")
+		sys.exit(1)
+
 	if pidfile:
 		pidfile_f = open(pidfile, 'w')
 		pidfile_f.write(str(mypid))
@@ -136,78 +234,119 @@ def main():
 	consumer = confluent_kafka.Consumer(**consumer_conf)
 	consumer.subscribe([kafka_topic])
 
-	producer_conf = { 'bootstrap.servers': kafka_host }
+	# produce() only queues, the producer sends the queued messages in batches
+	producer_conf = { 'bootstrap.servers': kafka_host,
+			  'linger.ms': 50,
+			  'batch.num.messages': 10000
+			}
 	if kafka_produce_topic:
 		producer = confluent_kafka.Producer(**producer_conf)
 
-	if stats_interval:
-		elem_count = 0
-		time_count = int(time.time())
+	http_poster = None
+	http_pending = []
+	if http_url_post:
+		http_poster = HttpPoster(http_url_post)
 
-	while True:
-		message = consumer.poll()
-		value = message.value().decode('utf-8')
+	stats = None
+	if stats_interval:
+		stats = Stats(stats_interval, mypid)
 
-		if stats_interval:
-			time_now = int(time.time())
+	try:
+		while True:
+			messages = consumer.consume(consume_batch, 1.0)
+			time_now = time.time()
 
-		if len(value):
-			try:
-				jsonObj = json.loads(value)
-			except ValueError:
-				print("ERROR: json.loads: '%s'. Skipping." % value)
-				continue
+			for message in messages:
+				if message.error():
+					if message.error().code() != confluent_kafka.KafkaError._PARTITION_EOF:
+						print("WARN: consume: %s" % message.error())
+					continue
 
-			if 'event_type' in jsonObj:
-				if jsonObj['event_type'] == "purge_init":
+				value = message.value().decode('utf-8')
+				if not len(value):
 					continue
-				elif jsonObj['event_type'] == "purge_close":
+
+				try:
+					jsonObj = json.loads(value)
+				except ValueError:
+					print("ERROR: json.loads: '%s'. Skipping." % value)
 					continue
-				elif jsonObj['event_type'] == "purge":
-					pass
+
+				if 'event_type' in jsonObj:
+					if jsonObj['event_type'] == "purge_init":
+						continue
+					elif jsonObj['event_type'] == "purge_close":
+						continue
+					elif jsonObj['event_type'] == "purge":
+						pass
+					else:
+						print("WARN: json.loads: flow record with unexpected event_type '%s'. Skipping." % jsonObj['event_type'])
+						continue
 				else:
-					print("WARN: json.loads: flow record with unexpected event_type '%s'. Skipping." % jsonObj['event_type'])
+					print("WARN: json.loads: flow record with no event_type field. Skipping.")
 					continue
-			else:
-				print("WARN: json.loads: flow record with no event_type field. Skipping.")
-				continue
 
-			#
-			# XXX: data enrichments, manipulations, correlations, filtering, etc. go here
-			#
+				#
+				# XXX: data enrichments, manipulations, correlations, filtering, etc. go here
+				#
 
-			if stats_interval:
-				elem_count += 1
+				if stats:
+					stats.add(message, time_now)
 
-			if convert_to_json_array:
-				value = "[" + value + "]"
-				value = value.replace('\n', ',\n')
-				value = value.replace(',\n]', ']')
+				if convert_to_json_array:
+					value = "[" + value + "]"
+					value = value.replace('\n', ',\n')
+					value = value.replace(',\n]', ']')
 
-			if print_stdout:
-				print("%s:%d:%d: pid=%d key=%s value=%s" % (message.topic(), message.partition(),
-						message.offset(), mypid, str(message.key()), value))
-				sys.stdout.flush()
-				print_stdout_num += 1
-				if (print_stdout_max == print_stdout_num):
+				if print_stdout:
+					print("%s:%d:%d: pid=%d key=%s value=%s" % (message.topic(), message.partition(),
+							message.offset(), mypid, str(message.key()), value))
+					sys.stdout.flush()
+					print_stdout_num += 1
+
+				if http_poster:
+					http_pending.append(value)
+					if len(http_pending) >= http_batch:
+						post_batch(http_poster, http_pending)
+						http_pending = []
+
+				if kafka_produce_topic:
+					try:
+						producer.produce(kafka_produce_topic, value)
+					except BufferError:
+						# local queue full, wait for deliveries and retry
+						producer.poll(1)
+						producer.produce(kafka_produce_topic, value)
+
+				# the pending HTTP records are posted on the way out
+				if print_stdout and print_stdout_max == print_stdout_num:
 					sys.exit(0)
 
-			if http_url_post:
-				http_req = urllib2.Request(http_url_post)
-				http_req.add_header('Content-Type', 'application/json')
-				post_to_url(http_req, value)
+			# records of a batch that was not filled (e.g. low rate) are not held
+			if http_poster and http_pending:
+				post_batch(http_poster, http_pending)
+				http_pending = []
 
 			if kafka_produce_topic:
-				producer.produce(kafka_produce_topic, value)
 				producer.poll(0)
 
-		if stats_interval:
-			if time_now >= (time_count + stats_interval):
-				print("INFO: stats: [ time=%s interval=%d records=%d pid=%d ]" %
-					(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time_now)), stats_interval, elem_count), mypid)
-				sys.stdout.flush()
-				time_count = time_now
-				elem_count = 0
+			if stats:
+				stats.report(time.time())
+	finally:
+		if kafka_produce_topic:
+			producer.flush()
+		if http_poster:
+			if http_pending:
+				post_batch(http_poster, http_pending)
+			http_poster.close()
+		consumer.close()
+
+
+def post_batch(http_poster, values):
+	if len(values) == 1:
+		http_poster.post(values[0])
+	else:
+		http_poster.post("[" + ",".join(values) + "]")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,127 @@
+#
+#   pmacct (Promiscuous mode IP Accounting package)
+#   pmacct is Copyright (C) 2003-2019 by Paolo Lucente
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+#   pmgrpcd and its components are Copyright (C) 2018-2019 by:
+#
+#   Matthias Arnold <matthias.arnold@swisscom.com>
+#   Juan Camilo Cardona <jccardona82@gmail.com>
+#   Thomas Graf <thomas.graf@swisscom.com>
+#   Paolo Lucente <paolo@pmacct.net>
+#
+"""
+Bounded caches shared by the gRPC worker threads.
+"""
+from collections import OrderedDict
+import threading
+import weakref
+
+DEFAULT_CACHE_SIZE = 10000
+
+_MISSING = object()
+
+# All named caches, used to report statistics.
+_CACHES = weakref.WeakSet()
+
+
+class LRUCache:
+    """
+    Thread safe LRU cache that counts hits, misses and evictions.
+    Named caches are reported by caches_stats.
+    """
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE, name=None):
+        if maxsize < 1:
+            raise Exception(f"Cache size must be at least 1, got {maxsize}")
+        self.maxsize = maxsize
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        if name is not None:
+            register_cache(self)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._data.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_compute(self, key, function):
+        """
+        Returns the cached value for key, computing it with function(key) if missing.
+        The computation is done outside the lock, two threads can compute the same key.
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = function(key)
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def register_cache(cache):
+    """
+    Adds a cache to the ones reported by caches_stats. Any object with name and
+    stats (returning a dict of numbers) can be registered.
+    """
+    _CACHES.add(cache)
+
+
+def caches_stats():
+    """
+    Statistics of all named caches, added per name.
+    """
+    stats = {}
+    for cache in list(_CACHES):
+        cache_stats = cache.stats()
+        if cache.name not in stats:
+            stats[cache.name] = cache_stats
+            continue
+        current = stats[cache.name]
+        for key, value in cache_stats.items():
+            current[key] += value
+    return stats
@@ -29,9 +29,14 @@ from google.protobuf.json_format import MessageToDict
 import ujson as json
 import lib_pmgrpcd
 import time
-from export_pmgrpcd import FinalizeTelemetryData
+from export_pmgrpcd import FinalizeTelemetryRows
+from envelope import PeerEnvelope
 import base64
 from debug import get_lock
+import tracing
+import prefilter
+import peerfilter
+import grpc
 
 if lib_pmgrpcd.OPTIONS.cenctype == 'gpbkv':
     import cisco_telemetry_pb2
@@ -59,7 +64,10 @@ class gRPCMdtDialoutServicer(cisco_grpc_dialout_pb2_grpc.gRPCMdtDialoutServicer)
             grpcPeer["telemetry_proto"],
             grpcPeer["telemetry_node"],
             grpcPeer["telemetry_node_port"],
-        ) = grpcPeerStr.split(":")
+        ) = peerfilter.parse_peer(grpcPeerStr)
+        if not peerfilter.accept_peer(grpcPeer["telemetry_node"]):
+            PMGRPCDLOG.debug("Cisco: rejected peer %s" % grpcPeerStr)
+            context.abort(grpc.StatusCode.PERMISSION_DENIED, "Peer not allowed")
         grpcPeer["ne_vendor"] = "Cisco"
         PMGRPCDLOG.debug("Cisco MdtDialout Message: %s" % grpcPeer["telemetry_node"])
 
@@ -72,29 +80,29 @@ class gRPCMdtDialoutServicer(cisco_grpc_dialout_pb2_grpc.gRPCMdtDialoutServicer)
         jsonTelemetryNode = json.dumps(grpcPeer, indent=2, sort_keys=True)
 
         PMGRPCDLOG.debug("Cisco connection info: %s" % jsonTelemetryNode)
+        peer_envelope = PeerEnvelope(grpcPeer["telemetry_node"], grpcPeer["ne_vendor"])
         for new_msg in msg_iterator:
             #breakpoint() if get_lock() else None
             PMGRPCDLOG.debug("Cisco new_msg iteration message")
 
-            # filter msgs that do not match the IP option if enabled.
-            if lib_pmgrpcd.OPTIONS.ip:
-                if grpcPeer["telemetry_node"] != lib_pmgrpcd.OPTIONS.ip:
-                    continue
-                PMGRPCDLOG.debug(
-                    "Cisco: ip filter matched with ip %s" % (lib_pmgrpcd.OPTIONS.ip)
-                )
+            # drop unwanted paths before decoding, only gpbkv has a protobuf header.
+            if lib_pmgrpcd.OPTIONS.cenctype == 'gpbkv' and not prefilter.accept_message("cisco", new_msg.data):
+                continue
 
+            tracing.start_trace(grpcPeer["telemetry_node"])
             try:
-                cisco_processing(grpcPeer, new_msg)
+                cisco_processing(grpcPeer, new_msg, peer_envelope)
             except Exception as e:
                 PMGRPCDLOG.debug("Error processing Cisco packet, error is %s", e)
                 continue
+            finally:
+                tracing.finish_trace()
         return
         yield
 
 
 
-def cisco_processing(grpcPeer, new_msg):
+def cisco_processing(grpcPeer, new_msg, peer_envelope=None):
     messages = {}
     grpc_message = {}
     encoding_type = None
@@ -113,6 +121,7 @@ def cisco_processing(grpcPeer, new_msg):
         encoding_type, grpc_message = find_encoding_and_decode(new_msg)
     except Exception as e:
         PMGRPCDLOG.error("Error decoding packet. Error is {}".format(e))
+    tracing.mark("decode")
 
 
     PMGRPCDLOG.debug("encoding_type is: %s\n" % (encoding_type))
@@ -164,6 +173,10 @@ def cisco_processing(grpcPeer, new_msg):
             elem = 0
             messages = {}
     message_header_dict["path"] = path
+    tracing.annotate(
+        msg_timestamp=message_header_dict.get("msg_timestamp"),
+        encoding_path=message_header_dict.get("encoding_path"),
+    )
 
     PMGRPCDLOG.info(
         "EPOCH=%-10s NIP=%-15s NID=%-20s VEN=%-7s PT=%-22s ET=%-12s ELEM=%s",
@@ -177,33 +190,19 @@ def cisco_processing(grpcPeer, new_msg):
     )
 
     # A single telemetry packet can contain multiple msgs (each having their own key/values).
-    # here we are processing them one by one.
-
-    for listelem in messages:
-        # Copy the necessary metadata to the packet.
-        PMGRPCDLOG.debug("LISTELEM: %s", listelem)
-
-        message_dict = {}
-        message_dict.update({"collector": {"grpc": {}}})
-        message_dict["collector"]["grpc"].update(
-            {"grpcPeer": grpcPeer["telemetry_node"]}
-        )
-        message_dict["collector"]["grpc"].update({"ne_vendor": grpcPeer["ne_vendor"]})
-        message_dict["collector"].update({"data": message_header_dict})
-
-        if encoding_type == "ciscojson":
-            PMGRPCDLOG.debug("TEST: %s | %s", path, listelem["content"])
-            message_dict.update({path: listelem["content"]})
-        elif encoding_type == "ciscogrpckv":
-            PMGRPCDLOG.debug("TEST: %s | %s", path, listelem["fields"])
-            message_dict.update({path: listelem["fields"]})
-
-        # allkeys = parse_dict(listelem, ret='', level=0)
-        # PMGRPCDLOG.info("Cisco: %s: %s" % (proto, allkeys))
-        try:
-            returned = FinalizeTelemetryData(message_dict)
-        except Exception as e:
-            PMGRPCDLOG.error("Error finalazing  message: %s", e)
+    # They share the envelope (collector grpc and data), which is built once.
+    if peer_envelope is None:
+        peer_envelope = PeerEnvelope(grpcPeer["telemetry_node"], grpcPeer["ne_vendor"])
+    message_header_dict["collection_timestamp"] = epochmillis
+    envelope = peer_envelope.message(message_header_dict)
+    content_key = "content" if encoding_type == "ciscojson" else "fields"
+
+    def rows():
+        for listelem in messages:
+            PMGRPCDLOG.debug("LISTELEM: %s", listelem)
+            yield {path: listelem[content_key]}, None
+
+    FinalizeTelemetryRows(envelope, rows())
 
 
 
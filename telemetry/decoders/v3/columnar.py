@@ -0,0 +1,124 @@
+"""
+Columnar representation of metrics.
+
+The metrics of a gRPC message share an encoding path and, after flattening,
+mostly the same fields. to_columns converts them into a column per field, so
+consumers (e.g. columnar exporters) do not need to go row by row.
+Numeric columns are numpy arrays if numpy is installed, any other column is a list.
+"""
+from typing import Dict, Sequence
+from encoders.base import InternalMetric, GetData
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+INT64_MIN = -(2 ** 63)
+INT64_MAX = 2 ** 63 - 1
+UINT64_MAX = 2 ** 64 - 1
+
+
+def numeric_dtype(values):
+    """
+    Returns the numpy dtype for a list of values, or None if they are not all numbers.
+    Counters are unsigned 64 bits, so they get uint64 when they do not fit in int64.
+    """
+    has_float = False
+    for value in values:
+        # bool is an int, but we do not want it in a numeric column
+        if value.__class__ is float:
+            has_float = True
+        elif value.__class__ is not int:
+            return None
+    if has_float:
+        return "float64"
+    low = min(values)
+    high = max(values)
+    if low >= INT64_MIN and high <= INT64_MAX:
+        return "int64"
+    if low >= 0 and high <= UINT64_MAX:
+        return "uint64"
+    return None
+
+
+def make_column(values):
+    if numpy is None or not values:
+        return values
+    dtype = numeric_dtype(values)
+    if dtype is None:
+        return values
+    return numpy.array(values, dtype=dtype)
+
+
+class MetricColumns:
+    """
+    Columns of the metrics of one encoding path. A field missing in a metric
+    is None in its column, which makes the column a list.
+    """
+
+    __slots__ = ("path", "length", "node", "timestamp", "keys", "content")
+
+    def __init__(self, path, length, node, timestamp, keys, content):
+        self.path = path
+        self.length = length
+        self.node = node
+        self.timestamp = timestamp
+        self.keys = keys
+        self.content = content
+
+    def rows(self):
+        """
+        Converts back into (keys, content) per metric, skipping missing fields.
+        """
+        for n in range(self.length):
+            keys = {}
+            for name, column in self.keys.items():
+                value = column[n]
+                if value is not None:
+                    keys[name] = value
+            content = {}
+            for name, column in self.content.items():
+                value = column[n]
+                if value is not None:
+                    content[name] = value
+            yield keys, content
+
+
+def _fields_to_columns(rows: Sequence[Dict]) -> Dict:
+    names = {}
+    for row in rows:
+        for name in row:
+            names[name] = None
+    columns = {}
+    for name in names:
+        values = [row.get(name) for row in rows]
+        columns[name] = make_column(values)
+    return columns
+
+
+def _optional(metric, name):
+    try:
+        return getattr(metric, name)
+    except GetData:
+        return None
+
+
+def to_columns(metrics: Sequence[InternalMetric]) -> Dict[str, MetricColumns]:
+    """
+    Groups the metrics per encoding path, and converts every group into columns.
+    """
+    per_path = {}
+    for metric in metrics:
+        per_path.setdefault(metric.path, []).append(metric)
+    columns = {}
+    for path, path_metrics in per_path.items():
+        columns[path] = MetricColumns(
+            path,
+            len(path_metrics),
+            [_optional(metric, "node") for metric in path_metrics],
+            make_column([_optional(metric, "timestamp") for metric in path_metrics]),
+            _fields_to_columns([metric.keys for metric in path_metrics]),
+            _fields_to_columns([metric.content for metric in path_metrics]),
+        )
+    return columns
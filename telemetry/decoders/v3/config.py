@@ -23,14 +23,25 @@
 #   Thomas Graf <thomas.graf@swisscom.com>
 #   Paolo Lucente <paolo@pmacct.net>
 #
+import atexit
+import ipaddress
+import ujson as json
 import export_pmgrpcd
 import lib_pmgrpcd
 from zmq_modules.zmq_exporter import ZmqExporter
 from kafka_modules.kafka_avro_exporter import KafkaAvroExporter
 from kafka_modules.kafka_simple_exporter import KafkaExporter, load_topics_file
 from file_modules.file_producer import FileExporter
+from file_modules.columnar_exporter import ColumnarExporter
 from lib_pmgrpcd import PMGRPCDLOG
+import transformations
 from transformations import load_transformtions_from_file
+import tracing
+import prefilter
+import exportroutes
+import peerfilter
+from mitigation_engine import MitigationEngine
+from transformation_workers import TransformationWorkers
 
 
 def configure(config=None):
@@ -40,17 +51,72 @@ def configure(config=None):
     if config is None:
         config = lib_pmgrpcd.OPTIONS
 
+    if config.trace_sample_rate:
+        tracing.TRACER = tracing.StageTracer(
+            config.trace_sample_rate, config.trace_buffer_size
+        )
+        PMGRPCDLOG.info(
+            "Tracing 1 in %s messages, dump with USR2 to %s",
+            config.trace_sample_rate,
+            config.trace_dump_file,
+        )
+
+    if config.peer_allow or config.peer_deny or config.ip:
+        allow = peerfilter.parse_networks(config.peer_allow)
+        if config.ip:
+            allow.append(ipaddress.ip_network(config.ip))
+        peerfilter.PEER_FILTER = peerfilter.PeerFilter(allow, config.peer_deny)
+        PMGRPCDLOG.info("Peer filter, allow: %s, deny: %s", allow, config.peer_deny)
+
+    if config.prefilter_rules:
+        prefilter.PREFILTER = prefilter.PreFilter.from_file(
+            config.prefilter_rules, only_openconfig=bool(config.onlyopenconfig)
+        )
+        PMGRPCDLOG.info("Pre-filter rules loaded from %s", config.prefilter_rules)
+    elif config.onlyopenconfig:
+        prefilter.PREFILTER = prefilter.PreFilter(only_openconfig=True)
+
+    if config.mitigation_rules:
+        export_pmgrpcd.MITIGATION = MitigationEngine.from_file(config.mitigation_rules)
+        PMGRPCDLOG.info("Mitigation rules loaded from %s", config.mitigation_rules)
+
     # Check for transfomrations
+    transformations.TRIE_CACHE_SIZE = config.trie_cache_size
     if config.file_transformations:
-        transformations = load_transformtions_from_file(config.file_transformations)
-        if len(transformations) > 1:
-            raise Exception("We only accept a single transformation right now")
-        export_pmgrpcd.TRANSFORMATION = transformations[0]
+        if config.transformation_workers:
+            # the transformations (and their state) only live in the workers
+            with open(config.file_transformations) as fh:
+                if len(json.load(fh)) > 1:
+                    raise Exception("We only accept a single transformation right now")
+            workers = TransformationWorkers(
+                config.file_transformations,
+                config.transformation_workers,
+                export_pmgrpcd.export_transformed,
+                shard_by=config.transformation_shard_by,
+                trie_cache_size=config.trie_cache_size,
+            )
+            workers.start()
+            export_pmgrpcd.TRANSFORMATION_WORKERS = workers
+            PMGRPCDLOG.info(
+                "Running transformations in %s worker processes", config.transformation_workers
+            )
+        else:
+            loaded = load_transformtions_from_file(config.file_transformations)
+            if len(loaded) > 1:
+                raise Exception("We only accept a single transformation right now")
+            export_pmgrpcd.TRANSFORMATION = loaded[0]
+            export_pmgrpcd.start_transformation_timer()
 
     # Add the exporters
 
     if config.zmq:
-        zmq_exporter = ZmqExporter()
+        zmq_exporter = ZmqExporter(
+            config.zmqipport,
+            config.zmq_mode,
+            batch_size=config.zmq_batch_size,
+            flush_seconds=config.zmq_flush_seconds,
+            sndhwm=config.zmq_sndhwm,
+        )
         export_pmgrpcd.EXPORTERS["zmq"] = zmq_exporter
     if config.kafkaavro:
         if config.bsservers is None:
@@ -72,3 +138,24 @@ def configure(config=None):
     if config.file_exporter_file is not None:
         exporter = FileExporter(config.file_exporter_file)
         export_pmgrpcd.EXPORTERS["file"] = exporter
+    if config.columnar_exporter_dir is not None:
+        exporter = ColumnarExporter(
+            config.columnar_exporter_dir,
+            config.columnar_format,
+            batch_size=config.columnar_batch_size,
+            flush_seconds=config.columnar_flush_seconds,
+            roll_seconds=config.columnar_roll_seconds,
+            roll_bytes=config.columnar_roll_mbytes * 1024 * 1024,
+            schemas_file=config.columnar_schemas_file,
+            compression=config.columnar_compression,
+        )
+        export_pmgrpcd.EXPORTERS["columnar"] = exporter
+
+    if config.export_routes:
+        exportroutes.EXPORT_ROUTES = exportroutes.ExportRoutes.from_file(
+            config.export_routes, export_pmgrpcd.EXPORTERS
+        )
+        PMGRPCDLOG.info("Export routes loaded from %s", config.export_routes)
+
+    # registered last, so it runs before the exporters are closed
+    atexit.register(export_pmgrpcd.shutdown)
@@ -27,26 +27,34 @@
 from datetime import datetime
 import pprint
 import json
+import threading
+from mitigation_engine import normalize_keys
 
 global mitigation
 mitigation = {}
 
+# The record being modified is the global mitigation, and mod_all_json_data is
+# called from all the gRPC threads, so only one record is modified at a time.
+# The mitigation_rules option (mitigation_engine.py) does not need this.
+MITIGATION_LOCK = threading.Lock()
+
 
 def mod_all_json_data(resdict):
     global mitigation
 
-    mitigation = resdict.copy()
+    with MITIGATION_LOCK:
+        mitigation = resdict.copy()
 
-    if "collector" in mitigation:
-        if ("grpc" in mitigation["collector"]) and ("data" in mitigation["collector"]):
-            if "ne_vendor" in mitigation["collector"]["grpc"]:
-                mod_all_pre()
-                if mitigation["collector"]["grpc"]["ne_vendor"] == "Huawei":
-                    mod_huawei()
-                elif mitigation["collector"]["grpc"]["ne_vendor"] == "Cisco":
-                    mod_cisco()
-                mod_all_post()
-    return mitigation
+        if "collector" in mitigation:
+            if ("grpc" in mitigation["collector"]) and ("data" in mitigation["collector"]):
+                if "ne_vendor" in mitigation["collector"]["grpc"]:
+                    mod_all_pre()
+                    if mitigation["collector"]["grpc"]["ne_vendor"] == "Huawei":
+                        mod_huawei()
+                    elif mitigation["collector"]["grpc"]["ne_vendor"] == "Cisco":
+                        mod_cisco()
+                    mod_all_post()
+        return mitigation
 
 
 def mod_all_pre():
@@ -195,17 +203,8 @@ def addanywayarray_int():
 
 
 def d2u(obj):
-    if isinstance(obj, (str, int, float)):
-        return obj
-    if isinstance(obj, dict):
-        new = obj.__class__()
-        for k, v in obj.items():
-            new[k.replace("-", "_")] = d2u(v)
-    elif isinstance(obj, (list, set, tuple)):
-        new = obj.__class__(d2u(v) for v in obj)
-    else:
-        return obj
-    return new
+    # The key names are cached, see KeyNormalizer in mitigation_engine.py
+    return normalize_keys(obj)
 
 
 def harmonize_collector_data():
@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+import sys
 from typing import Iterable, Sequence, Dict, Union, Any, Generator, Tuple
 import ujson as json
 from pygtrie import CharTrie
@@ -9,13 +10,22 @@ ValueField = Dict[str, Union[str, float]]
 Field = Dict[str, Union["Field", ValueField]]
 
 
+def intern_string(value):
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
 class BaseEncoding:
+    __slots__ = ()
 
     content_key = "content"
     keys_key = "keys"
     p_key = "encodingPath"
     node_key = "node_id"
     timestamp_key = "timestamp"
+    # gRPC peer of the message, kept (as an extra entry) to route the transformed metrics
+    peer_key = "grpcPeer"
 
     def __init__(self, data: Dict[Any, Any]):
         self.data = data
@@ -98,23 +108,106 @@ class InternalIteratorError(BaseEncodingException):
 
 
 
+# Marks a missing envelope field in InternalMetric.
+_MISSING = object()
+
+
 class InternalMetric(BaseEncoding):
+    """
+    Metric used by the transformations. The envelope fields (content, keys, path,
+    node and timestamp) are kept in slots, path and node strings are interned.
+    Any other entry of the data goes to extra, a dict shared between the metric and
+    the metrics created with replace, that must not be modified.
+    data builds a new dict each time it is requested, so changing it is silently
+    lost (metric.data[key] = value does nothing): assign data, or use replace.
+    """
+
+    __slots__ = ("_content", "_keys", "_path", "_node", "_timestamp", "_extra")
 
     def __init__(self, data):
-        super().__init__(data)
+        self.data = data
+        if self._content is _MISSING:
+            raise BaseEncodingException("Content not found")
+
+    @property
+    def data(self):
+        data = self._extra.copy()
+        for key, value in (
+            (self.node_key, self._node),
+            (self.timestamp_key, self._timestamp),
+            (self.p_key, self._path),
+            (self.keys_key, self._keys),
+            (self.content_key, self._content),
+        ):
+            if value is not _MISSING:
+                data[key] = value
+        return data
+
+    @data.setter
+    def data(self, data):
+        extra = data.copy()
+        self._content = extra.pop(self.content_key, _MISSING)
+        self._keys = extra.pop(self.keys_key, _MISSING)
+        self._path = intern_string(extra.pop(self.p_key, _MISSING))
+        self._node = intern_string(extra.pop(self.node_key, _MISSING))
+        self._timestamp = extra.pop(self.timestamp_key, _MISSING)
+        self._extra = extra
+
+    @staticmethod
+    def _get(value, name):
+        if value is _MISSING:
+            raise GetData(f"Error getting {name}, no key {name}")
+        return value
+
+    @property
+    def content(self):
+        return self._get(self._content, "content")
+
+    @property
+    def keys(self):
+        return self._get(self._keys, "keys")
+
+    @property
+    def path(self) -> str:
+        return self._get(self._path, "path")
+
+    @property
+    def node(self):
+        return self._get(self._node, "node")
+
+    @property
+    def timestamp(self):
+        return self._get(self._timestamp, "timestamp")
+
+    def load_from_data(self, key, name=None):
+        if name is None:
+            name = key
+        if key == self.content_key:
+            return self._get(self._content, name)
+        if key == self.keys_key:
+            return self._get(self._keys, name)
+        if key == self.p_key:
+            return self._get(self._path, name)
+        if key == self.node_key:
+            return self._get(self._node, name)
+        if key == self.timestamp_key:
+            return self._get(self._timestamp, name)
+        if key not in self._extra:
+            raise GetData(f"Error getting {name}, no key {key}")
+        return self._extra[key]
 
     def replace(self, content=None, keys=None, path=None):
-        new_data = self.data.copy()
-        if content is not None:
-            new_data[self.content_key] = content
-        if keys is not None:
-            new_data[self.keys_key] = keys
-        if path is not None:
-            new_data[self.p_key] = path
-        return InternalMetric(new_data)
+        new_metric = InternalMetric.__new__(InternalMetric)
+        new_metric._content = self._content if content is None else content
+        new_metric._keys = self._keys if keys is None else keys
+        new_metric._path = self._path if path is None else intern_string(path)
+        new_metric._node = self._node
+        new_metric._timestamp = self._timestamp
+        new_metric._extra = self._extra
+        return new_metric
 
     def get_json(self):
-        new_data = self.data.copy()
+        new_data = self.data
 
         new_content = json.dumps(self.content)
         new_data[self.content_key] = new_content
@@ -0,0 +1,181 @@
+"""
+Decoding of gNMI notifications (https://github.com/openconfig/gnmi) into internal metrics.
+
+A notification has a prefix Path and a list of updates, each with a relative
+Path and a TypedValue. The encoding path of a metric is the origin plus the
+element names of prefix and update path without the leaf, the keys of all the
+elements are the keys of the metric, and the leaf is a field of the content.
+Updates of a notification with the same encoding path and keys are grouped
+into a single metric.
+
+Targets repeat the same prefixes and paths in every notification, so the
+conversion of a Path is cached. Building the strings again for every leaf is
+most of the decoding cost, especially for ON_CHANGE streams, which send many
+notifications with few updates. The cache key is a tuple with the names and
+keys of the elements: with the python protobuf implementation, serializing a
+Path to use its bytes as key costs several times more than reading it.
+
+Key names repeated in different elements of a path are prefixed with the
+element name (e.g. interface_name and subinterface_index).
+"""
+from .base import InternalMetric
+from caching import LRUCache, DEFAULT_CACHE_SIZE
+import sys
+import ujson as json
+
+NS_PER_MS = 1000000
+
+
+def _json(field):
+    return lambda value: json.loads(getattr(value, field))
+
+
+def _hex(field):
+    return lambda value: getattr(value, field).hex()
+
+
+def _decimal(value):
+    decimal = value.decimal_val
+    return decimal.digits / 10 ** decimal.precision
+
+
+def _leaflist(value):
+    return [typed_value_to_python(element) for element in value.leaflist_val.element]
+
+
+# TypedValue fields that are not used as they are
+TYPED_VALUE_CONVERSIONS = {
+    "json_val": _json("json_val"),
+    "json_ietf_val": _json("json_ietf_val"),
+    "decimal_val": _decimal,
+    "leaflist_val": _leaflist,
+    "bytes_val": _hex("bytes_val"),
+    "proto_bytes": _hex("proto_bytes"),
+    "any_val": lambda value: value.any_val.value.hex(),
+}
+
+
+def typed_value_to_python(value):
+    """
+    Converts a TypedValue, without MessageToDict. json values are decoded and
+    bytes become hex strings.
+    """
+    kind = value.WhichOneof("value")
+    if kind is None:
+        return None
+    conversion = TYPED_VALUE_CONVERSIONS.get(kind)
+    if conversion is None:
+        return getattr(value, kind)
+    return conversion(value)
+
+
+def path_key(path):
+    """
+    Hashable identity of a Path.
+    """
+    return (
+        path.origin,
+        tuple([(elem.name, tuple(sorted(elem.key.items()))) if elem.key else elem.name for elem in path.elem]),
+    )
+
+
+def add_path_keys(keys, elems):
+    for elem in elems:
+        for key, value in sorted(elem.key.items()):
+            if key in keys:
+                key = f"{elem.name}_{key}"
+            keys[key] = value
+
+
+class PrefixInfo:
+    __slots__ = ("cache_key", "origin", "names", "keys")
+
+    def __init__(self, cache_key, origin, names, keys):
+        self.cache_key = cache_key
+        self.origin = origin
+        self.names = names
+        self.keys = keys
+
+
+class PathInfo:
+    """
+    Conversion of an update path under a prefix. group identifies the metric
+    the update belongs to.
+    """
+
+    __slots__ = ("encoding_path", "keys", "leaf", "group")
+
+    def __init__(self, encoding_path, keys, leaf):
+        self.encoding_path = encoding_path
+        self.keys = keys
+        self.leaf = leaf
+        self.group = (encoding_path, json.dumps(keys, sort_keys=True))
+
+
+class GNMIDecoder:
+    def __init__(self, cache_size=DEFAULT_CACHE_SIZE):
+        self.prefixes = LRUCache(cache_size, "gnmi_prefixes")
+        self.paths = LRUCache(cache_size, "gnmi_paths")
+
+    def prefix_info(self, prefix):
+        cache_key = path_key(prefix)
+        info = self.prefixes.get(cache_key)
+        if info is None:
+            keys = {}
+            add_path_keys(keys, prefix.elem)
+            names = tuple(elem.name for elem in prefix.elem)
+            info = PrefixInfo(cache_key, prefix.origin, names, keys)
+            self.prefixes.set(cache_key, info)
+        return info
+
+    def path_info(self, prefix_info, path):
+        cache_key = (prefix_info.cache_key, path_key(path))
+        info = self.paths.get(cache_key)
+        if info is None:
+            names = prefix_info.names + tuple(elem.name for elem in path.elem)
+            leaf = names[-1] if names else ""
+            origin = prefix_info.origin or path.origin
+            encoding_path = "/".join(names[:-1])
+            if origin:
+                encoding_path = f"{origin}:{encoding_path}"
+            keys = dict(prefix_info.keys)
+            add_path_keys(keys, path.elem)
+            info = PathInfo(sys.intern(encoding_path), keys, leaf)
+            self.paths.set(cache_key, info)
+        return info
+
+    def decode(self, notification, node):
+        """
+        Returns the metrics of a notification. Deleted paths become a metric with
+        the deleted leaves in the content field deleted.
+        """
+        timestamp = notification.timestamp // NS_PER_MS
+        prefix_info = self.prefix_info(notification.prefix)
+        groups = {}
+        for update in notification.update:
+            info = self.path_info(prefix_info, update.path)
+            group = groups.get(info.group)
+            if group is None:
+                group = groups[info.group] = (info, {})
+            group[1][info.leaf] = typed_value_to_python(update.val)
+        for deleted in notification.delete:
+            info = self.path_info(prefix_info, deleted)
+            group = groups.get(info.group)
+            if group is None:
+                group = groups[info.group] = (info, {})
+            group[1].setdefault("deleted", []).append(info.leaf)
+        metrics = []
+        for info, content in groups.values():
+            metrics.append(
+                InternalMetric(
+                    {
+                        InternalMetric.p_key: info.encoding_path,
+                        InternalMetric.node_key: node,
+                        InternalMetric.timestamp_key: timestamp,
+                        # the cached keys are shared, every metric gets its own copy
+                        InternalMetric.keys_key: dict(info.keys),
+                        InternalMetric.content_key: content,
+                    }
+                )
+            )
+        return metrics
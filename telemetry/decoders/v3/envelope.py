@@ -0,0 +1,118 @@
+#
+#   pmacct (Promiscuous mode IP Accounting package)
+#   pmacct is Copyright (C) 2003-2019 by Paolo Lucente
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+#   pmgrpcd and its components are Copyright (C) 2018-2019 by:
+#
+#   Matthias Arnold <matthias.arnold@swisscom.com>
+#   Juan Camilo Cardona <jccardona82@gmail.com>
+#   Thomas Graf <thomas.graf@swisscom.com>
+#   Paolo Lucente <paolo@pmacct.net>
+#
+"""
+Envelope (the collector entry) shared by the rows of a gRPC message.
+
+Every row of a message is exported as {"collector": {"grpc": ..., "data": ...},
+<row entries>}. grpc only depends on the peer and data on the message header
+(plus, for Huawei, a few row header fields), so they are built and json
+encoded once, and the encoded fragments are spliced into the json of each row.
+The output is the same as json.dumps(row_dict, sort_keys=True).
+
+The templates must not be modified once built.
+"""
+import ujson as json
+
+
+def encode_items(items):
+    """
+    Encodes a dict of already encoded '"key":value' items, sorted by key.
+    """
+    return "{" + ",".join(items[key] for key in sorted(items)) + "}"
+
+
+def encode_item(key, value):
+    return json.dumps(key) + ":" + json.dumps(value, sort_keys=True)
+
+
+class PeerEnvelope:
+    """
+    grpc part of the envelope, built once per stream.
+    """
+
+    __slots__ = ("grpc", "grpc_json")
+
+    def __init__(self, grpc_peer, ne_vendor):
+        self.grpc = {"grpcPeer": grpc_peer, "ne_vendor": ne_vendor}
+        self.grpc_json = json.dumps(self.grpc, sort_keys=True)
+
+    def message(self, data):
+        return MessageEnvelope(self, data)
+
+
+class MessageEnvelope:
+    """
+    Envelope of the rows of a message. data is the message header.
+    """
+
+    __slots__ = ("peer", "data", "_data_items", "_collector_json")
+
+    def __init__(self, peer, data):
+        self.peer = peer
+        self.data = data
+        self._data_items = {key: encode_item(key, value) for key, value in data.items()}
+        self._collector_json = None
+
+    def get(self, key, row_data=None):
+        if row_data and key in row_data:
+            return row_data[key]
+        return self.data.get(key)
+
+    def _collector(self, data_items):
+        return '{"data":' + encode_items(data_items) + ',"grpc":' + self.peer.grpc_json + "}"
+
+    def collector_json(self, row_data=None):
+        if not row_data:
+            # two threads could build it at the same time, with the same result.
+            if self._collector_json is None:
+                self._collector_json = self._collector(self._data_items)
+            return self._collector_json
+        data_items = self._data_items.copy()
+        for key, value in row_data.items():
+            data_items[key] = encode_item(key, value)
+        return self._collector(data_items)
+
+    def encode(self, fields, row_data=None):
+        """
+        json of a row. fields are the top level entries of the row besides
+        collector, row_data the entries added to (or replaced in) data for this row.
+        """
+        items = {"collector": '"collector":' + self.collector_json(row_data)}
+        for key, value in fields.items():
+            items[key] = encode_item(key, value)
+        return encode_items(items)
+
+    def message_dict(self, fields, row_data=None):
+        """
+        The row as a dict, with its own collector dicts, for the code that needs
+        to change it (mitigation, transformations).
+        """
+        data = self.data.copy()
+        if row_data:
+            data.update(row_data)
+        message = {"collector": {"grpc": self.peer.grpc.copy(), "data": data}}
+        message.update(fields)
+        return message
@@ -23,7 +23,9 @@
 #   Thomas Graf <thomas.graf@swisscom.com>
 #   Paolo Lucente <paolo@pmacct.net>
 #
+import logging
 import os
+import threading
 import time
 from lib_pmgrpcd import PMGRPCDLOG
 import lib_pmgrpcd
@@ -32,6 +34,9 @@ import ujson as json
 from abc import ABC, abstractmethod
 from debug import get_lock
 from encoders.cisco_kv import CiscoKVFlatten
+import tracing
+import exportroutes
+from encoders.base import InternalMetric
 
 jsonmap = {}
 avscmap = {}
@@ -41,24 +46,188 @@ example_dict = {}
 
 EXPORTERS = {}
 TRANSFORMATION = None
+# Set up by config.configure when mitigation rules are given.
+MITIGATION = None
+# Set up by config.configure when transformations run in worker processes.
+TRANSFORMATION_WORKERS = None
 
 class Exporter(ABC):
     @abstractmethod
     def process_metric(self, metric):
         pass
 
+    def export(self, data):
+        """
+        data is an ExportData. Exporters that work on the dict override this,
+        so the json is not built and parsed again. The dict is shared with the
+        other exporters and must not be changed.
+        """
+        self.process_metric(data.json())
+
+
+class ExportData:
+    """
+    A metric on its way to the exporters, as json or as a dict. The other
+    format is only built (once) if an exporter needs it. path (encoding path)
+    and peer are used by the export routes. The json is compact (no indentation),
+    the same as the rows encoded from an envelope.
+    """
+
+    __slots__ = ("_json", "_dict", "path", "peer")
+
+    def __init__(self, jsondata=None, dictdata=None, path=None, peer=None):
+        self._json = jsondata
+        self._dict = dictdata
+        self.path = path
+        self.peer = peer
+
+    def json(self):
+        if self._json is None:
+            self._json = self.encode()
+        return self._json
+
+    def dict(self):
+        if self._dict is None:
+            self._dict = self.decode()
+        return self._dict
+
+    def encode(self):
+        return json.dumps(self._dict, sort_keys=True)
+
+    def decode(self):
+        return json.loads(self._json)
+
+    def route(self):
+        """
+        Fills path and peer from the dict, if they were not given.
+        """
+        if self.path is not None and self.peer is not None:
+            return
+        collector = self.dict().get("collector", {})
+        data = collector.get("data", {})
+        if self.path is None:
+            self.path = data.get("encoding_path") or data.get("sensor_path") or data.get("encodingPath")
+        if self.peer is None:
+            self.peer = collector.get("grpc", {}).get("grpcPeer") or data.get("node_id")
+
+
+class RowExportData(ExportData):
+    """
+    A row of a message sharing an envelope (see envelope.py).
+    """
+
+    __slots__ = ("envelope", "fields", "row_data")
+
+    def __init__(self, envelope, fields, row_data=None):
+        path = envelope.get("encoding_path", row_data) or envelope.get("sensor_path", row_data)
+        super().__init__(path=path, peer=envelope.peer.grpc["grpcPeer"])
+        self.envelope = envelope
+        self.fields = fields
+        self.row_data = row_data
+
+    def encode(self):
+        return self.envelope.encode(self.fields, self.row_data)
+
+    def decode(self):
+        return self.envelope.message_dict(self.fields, self.row_data)
+
+
+def selected_exporters(data):
+    """
+    Names of the exporters of an ExportData, all of them without export routes.
+    """
+    if exportroutes.EXPORT_ROUTES is None:
+        return EXPORTERS
+    data.route()
+    return exportroutes.EXPORT_ROUTES.exporters_for(data.path, data.peer)
+
+
+def export_data(data, exporters=None):
+    """
+    Exports an ExportData. exporters are the names from selected_exporters, if
+    the caller already has them.
+    """
+    if exporters is None:
+        exporters = selected_exporters(data)
+    for exporter in exporters:
+        try:
+            EXPORTERS[exporter].export(data)
+        except Exception as e:
+            PMGRPCDLOG.debug("Error processing packet on exporter %s. Error was %s", exporter, e)
+            raise
+        tracing.mark("exporter:" + exporter)
 
 
 def export_metrics(datajsonstring):
-    #breakpoint() if get_lock() else None
-   
-    for exporter in EXPORTERS:
+    export_data(ExportData(jsondata=datajsonstring))
+
+
+def export_transformed(data):
+    """
+    Exports the data of a transformed metric. The gRPC peer of the original
+    message goes back to collector/grpc, like in the raw metrics.
+    """
+    data["dataGpbkv"] = data["content"]
+    collector = {"data": data}
+    peer = data.pop(InternalMetric.peer_key, None)
+    if peer is not None:
+        collector["grpc"] = {"grpcPeer": peer}
+    else:
+        # e.g. gnmi metrics, where the node is the target
+        peer = data.get(InternalMetric.node_key)
+    export_data(
+        ExportData(
+            dictdata={"collector": collector},
+            path=data.get(InternalMetric.p_key),
+            peer=peer,
+        )
+    )
+
+
+def export_internal_metrics(internals):
+    """
+    Transforms (if a transformation is configured) and exports metrics that are
+    already internal metrics, e.g. from the gnmi collector.
+    """
+    if TRANSFORMATION_WORKERS is not None:
+        TRANSFORMATION_WORKERS.submit(internals)
+        return
+    if TRANSFORMATION:
+        internals = TRANSFORMATION.transform_batch(internals)
+        tracing.mark("transformation")
+    for metric in internals:
+        export_transformed(metric.data)
+
+
+def expire_transformation(interval=1):
+    """
+    Timer thread of the transformation (without workers, they have their own),
+    exports the metrics it releases with the time, e.g. closed windows.
+    """
+    while True:
+        time.sleep(interval)
         try:
-            EXPORTERS[exporter].process_metric(datajsonstring)
+            for metric in TRANSFORMATION.expire():
+                export_transformed(metric.data)
         except Exception as e:
-            PMGRPCDLOG.debug("Error processing packet on exporter %s. Error was %s", exporter, e)
-            raise
-        #breakpoint() if get_lock() else None
+            PMGRPCDLOG.error("Error expiring the transformation: %s", e)
+
+
+def start_transformation_timer():
+    threading.Thread(target=expire_transformation, name="transformation-timer", daemon=True).start()
+
+
+def shutdown():
+    """
+    Stops the transformation workers, or flushes the transformation, exporting
+    the metrics they still hold (e.g. open windows). Called at exit, before the
+    exporters are closed.
+    """
+    if TRANSFORMATION_WORKERS is not None:
+        TRANSFORMATION_WORKERS.stop()
+    elif TRANSFORMATION:
+        for metric in TRANSFORMATION.flush():
+            export_transformed(metric.data)
 
 
 def examples(dictTelemetryData_mod, jsonTelemetryData):
@@ -98,7 +267,53 @@ def examples(dictTelemetryData_mod, jsonTelemetryData):
             exapathfile.write("\n")
 
 
-def FinalizeTelemetryData(dictTelemetryData):
+def FinalizeTelemetryRows(envelope, rows, owned=False):
+    """
+    Finalizes the rows of a message, which share the envelope (see envelope.py).
+    rows are (fields, row_data): the top level entries of the row besides
+    collector, and the entries of collector/data that only apply to this row
+    (or None).
+    Without mitigation and transformations, the envelope is encoded once and
+    spliced into the json of every row, and collection_timestamp is the one of
+    the envelope. Otherwise each row is built as a dict and goes through
+    FinalizeTelemetryData.
+    """
+    if (
+        lib_pmgrpcd.OPTIONS.mitigation
+        or MITIGATION is not None
+        or TRANSFORMATION
+        or TRANSFORMATION_WORKERS is not None
+    ):
+        for fields, row_data in rows:
+            try:
+                FinalizeTelemetryData(envelope.message_dict(fields, row_data), owned)
+            except Exception as e:
+                PMGRPCDLOG.error("Error finalazing  message: %s", e)
+        return
+
+    for fields, row_data in rows:
+        try:
+            data = RowExportData(envelope, fields, row_data)
+            if lib_pmgrpcd.OPTIONS.examplepath and lib_pmgrpcd.OPTIONS.example:
+                examples(data.dict(), data.json())
+            if lib_pmgrpcd.OPTIONS.jsondatadumpfile:
+                with open(lib_pmgrpcd.OPTIONS.jsondatadumpfile, "a") as jsondatadumpfile:
+                    jsondatadumpfile.write(data.json())
+                    jsondatadumpfile.write("\n")
+            if lib_pmgrpcd.OPTIONS.onlyopenconfig:
+                if "openconfig" not in (envelope.get("encoding_path", row_data) or ""):
+                    continue
+            # the row is only encoded if an exporter needs it
+            export_data(data)
+        except Exception as e:
+            PMGRPCDLOG.error("Error finalazing  message: %s", e)
+
+
+def FinalizeTelemetryData(dictTelemetryData, owned=False):
+    """
+    owned marks that nothing else references the nested dicts and lists of
+    dictTelemetryData, so the mitigation rules can change them in place.
+    """
 
     # Adding epoch in millisecond to identify this singel metric on the way to the storage
     epochmillis = int(round(time.time() * 1000))
@@ -109,26 +324,28 @@ def FinalizeTelemetryData(dictTelemetryData):
     # Going over the mitigation library, if needed.
     # TODO: Simplify the next part
     dictTelemetryData_beforeencoding = None
-    if lib_pmgrpcd.OPTIONS.mitigation:
-        from mitigation import mod_all_json_data
+    if lib_pmgrpcd.OPTIONS.mitigation or MITIGATION is not None:
+        if MITIGATION is not None:
+            mod_all_json_data = lambda record: MITIGATION.apply(record, owned)
+        else:
+            from mitigation import mod_all_json_data
         try:
             dictTelemetryData_mod = mod_all_json_data(dictTelemetryData_mod)
             dictTelemetryData_beforeencoding = dictTelemetryData_mod
-            jsonTelemetryData = json.dumps(
-                dictTelemetryData_mod, indent=2, sort_keys=True
-            )
         except Exception as e:
             PMGRPCDLOG.info("ERROR: mod_all_json_data raised a error:\n%s")
             PMGRPCDLOG.info("ERROR: %s" % (e))
             dictTelemetryData_mod = dictTelemetryData
             dictTelemetryData_beforeencoding = dictTelemetryData
-            jsonTelemetryData = json.dumps(dictTelemetryData, indent=2, sort_keys=True)
+        tracing.mark("mitigation")
     else:
         dictTelemetryData_mod = dictTelemetryData
         dictTelemetryData_beforeencoding = dictTelemetryData
-        jsonTelemetryData = json.dumps(dictTelemetryData, indent=2, sort_keys=True)
 
-    PMGRPCDLOG.debug("After mitigation: %s" % (jsonTelemetryData))
+    # json is only built if needed (debug, examples, dump or a json exporter)
+    data = ExportData(dictdata=dictTelemetryData_mod)
+    if PMGRPCDLOG.isEnabledFor(logging.DEBUG):
+        PMGRPCDLOG.debug("After mitigation: %s" % (data.json()))
 
     # Check if we need to transform. This will change later
     #breakpoint() if get_lock() else None
@@ -136,35 +353,35 @@ def FinalizeTelemetryData(dictTelemetryData):
     actual_data  = dictTelemetryData_beforeencoding.get(path, {})
     #if path == "sys/intf":
     #    return
-    print(path)
     #breakpoint() if get_lock() else None
 
-    if TRANSFORMATION and dictTelemetryData_beforeencoding and "dataGpbkv" in dictTelemetryData_beforeencoding.get("collector", {}).get("data", {}):
+    if (TRANSFORMATION or TRANSFORMATION_WORKERS is not None) and dictTelemetryData_beforeencoding and "dataGpbkv" in dictTelemetryData_beforeencoding.get("collector", {}).get("data", {}):
         data = dictTelemetryData_beforeencoding["collector"]["data"].copy()
         data["dataGpbkv"] = [{"fields": actual_data}]
+        data[InternalMetric.peer_key] = dictTelemetryData_beforeencoding["collector"].get("grpc", {}).get("grpcPeer")
         # we just transform for kv
         metric = CiscoKVFlatten.build_from_dcit(data)
         internals = list(metric.get_internal())
 
         #breakpoint() if get_lock() else None
-        for internal in internals:
-            for new_metric in TRANSFORMATION.transform(internal):
-                print(new_metric.keys)
-                data = new_metric.data
-                data["dataGpbkv"] = new_metric.content
-                export_metrics(json.dumps({"collector": {"data":data}}))
+        if TRANSFORMATION_WORKERS is not None:
+            TRANSFORMATION_WORKERS.submit(internals)
+            return data
+        for new_metric in TRANSFORMATION.transform_batch(internals):
+            tracing.mark("transformation")
+            export_transformed(new_metric.data)
         #breakpoint() if get_lock() else None
-        return jsonTelemetryData
+        return data
     #breakpoint() if get_lock() else None
 
 
     if lib_pmgrpcd.OPTIONS.examplepath and lib_pmgrpcd.OPTIONS.example:
-        examples(dictTelemetryData_mod, jsonTelemetryData)
+        examples(dictTelemetryData_mod, data.json())
 
     if lib_pmgrpcd.OPTIONS.jsondatadumpfile:
         PMGRPCDLOG.debug("Write jsondatadumpfile: %s" % (lib_pmgrpcd.OPTIONS.jsondatadumpfile))
         with open(lib_pmgrpcd.OPTIONS.jsondatadumpfile, "a") as jsondatadumpfile:
-            jsondatadumpfile.write(jsonTelemetryData)
+            jsondatadumpfile.write(data.json())
             jsondatadumpfile.write("\n")
 
 
@@ -185,6 +402,6 @@ def FinalizeTelemetryData(dictTelemetryData):
 
 
     if export:
-        export_metrics(jsonTelemetryData)
+        export_data(data)
 
-    return jsonTelemetryData
+    return data
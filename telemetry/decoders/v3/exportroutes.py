@@ -0,0 +1,164 @@
+#
+#   pmacct (Promiscuous mode IP Accounting package)
+#   pmacct is Copyright (C) 2003-2019 by Paolo Lucente
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+#   pmgrpcd and its components are Copyright (C) 2018-2019 by:
+#
+#   Matthias Arnold <matthias.arnold@swisscom.com>
+#   Juan Camilo Cardona <jccardona82@gmail.com>
+#   Thomas Graf <thomas.graf@swisscom.com>
+#   Paolo Lucente <paolo@pmacct.net>
+#
+"""
+Routing of the metrics to the exporters, by encoding path and peer.
+
+Without routes every metric goes to every exporter. Routes (see
+config_files/export_routes.json) restrict the exporters they name:
+    exporters: names of the exporters (keys of export_pmgrpcd.EXPORTERS).
+    paths: fnmatch patterns of the encoding path. Any path if missing.
+    peers: networks (CIDR) or fnmatch patterns of the peer. Any peer if missing.
+    sample: keeps 1 in every N metrics of each path. All if missing.
+An exporter named in a route only receives the metrics of the routes that
+match, an exporter that no route names receives all of them.
+
+The exporters of each (path, peer) are computed once and cached, so routing
+is a lookup per metric (plus a counter for the sampled routes).
+"""
+from fnmatch import fnmatchcase
+import ipaddress
+import itertools
+import ujson as json
+from caching import LRUCache
+
+# None means every metric goes to every exporter. It is set up by config.configure.
+EXPORT_ROUTES = None
+
+
+class Route:
+    def __init__(self, exporters, paths=None, peers=None, sample=None):
+        if not exporters:
+            raise Exception("Export route without exporters")
+        if isinstance(exporters, str):
+            exporters = [exporters]
+        self.exporters = list(exporters)
+        self.paths = list(paths or [])
+        self.networks = []
+        self.peer_patterns = []
+        for peer in peers or []:
+            try:
+                self.networks.append(ipaddress.ip_network(peer, strict=False))
+            except ValueError:
+                self.peer_patterns.append(peer)
+        self.has_peers = bool(peers)
+        if sample is not None and (not isinstance(sample, int) or sample < 1):
+            raise Exception(f"Sample rate of a route must be an integer of at least 1, got {sample}")
+        self.sample = sample if sample and sample > 1 else None
+
+    def match_path(self, path):
+        if not self.paths:
+            return True
+        if path is None:
+            return False
+        for pattern in self.paths:
+            if fnmatchcase(path, pattern):
+                return True
+        return False
+
+    def match_peer(self, peer):
+        if not self.has_peers:
+            return True
+        if peer is None:
+            return False
+        for pattern in self.peer_patterns:
+            if fnmatchcase(peer, pattern):
+                return True
+        if self.networks:
+            try:
+                address = ipaddress.ip_address(peer)
+            except ValueError:
+                return False
+            for network in self.networks:
+                if address in network:
+                    return True
+        return False
+
+    def match(self, path, peer):
+        return self.match_path(path) and self.match_peer(peer)
+
+
+class ExportRoutes:
+    def __init__(self, routes, exporters, cache_size=10000):
+        """
+        exporters are the names of all the configured exporters.
+        """
+        self.routes = [route if isinstance(route, Route) else Route(**route) for route in routes]
+        self.exporters = list(exporters)
+        routed = set()
+        for route in self.routes:
+            for name in route.exporters:
+                if name not in self.exporters:
+                    raise Exception(f"Export route to {name}, which is not configured. Exporters: {self.exporters}")
+                routed.add(name)
+        self.unrouted = [name for name in self.exporters if name not in routed]
+        self.selections = LRUCache(cache_size, "export_routes")
+        # Sampling counters per (route, path). next() over itertools.count is
+        # atomic in CPython, no lock needed.
+        self._counters = {}
+
+    @classmethod
+    def from_file(cls, filename, exporters, **kwargs):
+        with open(filename) as fh:
+            config = json.loads(fh.read())
+        return cls(config["routes"], exporters, **kwargs)
+
+    def select(self, key):
+        """
+        Returns (exporters, sampled) for a (path, peer). sampled are
+        (route index, rate, exporters) for the matching routes with sampling.
+        """
+        path, peer = key
+        selected = set(self.unrouted)
+        sampled = []
+        for index, route in enumerate(self.routes):
+            if not route.match(path, peer):
+                continue
+            if route.sample is None:
+                selected.update(route.exporters)
+            else:
+                sampled.append((index, route.sample, route.exporters))
+        # keep the order of the configuration
+        return [name for name in self.exporters if name in selected], sampled
+
+    def exporters_for(self, path, peer=None):
+        """
+        Names of the exporters a metric goes to.
+        """
+        selected, sampled = self.selections.get_or_compute((path, peer), self.select)
+        if not sampled:
+            return selected
+        extra = set()
+        for index, rate, exporters in sampled:
+            counter_key = (index, path)
+            counter = self._counters.get(counter_key)
+            if counter is None:
+                counter = self._counters.setdefault(counter_key, itertools.count())
+            if next(counter) % rate == 0:
+                extra.update(exporters)
+        extra.difference_update(selected)
+        if not extra:
+            return selected
+        return [name for name in self.exporters if name in extra or name in selected]
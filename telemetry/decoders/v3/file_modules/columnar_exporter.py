@@ -0,0 +1,357 @@
+#
+#   pmacct (Promiscuous mode IP Accounting package)
+#   pmacct is Copyright (C) 2003-2019 by Paolo Lucente
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+#   pmgrpcd and its components are Copyright (C) 2018-2019 by:
+#
+#   Matthias Arnold <matthias.arnold@swisscom.com>
+#   Juan Camilo Cardona <jccardona82@gmail.com>
+#   Thomas Graf <thomas.graf@swisscom.com>
+#   Paolo Lucente <paolo@pmacct.net>
+#
+"""
+Columnar file exporter.
+
+Metrics are flattened (nested fields are joined with ".", lists are kept as json
+strings) and buffered per encoding path. The gRPC threads only buffer rows: full
+buffers are handed to a writer thread, which encodes them as record batches to an
+Arrow IPC stream or a Parquet file per encoding path. The writer thread also
+writes the buffers older than flush_seconds, so paths that stop sending are not
+kept in memory. Files are rolled after some time or size, a new file is started
+with the next batch.
+
+The schema of a path is taken from the schema file if given, otherwise it is
+inferred from the batches of the path: new fields and promotable types (null to
+any type, int to double, ...) are unified into the schema, and a new file is
+started with the unified schema. Fields not in a schema file are dropped. Rows
+that do not fit the schema of their path (e.g. a string in an int column) are not
+lost, they are written to a separate file with their own schema (-rejected).
+"""
+from export_pmgrpcd import Exporter
+from lib_pmgrpcd import PMGRPCDLOG
+import atexit
+import os
+import queue
+import threading
+import time
+import ujson as json
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FORMATS = {"arrow": ".arrow", "parquet": ".parquet"}
+PATH_KEYS = ("encodingPath", "encoding_path", "path")
+
+
+def flatten_row(data, prefix="", row=None):
+    if row is None:
+        row = {}
+    for key, value in data.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            flatten_row(value, name + ".", row)
+        elif isinstance(value, list):
+            row[name] = json.dumps(value)
+        else:
+            row[name] = value
+    return row
+
+
+def get_encoding_path(jsondata):
+    data = jsondata.get("collector", {}).get("data", {})
+    for key in PATH_KEYS:
+        if key in data:
+            return data[key]
+    return None
+
+
+def load_schemas_file(file_json):
+    """
+    The json file is an object. Keys are encoding paths, values are objects from
+    field name to arrow type name (e.g. int64, uint64, double, string, bool).
+    """
+    with open(file_json, "r") as file_h:
+        fields_per_path = json.load(file_h)
+    schemas = {}
+    for path, fields in fields_per_path.items():
+        schemas[path] = pyarrow.schema(
+            [(name, pyarrow.type_for_alias(type_name)) for name, type_name in fields.items()]
+        )
+    return schemas
+
+
+def rows_to_batch(rows):
+    """
+    Batch with the schema inferred from the rows. If the rows of a field have
+    different types, the values of the batch are kept as strings.
+    """
+    try:
+        return pyarrow.RecordBatch.from_pylist(rows)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+        rows = [
+            {name: value if value is None else str(value) for name, value in row.items()}
+            for row in rows
+        ]
+        return pyarrow.RecordBatch.from_pylist(rows)
+
+
+class PathWriter:
+    """
+    Writes the batches of one encoding path, rolling files by time and size.
+    Only used by the writer thread.
+    """
+
+    def __init__(self, directory, file_format, schema, compression):
+        self.directory = directory
+        self.file_format = file_format
+        self.schema = schema
+        # schemas from the schema file are not changed
+        self.fixed_schema = schema is not None
+        self.compression = compression
+        self.writer = None
+        self.sink = None
+        self.filename = None
+        self.opened_at = None
+        self.dropped_fields = set()
+
+    def open_file(self, schema, suffix=""):
+        """
+        Returns (writer, sink, filename) of a new file.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        now = time.time()
+        name = time.strftime("%Y%m%d-%H%M%S", time.gmtime(now)) + "-%06d" % (now % 1 * 1e6)
+        filename = os.path.join(self.directory, name + suffix + FORMATS[self.file_format])
+        if self.file_format == "parquet":
+            return pyarrow.parquet.ParquetWriter(filename, schema, compression=self.compression), None, filename
+        options = pyarrow.ipc.IpcWriteOptions(compression=self.compression)
+        sink = pyarrow.OSFile(filename, "wb")
+        return pyarrow.ipc.new_stream(sink, schema, options=options), sink, filename
+
+    def open(self):
+        self.writer, self.sink, self.filename = self.open_file(self.schema)
+        self.opened_at = time.time()
+
+    def close(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+        if self.sink is not None:
+            self.sink.close()
+        self.writer = None
+        self.sink = None
+
+    def must_roll(self, roll_seconds, roll_bytes):
+        if self.writer is None:
+            return False
+        if roll_seconds and time.time() - self.opened_at >= roll_seconds:
+            return True
+        if roll_bytes and os.path.getsize(self.filename) >= roll_bytes:
+            return True
+        return False
+
+    def unify_schema(self, batch_schema):
+        """
+        Adds the new fields and promotes the types of the batch to the schema
+        of the path. A different schema needs a new file.
+        """
+        if self.schema is None:
+            self.schema = batch_schema
+            return
+        try:
+            schema = pyarrow.unify_schemas([self.schema, batch_schema], promote_options="permissive")
+        except TypeError:
+            # pyarrow < 14 does not promote types, only new fields (and null fields)
+            # are unified, other type changes are rejected rows.
+            schema = pyarrow.unify_schemas([self.schema, batch_schema])
+        if not schema.equals(self.schema):
+            PMGRPCDLOG.info("Schema of %s changed, starting a new file", self.directory)
+            self.close()
+            self.schema = schema
+
+    def write(self, rows):
+        try:
+            if self.fixed_schema:
+                names = set(self.schema.names)
+                for row in rows:
+                    for name in row:
+                        if name not in names and name not in self.dropped_fields:
+                            self.dropped_fields.add(name)
+                            PMGRPCDLOG.info(
+                                "Field %s is not in the schema of %s, dropping it", name, self.directory
+                            )
+            else:
+                self.unify_schema(rows_to_batch(rows).schema)
+            batch = pyarrow.RecordBatch.from_pylist(rows, schema=self.schema)
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, pyarrow.ArrowNotImplementedError) as e:
+            PMGRPCDLOG.error(
+                "%s rows do not fit the schema of %s (%s), writing them to a separate file",
+                len(rows),
+                self.directory,
+                e,
+            )
+            self.write_rejected(rows)
+            return
+        if self.writer is None:
+            self.open()
+        self.writer.write_batch(batch)
+        if self.sink is not None:
+            self.sink.flush()
+
+    def write_rejected(self, rows):
+        batch = rows_to_batch(rows)
+        writer, sink, _ = self.open_file(batch.schema, "-rejected")
+        writer.write_batch(batch)
+        writer.close()
+        if sink is not None:
+            sink.close()
+
+
+class ColumnarExporter(Exporter):
+    def __init__(
+        self,
+        directory,
+        file_format="parquet",
+        batch_size=1000,
+        flush_seconds=60,
+        roll_seconds=3600,
+        roll_bytes=256 * 1024 * 1024,
+        schemas_file=None,
+        compression="zstd",
+        queue_size=100,
+    ):
+        if pyarrow is None:
+            raise Exception("The columnar exporter needs pyarrow, it is not installed")
+        if file_format not in FORMATS:
+            raise Exception(f"Columnar format must be one of {list(FORMATS)}, got {file_format}")
+        if batch_size < 1:
+            raise Exception(f"Columnar batch size must be at least 1, got {batch_size}")
+        schemas = {}
+        if schemas_file is not None:
+            schemas = load_schemas_file(schemas_file)
+        self.directory = directory
+        self.file_format = file_format
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.roll_seconds = roll_seconds
+        self.roll_bytes = roll_bytes
+        self.schemas = schemas
+        self.compression = compression
+        # path -> (time of the first buffered metric, rows)
+        self.buffers = {}
+        # process_metric is called from the gRPC threads, the lock only covers the buffers.
+        self.lock = threading.Lock()
+        # (path, rows) to write, bounded, so the gRPC threads wait when the writer is behind.
+        self.batches = queue.Queue(queue_size)
+        # only used by the writer thread
+        self.writers = {}
+        self.writer_thread = threading.Thread(target=self.write_batches, name="columnar-writer", daemon=True)
+        self.writer_thread.start()
+        atexit.register(self.close)
+
+    def get_writer(self, path):
+        writer = self.writers.get(path)
+        if writer is None:
+            directory = os.path.join(self.directory, path.replace(":", ".").replace("/", "."))
+            writer = PathWriter(
+                directory, self.file_format, self.schemas.get(path), self.compression
+            )
+            self.writers[path] = writer
+        return writer
+
+    def process_metric(self, datajsonstring):
+        self.process_dict(json.loads(datajsonstring))
+
+    def export(self, data):
+        self.process_dict(data.dict())
+
+    def process_dict(self, jsondata):
+        path = get_encoding_path(jsondata)
+        if path is None:
+            path = "unknown"
+        row = flatten_row(jsondata)
+        with self.lock:
+            if path not in self.buffers:
+                self.buffers[path] = (time.time(), [])
+            rows = self.buffers[path][1]
+            rows.append(row)
+            if len(rows) < self.batch_size:
+                return
+            del self.buffers[path]
+        self.batches.put((path, rows))
+
+    def expired_buffers(self, older_than):
+        """
+        Removes and returns the buffers started before older_than, all of them if None.
+        """
+        with self.lock:
+            paths = [
+                path
+                for path, (started, _) in self.buffers.items()
+                if older_than is None or started < older_than
+            ]
+            return [(path, self.buffers.pop(path)[1]) for path in paths]
+
+    def write_batches(self):
+        """
+        Writer thread. Writes the full buffers as they come, and the buffers
+        older than flush_seconds (paths with few metrics) on a timer.
+        """
+        timeout = min(max(self.flush_seconds, 0.1), 1)
+        while True:
+            try:
+                item = self.batches.get(timeout=timeout)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            pending = [item] if item else []
+            pending.extend(self.expired_buffers(time.time() - self.flush_seconds))
+            for path, rows in pending:
+                self.write_path(path, rows)
+            for writer in self.writers.values():
+                if writer.must_roll(self.roll_seconds, self.roll_bytes):
+                    writer.close()
+
+    def write_path(self, path, rows):
+        writer = self.get_writer(path)
+        if writer.must_roll(self.roll_seconds, self.roll_bytes):
+            writer.close()
+        try:
+            writer.write(rows)
+        except Exception as e:
+            PMGRPCDLOG.error("Error writing %s rows of %s: %s", len(rows), path, e)
+
+    def flush(self):
+        """
+        Hands all the buffers to the writer thread.
+        """
+        for item in self.expired_buffers(None):
+            self.batches.put(item)
+
+    def close(self):
+        if not self.writer_thread.is_alive():
+            return
+        self.flush()
+        self.batches.put(None)
+        self.writer_thread.join()
+        for writer in self.writers.values():
+            writer.close()
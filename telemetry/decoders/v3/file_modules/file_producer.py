@@ -32,9 +32,13 @@ class FileExporter(Exporter):
         self.output_file = output_file
 
     def process_metric(self, datajsonstring):
-        jsondata = json.loads(datajsonstring)
+        self.process_dict(json.loads(datajsonstring))
+
+    def export(self, data):
+        self.process_dict(data.dict())
+
+    def process_dict(self, jsondata):
         again_json = json.dumps(jsondata).replace("\n", "")
-        # we'll probably remove the loading here
         with open(self.output_file, 'a') as fh:
             fh.write(again_json)
             fh.write("\n")
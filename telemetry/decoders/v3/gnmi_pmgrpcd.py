@@ -1,27 +1,303 @@
 """
-Implements a simple gNMI client. Still no fancy features here, like:
+Implements a gNMI dial-in client. The collector connects to the targets and
+subscribes (STREAM mode) to a set of paths, in SAMPLE, ON_CHANGE or
+TARGET_DEFINED mode. Still no fancy features here, like:
     - Evaluting duplicates to detect slow consumption
-    - Capabilites. 
-    - Related to Capabilities: etecting if the paths are supported by target (since it seems that some targets simply do not send anything and do not complain about an unsupported path)
+    - Detecting if the paths are supported by target (since it seems that some targets simply do not send anything and do not complain about an unsupported path)
+
+All the targets are handled by a single asyncio loop, one task per target.
+When a stream fails or is closed by the target, the client reconnects after
+an exponential backoff (with jitter, so targets do not reconnect in lockstep).
+Notifications are decoded into internal metrics (see encoders/gnmi.py), which
+go through the transformations and exporters. That part is blocking, so it
+runs in a thread pool.
+
 The specifications for gnmi can be found in https://github.com/openconfig/gnmi
 Although the gnmi standard is quite detailed, it was very nice to see python examples of the interface from https://github.com/nokia/pygnmi
 """
+import asyncio
+from concurrent import futures
+import random
+import grpc
+import ujson as json
 import gnmi_pb2
 import gnmi_pb2_grpc
 import lib_pmgrpcd
+from lib_pmgrpcd import PMGRPCDLOG
+from gnmi_utils import simple_gnmi_string_parser
+from export_pmgrpcd import export_internal_metrics
+from encoders.gnmi import GNMIDecoder
+
+SUBSCRIPTION_MODES = {
+    "target_defined": gnmi_pb2.TARGET_DEFINED,
+    "on_change": gnmi_pb2.ON_CHANGE,
+    "sample": gnmi_pb2.SAMPLE,
+}
+
+ENCODINGS = {
+    "json": gnmi_pb2.JSON,
+    "bytes": gnmi_pb2.BYTES,
+    "proto": gnmi_pb2.PROTO,
+    "ascii": gnmi_pb2.ASCII,
+    "json_ietf": gnmi_pb2.JSON_IETF,
+}
+
+NS_PER_SECOND = 1000000000
+
+
+class GNMIConfigError(Exception):
+    pass
 
 
+def parse_path(path):
+    """
+    Parses a gNMI path string, optionally starting with the origin (e.g.
+    openconfig:/interfaces/interface).
+    """
+    origin = None
+    first_step = path.split("/", 1)[0]
+    if first_step.endswith(":") and "[" not in first_step:
+        origin = first_step[:-1]
+        path = path[len(first_step):]
+    gnmi_path = simple_gnmi_string_parser(path)
+    if origin:
+        gnmi_path.origin = origin
+    return gnmi_path
+
+
+def build_subscribe_request(subscriptions, encoding="json_ietf", prefix=None):
+    """
+    Builds a STREAM SubscribeRequest. Every subscription is a path string or a
+    dict with path, mode (sample, on_change or target_defined), and optionally
+    sample_interval and heartbeat_interval (seconds) and suppress_redundant.
+    """
+    if encoding not in ENCODINGS:
+        raise GNMIConfigError(f"Unknown gNMI encoding {encoding}")
+    subscription_list = gnmi_pb2.SubscriptionList(
+        mode=gnmi_pb2.SubscriptionList.STREAM, encoding=ENCODINGS[encoding]
+    )
+    if prefix:
+        subscription_list.prefix.CopyFrom(parse_path(prefix))
+    for subscription_config in subscriptions:
+        if isinstance(subscription_config, str):
+            subscription_config = {"path": subscription_config}
+        mode = subscription_config.get("mode", "sample")
+        if mode not in SUBSCRIPTION_MODES:
+            raise GNMIConfigError(f"Unknown gNMI subscription mode {mode}")
+        subscription = subscription_list.subscription.add()
+        subscription.path.CopyFrom(parse_path(subscription_config["path"]))
+        subscription.mode = SUBSCRIPTION_MODES[mode]
+        if "sample_interval" in subscription_config:
+            subscription.sample_interval = int(subscription_config["sample_interval"] * NS_PER_SECOND)
+        if "heartbeat_interval" in subscription_config:
+            subscription.heartbeat_interval = int(
+                subscription_config["heartbeat_interval"] * NS_PER_SECOND
+            )
+        subscription.suppress_redundant = bool(subscription_config.get("suppress_redundant", False))
+    return gnmi_pb2.SubscribeRequest(subscribe=subscription_list)
+
 
 class GNMIClient:
+    """
+    Subscription to a single target. run() keeps the subscription alive until stop().
+    """
+
+    def __init__(
+        self,
+        address,
+        request,
+        handler,
+        name=None,
+        username=None,
+        password=None,
+        tls=False,
+        ca_file=None,
+        backoff_initial=1,
+        backoff_max=60,
+    ):
+        self.address = address
+        self.name = name or address
+        self.request = request
+        self.handler = handler
+        self.metadata = []
+        if username is not None:
+            self.metadata = [("username", username), ("password", password or "")]
+        self.tls = tls
+        self.ca_file = ca_file
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.connected = False
+        self.reconnections = 0
+        self._stopped = None
+        self._call = None
+
+    def create_channel(self):
+        if not self.tls:
+            return grpc.aio.insecure_channel(self.address)
+        root_certificates = None
+        if self.ca_file is not None:
+            with open(self.ca_file, "rb") as fh:
+                root_certificates = fh.read()
+        credentials = grpc.ssl_channel_credentials(root_certificates=root_certificates)
+        return grpc.aio.secure_channel(self.address, credentials)
+
+    async def requests(self):
+        yield self.request
+        # Some targets end the subscription when the client closes its side.
+        await self._stopped.wait()
+
+    async def subscribe(self):
+        async with self.create_channel() as channel:
+            stub = gnmi_pb2_grpc.gNMIStub(channel)
+            call = stub.Subscribe(self.requests(), metadata=self.metadata)
+            self._call = call
+            async for response in call:
+                if not self.connected:
+                    PMGRPCDLOG.info("gNMI %s: subscribed", self.name)
+                    self.connected = True
+                kind = response.WhichOneof("response")
+                if kind == "update":
+                    await self.handler(self, response.update)
+                elif kind == "sync_response":
+                    PMGRPCDLOG.debug("gNMI %s: initial sync done", self.name)
+                elif kind == "error":
+                    PMGRPCDLOG.error("gNMI %s: error %s", self.name, response.error.message)
+
+    async def run(self):
+        self._stopped = asyncio.Event()
+        backoff = self.backoff_initial
+        while not self._stopped.is_set():
+            try:
+                await self.subscribe()
+                PMGRPCDLOG.info("gNMI %s: stream closed by the target", self.name)
+            except (asyncio.CancelledError, grpc.aio.AioRpcError) as e:
+                # stop() cancels the call
+                if self._stopped.is_set():
+                    break
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                PMGRPCDLOG.error("gNMI %s: %s %s", self.name, e.code(), e.details())
+            except Exception as e:
+                PMGRPCDLOG.error("gNMI %s: subscription failed, error is %s", self.name, e)
+            if self._stopped.is_set():
+                break
+            if self.connected:
+                # the last stream worked, start over
+                backoff = self.backoff_initial
+                self.connected = False
+            delay = random.uniform(backoff / 2, backoff)
+            PMGRPCDLOG.info("gNMI %s: reconnecting in %.1f seconds", self.name, delay)
+            try:
+                await asyncio.wait_for(self._stopped.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            backoff = min(backoff * 2, self.backoff_max)
+            self.reconnections += 1
+
+    def stop(self):
+        if self._stopped is not None:
+            self._stopped.set()
+        if self._call is not None:
+            self._call.cancel()
+
+
+class GNMICollector:
+    """
+    Runs the clients of all targets in one asyncio loop.
+    """
+
+    def __init__(self, targets, workers=20, decoder=None):
+        self.executor = futures.ThreadPoolExecutor(max_workers=workers)
+        self.decoder = GNMIDecoder() if decoder is None else decoder
+        self.clients = [GNMIClient(handler=self.process, **target) for target in targets]
+
+    def export(self, notification, node):
+        export_internal_metrics(self.decoder.decode(notification, node))
+
+    async def process(self, client, notification):
+        loop = asyncio.get_running_loop()
+        # Waiting here keeps a slow pipeline from queueing unlimited notifications.
+        try:
+            await loop.run_in_executor(self.executor, self.export, notification, client.name)
+        except Exception as e:
+            PMGRPCDLOG.error("Error exporting gNMI notification from %s: %s", client.name, e)
+
+    async def run(self):
+        await asyncio.gather(*[client.run() for client in self.clients])
+
+    def stop(self):
+        for client in self.clients:
+            client.stop()
+
+    def run_forever(self):
+        asyncio.run(self.run())
+
+
+def load_targets_file(filename):
+    """
+    Loads the targets of a json file:
+        {"defaults": {target options}, "targets": [{"address": "host:port", ...}]}
+    Target options: name, subscriptions, encoding, prefix, username, password,
+    tls, ca_file, backoff_initial and backoff_max. Values of the target override
+    the defaults.
+    """
+    with open(filename) as fh:
+        config = json.loads(fh.read())
+    targets = config.get("targets")
+    if not isinstance(targets, list) or not targets:
+        raise GNMIConfigError(f"gNMI targets file {filename} must have a list of targets")
+    defaults = config.get("defaults", {})
+    return [dict(defaults, **target) for target in targets]
+
 
-    def __init__(self, channel):
-        self.channel = channel
-        self.stub = gnmi_pb2_grpc.gNMIStub(self.channel)
-        # ask for the capabilites
-        cap_req = gnmi_pb2.CapabilityRequest()
-        cap_res = self.stub.Capabilities(cap_req)
-        breakpoint()
+def configure_targets(targets):
+    """
+    Converts target options into GNMIClient arguments.
+    """
+    clients = []
+    for target in targets:
+        target = dict(target)
+        if "address" not in target:
+            raise GNMIConfigError(f"gNMI target without address: {target}")
+        subscriptions = target.pop("subscriptions", None)
+        if not subscriptions:
+            raise GNMIConfigError(f"gNMI target {target['address']} without subscriptions")
+        target["request"] = build_subscribe_request(
+            subscriptions, target.pop("encoding", "json_ietf"), target.pop("prefix", None)
+        )
+        clients.append(target)
+    return clients
 
 
+def targets_from_options(options):
+    if options.gnmi_targets_file:
+        targets = load_targets_file(options.gnmi_targets_file)
+    else:
+        if options.gnmi_target is None:
+            raise GNMIConfigError("gnmi target not configured, but gnmi enabled")
+        subscriptions = []
+        for path in options.gnmi_paths.split(","):
+            path = path.strip()
+            if not path:
+                continue
+            subscription = {"path": path, "mode": options.gnmi_mode}
+            if options.gnmi_mode == "sample":
+                subscription["sample_interval"] = options.gnmi_sample_interval
+            subscriptions.append(subscription)
+        targets = [
+            {
+                "address": options.gnmi_target,
+                "subscriptions": subscriptions,
+                "encoding": options.gnmi_encoding,
+            }
+        ]
+    for target in targets:
+        target.setdefault("backoff_max", options.gnmi_backoff_max)
+    return configure_targets(targets)
 
 
+def serve_gnmi():
+    targets = targets_from_options(lib_pmgrpcd.OPTIONS)
+    PMGRPCDLOG.info("Starting gNMI subscriptions to %s targets", len(targets))
+    collector = GNMICollector(targets, workers=lib_pmgrpcd.OPTIONS.workers)
+    collector.run_forever()
@@ -2,7 +2,7 @@
 Utils for the gnmi package
 '''
 #from pyang import xpath_parser
-from protos import gnmi_pb2
+import gnmi_pb2
 
 AXIS_SUPPORTED = set(['child', 'descendant-or-self'])
 SUPPORTED_PREDICATES = set(["relative", "path_expr"])
@@ -30,8 +30,13 @@ import lib_pmgrpcd
 from google.protobuf.json_format import MessageToDict
 import time
 from datetime import datetime
-from export_pmgrpcd import FinalizeTelemetryData
+from export_pmgrpcd import FinalizeTelemetryRows
+from envelope import PeerEnvelope
 import base64
+import tracing
+import prefilter
+import peerfilter
+import grpc
 
 # TODO: Maybe move this to its own part, who knows
 import huawei_ifm_pb2
@@ -53,7 +58,10 @@ class gRPCDataserviceServicer(huawei_grpc_dialout_pb2_grpc.gRPCDataserviceServic
             grpcPeer["telemetry_proto"],
             grpcPeer["telemetry_node"],
             grpcPeer["telemetry_node_port"],
-        ) = grpcPeerStr.split(":")
+        ) = peerfilter.parse_peer(grpcPeerStr)
+        if not peerfilter.accept_peer(grpcPeer["telemetry_node"]):
+            PMGRPCDLOG.debug("Huawei: rejected peer %s" % grpcPeerStr)
+            context.abort(grpc.StatusCode.PERMISSION_DENIED, "Peer not allowed")
         grpcPeer["ne_vendor"] = "Huawei"
         PMGRPCDLOG.debug("Huawei MdtDialout Message: %s" % grpcPeer["telemetry_node"])
 
@@ -65,25 +73,25 @@ class gRPCDataserviceServicer(huawei_grpc_dialout_pb2_grpc.gRPCDataserviceServic
         jsonTelemetryNode = json.dumps(grpcPeer, indent=2, sort_keys=True)
         PMGRPCDLOG.debug("Huawei RAW Message: %s" % jsonTelemetryNode)
 
+        peer_envelope = PeerEnvelope(grpcPeer["telemetry_node"], grpcPeer["ne_vendor"])
         for new_msg in message:
             PMGRPCDLOG.debug("Huawei new_msg iteration message")
-            if lib_pmgrpcd.OPTIONS.ip:
-                if grpcPeer["telemetry_node"] != lib_pmgrpcd.OPTIONS.ip:
-                    continue
-                PMGRPCDLOG.debug(
-                    "Huawei: ip filter matched with ip %s"
-                    % (lib_pmgrpcd.OPTIONS.ip)
-                )
+            # drop unwanted paths before decoding
+            if not prefilter.accept_message("huawei", new_msg.data):
+                continue
+            tracing.start_trace(grpcPeer["telemetry_node"])
             try:
-                huawei_processing(grpcPeer, new_msg)
+                huawei_processing(grpcPeer, new_msg, peer_envelope)
             except Exception as e:
                 PMGRPCDLOG.debug("Error processing Huawei packet, error is %s", e)
                 continue
+            finally:
+                tracing.finish_trace()
         return
         yield
 
 
-def huawei_processing(grpcPeer, new_msg):
+def huawei_processing(grpcPeer, new_msg, peer_envelope=None):
     PMGRPCDLOG.debug("Huawei: Received GRPC-Data")
 
     # dump the raw data
@@ -116,6 +124,7 @@ def huawei_processing(grpcPeer, new_msg):
         )
         raise
 
+    tracing.mark("decode")
     PMGRPCDLOG.debug("Huawei: Received GPB-Data as JSON")
     # TODO: Do we really need this? it can be expensive 
     PMGRPCDLOG.debug(json.dumps(telemetry_msg_dict, indent=2, sort_keys=True))
@@ -126,6 +135,10 @@ def huawei_processing(grpcPeer, new_msg):
         del message_header_dict["data_gpb"]
 
     (proto, path) = message_header_dict["sensor_path"].split(":")
+    tracing.annotate(
+        msg_timestamp=message_header_dict.get("msg_timestamp"),
+        encoding_path=message_header_dict["sensor_path"],
+    )
     (node_id_str) = message_header_dict["node_id_str"]
     (node_ip) = grpcPeer["telemetry_node"]
     (ne_vendor) = grpcPeer["ne_vendor"]
@@ -140,50 +153,44 @@ def huawei_processing(grpcPeer, new_msg):
             % (epochmillis, node_ip, node_id_str, ne_vendor, proto, "GPB", elem)
         )
 
+        # The rows share the envelope (collector grpc and data), which is built once.
+        if peer_envelope is None:
+            peer_envelope = PeerEnvelope(grpcPeer["telemetry_node"], grpcPeer["ne_vendor"])
+        message_header_dict["collection_timestamp"] = epochmillis
+        envelope = peer_envelope.message(message_header_dict)
+
         # L2:
-        for new_row in telemetry_msg.data_gpb.row:
-            # PMGRPCDLOG.info("NEW_ROW: %s" % (new_row))
-            new_row_header_dict = MessageToDict(
-                new_row,
-                including_default_value_fields=True,
-                preserving_proto_field_name=True,
-                use_integers_for_enums=True,
-            )
-
-            if "content" in new_row_header_dict:
-                del new_row_header_dict["content"]
-
-            # L3:
-            msg.ParseFromString(new_row.content)
-            content = MessageToDict(
-                msg,
-                including_default_value_fields=True,
-                preserving_proto_field_name=True,
-                use_integers_for_enums=True,
-            )
-
-            message_dict = {}
-            message_dict.update(
-                {
-                    "collector": {
-                        "grpc": {
-                            "grpcPeer": grpcPeer["telemetry_node"],
-                            "ne_vendor": grpcPeer["ne_vendor"],
-                        }
-                    }
-                }
-            )
-            message_dict["collector"].update({"data": message_header_dict.copy()})
-            message_dict["collector"]["data"].update(new_row_header_dict)
-            message_dict.update(content)
-
-            allkeys = parse_dict(content, ret="", level=0)
-            PMGRPCDLOG.debug("Huawei: %s: %s" % (proto, allkeys))
+        def rows():
+            for new_row in telemetry_msg.data_gpb.row:
+                # PMGRPCDLOG.info("NEW_ROW: %s" % (new_row))
+                new_row_header_dict = MessageToDict(
+                    new_row,
+                    including_default_value_fields=True,
+                    preserving_proto_field_name=True,
+                    use_integers_for_enums=True,
+                )
 
-            try:
-                returned = FinalizeTelemetryData(message_dict)
-            except Exception as e:
-                PMGRPCDLOG.error("Error finalazing  message: %s", e)
+                if "content" in new_row_header_dict:
+                    del new_row_header_dict["content"]
+
+                # L3:
+                msg.ParseFromString(new_row.content)
+                content = MessageToDict(
+                    msg,
+                    including_default_value_fields=True,
+                    preserving_proto_field_name=True,
+                    use_integers_for_enums=True,
+                )
+                tracing.mark("decode_row")
+
+                allkeys = parse_dict(content, ret="", level=0)
+                PMGRPCDLOG.debug("Huawei: %s: %s" % (proto, allkeys))
+
+                # the row header is added to data of this row only.
+                yield content, new_row_header_dict
+
+        # the content is new for every row.
+        FinalizeTelemetryRows(envelope, rows(), owned=True)
 
 # TODO, probably better to have this in the object
 
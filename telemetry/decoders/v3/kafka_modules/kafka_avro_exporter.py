@@ -39,7 +39,12 @@ jsonmap = {}
 
 class KafkaAvroExporter(Exporter):
     def process_metric(self, datajsonstring):
-        jsondata = json.loads(datajsonstring)
+        self.process_dict(json.loads(datajsonstring))
+
+    def export(self, data):
+        self.process_dict(data.dict())
+
+    def process_dict(self, jsondata):
         lib_pmgrpcd.SERIALIZELOG.debug("In process_metric")
 
         if "grpcPeer" in jsondata["collector"]["grpc"]:
@@ -23,33 +23,14 @@
 #   Thomas Graf <thomas.graf@swisscom.com>
 #   Paolo Lucente <paolo@pmacct.net>
 #
-from export_pmgrpcd import Exporter
+from export_pmgrpcd import Exporter, ExportData
 import ujson as json
 import os
 from confluent_kafka import Producer
 import pickle
 import itertools
+from kafka_modules.topic_router import TopicRouter, load_topics_file, create_topic
 
-def load_topics_file(file_json):
-    '''
-    The json file is an object. Keys are encoding paths.
-    If the encoding path is absolute, just write the topic.
-    TODO: maybe do something fancy later
-    '''
-    with open(file_json, 'r') as file_h:
-        data_per_path = json.load(file_h)
-    for key, value in data_per_path.items():
-        if not isinstance(value, str):
-            raise Exception(f"We only support files with simple key values as string, {value} is of a different type")
-    return data_per_path
-
-
-def create_topic(path):
-    replacesments = set([':', '/'])
-    rpath = path
-    for ch in replacesments:
-        rpath = rpath.replace(ch, ".")
-    return rpath
 
 class KafkaExporter(Exporter):
     def __init__(self, servers, topic, topic_per_encoding_path=None):
@@ -62,19 +43,22 @@ class KafkaExporter(Exporter):
         self.producer = Producer({"bootstrap.servers": servers})
         self.topic = topic
         self.topic_per_encoding_path = topic_per_encoding_path
+        self.router = TopicRouter(topic, topic_per_encoding_path)
 
     def get_topic(self, jsondata):
-        # change this for the topic per encoding path.
-        if "encoding_path" in jsondata["collector"]["data"]:
-            encoding_path = jsondata["collector"]["data"]["encoding_path"]
-            if encoding_path in self.topic_per_encoding_path:
-                return self.topic_per_encoding_path[encoding_path]
-        return self.topic
+        return self.topic_of(ExportData(dictdata=jsondata))
+
+    def topic_of(self, data):
+        # the path of ExportData.route (encoding_path, sensor_path or encodingPath)
+        data.route()
+        return self.router.topic(data.path)
+
+    def export(self, data):
+        # the topic comes from the path, the json is not parsed
+        self.send(data.json(), self.topic_of(data))
 
     def process_metric(self, datajsonstring):
-        jsondata = json.loads(datajsonstring)
-        topic = self.get_topic(jsondata)
-        self.send(datajsonstring, topic)
+        self.export(ExportData(jsondata=datajsonstring))
 
     def send(self, text, topic=None):
         if topic is None:
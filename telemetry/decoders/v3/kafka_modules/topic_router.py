@@ -0,0 +1,167 @@
+#
+#   pmacct (Promiscuous mode IP Accounting package)
+#   pmacct is Copyright (C) 2003-2019 by Paolo Lucente
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+#   pmgrpcd and its components are Copyright (C) 2018-2019 by:
+#
+#   Matthias Arnold <matthias.arnold@swisscom.com>
+#   Juan Camilo Cardona <jccardona82@gmail.com>
+#   Thomas Graf <thomas.graf@swisscom.com>
+#   Paolo Lucente <paolo@pmacct.net>
+#
+"""
+Routing of metrics to kafka topics by encoding path.
+
+The topics file is a json object from encoding path to topic. Besides the
+exact paths, a key can be:
+    - a prefix, ending with a single * (e.g. "Cisco-IOS-XR-infra-statsd-oper:*").
+      The longest matching prefix wins.
+    - a pattern, with other fnmatch wildcards (e.g. "*:interfaces/interface*/state").
+      Patterns are checked in file order.
+A topic can be derived from the path: {path} is replaced by the path with ':'
+and '/' replaced by '.' (see create_topic) and {module} by the part of the
+path before ':'. The "*" key is the topic of the paths no other rule matches,
+e.g. {"*": "telemetry.{path}"} gives a topic to every path.
+
+Exact paths win over prefixes, and prefixes over patterns. The rules are
+compiled once, and the topic of each path is cached, so the routing does not
+add a per-message cost.
+"""
+from fnmatch import translate
+import re
+import ujson as json
+from pygtrie import CharTrie
+from caching import LRUCache, DEFAULT_CACHE_SIZE
+
+WILDCARDS = set("*?[")
+
+
+def load_topics_file(file_json):
+    """
+    The json file is an object. Keys are encoding paths, prefixes or patterns,
+    values are topics (see TopicRouter).
+    """
+    with open(file_json, "r") as file_h:
+        data_per_path = json.load(file_h)
+    for key, value in data_per_path.items():
+        if not isinstance(value, str):
+            raise Exception(f"We only support files with simple key values as string, {value} is of a different type")
+    return data_per_path
+
+
+def create_topic(path):
+    replacesments = set([":", "/"])
+    rpath = path
+    for ch in replacesments:
+        rpath = rpath.replace(ch, ".")
+    return rpath
+
+
+def path_module(path):
+    if ":" not in path:
+        return ""
+    return path.split(":", 1)[0]
+
+
+class TopicTemplate:
+    """
+    A topic derived from the path.
+    """
+
+    __slots__ = ("template",)
+
+    def __init__(self, template):
+        self.template = template
+        try:
+            self.format("check")
+        except (KeyError, IndexError, ValueError) as e:
+            raise Exception(f"Invalid topic {template}, error is {e}")
+
+    def format(self, path):
+        return self.template.format(path=create_topic(path), module=path_module(path))
+
+
+def compile_topic(topic):
+    if "{" in topic:
+        return TopicTemplate(topic)
+    return topic
+
+
+def is_prefix_rule(key):
+    return key.endswith("*") and not WILDCARDS.intersection(key[:-1])
+
+
+class TopicRouter:
+    """
+    Compiled topic rules. topic(path) returns the topic of an encoding path,
+    default_topic when no rule matches (or the path is None).
+    """
+
+    def __init__(self, default_topic, topic_per_encoding_path=None, cache_size=DEFAULT_CACHE_SIZE):
+        self.default_topic = default_topic
+        self.exact = {}
+        self.prefixes = CharTrie()
+        patterns = []
+        self.pattern_topics = []
+        self.fallback = None
+        for key, topic in (topic_per_encoding_path or {}).items():
+            topic = compile_topic(topic)
+            if key == "*":
+                self.fallback = topic
+            elif is_prefix_rule(key):
+                self.prefixes[key[:-1]] = topic
+            elif WILDCARDS.intersection(key):
+                # a single regex, the group that matched gives the rule
+                patterns.append(f"(?P<p{len(patterns)}>{translate(key)})")
+                self.pattern_topics.append(topic)
+            else:
+                self.exact[key] = topic
+        self.patterns = re.compile("|".join(patterns)) if patterns else None
+        self.cache = LRUCache(cache_size, "kafka_topics")
+
+    def __len__(self):
+        return len(self.exact) + len(self.prefixes) + len(self.pattern_topics) + (self.fallback is not None)
+
+    def match(self, path):
+        """
+        Rule of a path, or None.
+        """
+        topic = self.exact.get(path)
+        if topic is not None:
+            return topic
+        if self.prefixes:
+            step = self.prefixes.longest_prefix(path)
+            if step:
+                return step.value
+        if self.patterns is not None:
+            match = self.patterns.match(path)
+            if match is not None:
+                return self.pattern_topics[int(match.lastgroup[1:])]
+        return self.fallback
+
+    def route(self, path):
+        topic = self.match(path)
+        if topic is None:
+            return self.default_topic
+        if isinstance(topic, TopicTemplate):
+            return topic.format(path)
+        return topic
+
+    def topic(self, path):
+        if path is None:
+            return self.default_topic
+        return self.cache.get_or_compute(path, self.route)
@@ -23,31 +23,55 @@
 #   Thomas Graf <thomas.graf@swisscom.com>
 #   Paolo Lucente <paolo@pmacct.net>
 #
+# Prints the messages of a kafka topic, to debug the kafka exporters.
+# utils/kafka_consumer.py also measures the throughput.
 from confluent_kafka import Consumer, KafkaError
 import logging
-logging.basicConfig(level=logging.DEBUG) 
+from optparse import OptionParser
 
-mylogger = logging.getLogger()
+parser = OptionParser()
+parser.add_option("-s", "--servers", dest="servers", help="Kafka servers")
+parser.add_option("-t", "--topic", dest="topic", help="Topic to listen, or comma separated topics")
+parser.add_option("-g", "--group", default="mygroup", dest="group", help="Consumer group")
+parser.add_option(
+    "--offset",
+    default="latest",
+    dest="offset",
+    help="auto.offset.reset of the consumer: earliest or latest",
+)
+parser.add_option(
+    "-d", "--debug", action="store_true", default=False, dest="debug", help="Log the kafka client"
+)
+(options, _) = parser.parse_args()
+if not options.servers or not options.topic:
+    parser.error("servers and topic are required")
 
-c = Consumer({
-    'bootstrap.servers': 'gtat-stage-msg01',
-    'group.id': 'mygroup',
-    'auto.offset.reset': 'latest',
-    "logger": mylogger
-})
+config = {
+    'bootstrap.servers': options.servers,
+    'group.id': options.group,
+    'auto.offset.reset': options.offset,
+}
+if options.debug:
+    logging.basicConfig(level=logging.DEBUG)
+    config["logger"] = logging.getLogger()
 
-c.subscribe(['gnmi'])
-#c.subscribe(['Cisco-IOS-XR-qos-ma-oper.qos.nodes.node.policy-map.interface-table.interface.member-interfaces.member-interface.output.service-policy-names.service-policy-instance.statistics'])
+c = Consumer(config)
 
-while True:
-    msg = c.poll(1.0)
+c.subscribe([topic.strip() for topic in options.topic.split(",")])
+#c.subscribe(['Cisco-IOS-XR-qos-ma-oper.qos.nodes.node.policy-map.interface-table.interface.member-interfaces.member-interface.output.service-policy-names.service-policy-instance.statistics'])
 
-    if msg is None:
-        continue
-    if msg.error():
-        print("Consumer error: {}".format(msg.error()))
-        continue
+try:
+    while True:
+        msg = c.poll(1.0)
 
-    print('Received message: {}'.format(msg.value().decode('utf-8')))
+        if msg is None:
+            continue
+        if msg.error():
+            print("Consumer error: {}".format(msg.error()))
+            continue
 
-c.close()
+        print('Received message: {}'.format(msg.value().decode('utf-8')))
+except KeyboardInterrupt:
+    pass
+finally:
+    c.close()
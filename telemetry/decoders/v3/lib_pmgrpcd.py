@@ -25,6 +25,8 @@
 #
 import logging
 from pathlib import Path
+import tracing
+import caching
 
 SCRIPTVERSION = "1.1"
 
@@ -103,6 +105,11 @@ def signalhandler(signum, frame):
     if signum == 10:
         PMGRPCDLOG.info("Signal handler called with USR1 signal: %s" % (signum))
         PMGRPCDLOG.info("These are the missing gpb libs: %s" % (MISSGPBLIB))
+        PMGRPCDLOG.info("These are the cache stats: %s" % (caching.caches_stats()))
     if signum == 12:
         PMGRPCDLOG.info("Signal handler called with USR2 signal: %s" % (signum))
-        PMGRPCDLOG.info("TODO: %s" % ("todo"))
+        if tracing.TRACER is None:
+            PMGRPCDLOG.info("Tracing is not enabled, nothing to dump")
+        else:
+            n_traces = tracing.TRACER.dump(OPTIONS.trace_dump_file)
+            PMGRPCDLOG.info("Dumped %s traces to %s", n_traces, OPTIONS.trace_dump_file)
@@ -0,0 +1,592 @@
+#
+#   pmacct (Promiscuous mode IP Accounting package)
+#   pmacct is Copyright (C) 2003-2019 by Paolo Lucente
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+#   pmgrpcd and its components are Copyright (C) 2018-2019 by:
+#
+#   Matthias Arnold <matthias.arnold@swisscom.com>
+#   Juan Camilo Cardona <jccardona82@gmail.com>
+#   Thomas Graf <thomas.graf@swisscom.com>
+#   Paolo Lucente <paolo@pmacct.net>
+#
+"""
+Declarative mitigation engine.
+
+Replaces the python mitigation module (config_files/mitigation.py) with rules
+loaded from a json file (see config_files/mitigation_rules.json). The engine
+keeps no state per record, so it can be used by all gRPC threads at once.
+
+The rule file is an object with:
+    normalize_keys: replace "-" with "_" in every key of the record (d2u).
+    rules: list of rules, applied in order.
+
+Every rule has:
+    name: only used in errors and logs.
+    when: optional, {"vendor": ..., "encoding_path": {"equals"|"contains"|"prefix": ...}}.
+    select: the dicts the action works on, as a "/" separated path from the root
+        of the record. A component ending in "[]" goes over every element of a list.
+        An empty select is the record itself.
+    where: optional list of conditions on the selected dict, all must hold:
+        {"key": k, "exists": bool}, {"key": k, "equals": v}, {"key": k, "not_equals": v}
+        or {"key": k, "type": "list"|"dict"}. Only equals, not_equals and type
+        require the key to be present.
+    action: one of the ACTIONS, with its own parameters.
+
+The rules that apply to a record only depend on the vendor and the encoding
+(or sensor) path, so they are selected once per path and cached.
+"""
+from datetime import datetime
+import ujson as json
+from caching import LRUCache, register_cache, DEFAULT_CACHE_SIZE
+import sys
+
+INT64_MAX = 2 ** 63 - 1
+UINT64_OFFSET = 2 ** 63
+
+# keys of collector/data that decide which rules apply.
+PATH_KEYS = ("encoding_path", "sensor_path")
+
+TYPES = {"list": list, "dict": dict}
+
+
+def timestuff2epoch(value):
+    """
+    Epoch in seconds from an epoch or a "2019-01-08T12:53:02Z" string. 0 if neither.
+    """
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return int(value)
+    try:
+        utc_dt = datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ")
+    except (TypeError, ValueError):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return 0
+    return int((utc_dt - datetime(1970, 1, 1)).total_seconds())
+
+
+class KeyNormalizer:
+    """
+    Replaces "-" with "_" in every key of a record (d2u).
+
+    The key names come from the YANG models, so there are few of them, and
+    the dicts of a list usually have the same keys. The normalized keys are
+    cached (and interned) per key, and per tuple of keys of a dict, where a
+    tuple without any "-" maps to None. Such dicts are not rebuilt when
+    normalizing in place. The caches are plain dicts, safe to share between
+    threads, and are emptied when they reach maxsize.
+
+    Only the renaming is cached: every dict and list of the record is still
+    visited. Clean subtrees are not skipped, a subtree that was clean can have
+    new keys in the next record (e.g. optional leaves of the model).
+    """
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE, name="mitigation_keys"):
+        self.maxsize = maxsize
+        self.name = name
+        self.keys = {}
+        self.shapes = {}
+        self.misses = 0
+        self.resets = 0
+        register_cache(self)
+
+    def stats(self):
+        return {
+            "size": len(self.keys) + len(self.shapes),
+            "maxsize": self.maxsize * 2,
+            "misses": self.misses,
+            "resets": self.resets,
+        }
+
+    def normalize_key(self, key):
+        new_key = self.keys.get(key)
+        if new_key is None:
+            self.misses += 1
+            if len(self.keys) >= self.maxsize:
+                self.resets += 1
+                self.keys = {}
+            new_key = sys.intern(key.replace("-", "_")) if "-" in key else key
+            self.keys[key] = new_key
+        return new_key
+
+    def normalize_shape(self, shape):
+        """
+        Normalized keys for a tuple of keys, None if they are all clean.
+        """
+        try:
+            return self.shapes[shape]
+        except KeyError:
+            pass
+        if len(self.shapes) >= self.maxsize:
+            self.resets += 1
+            self.shapes = {}
+        new_shape = tuple(self.normalize_key(key) for key in shape)
+        if new_shape == shape:
+            new_shape = None
+        self.shapes[shape] = new_shape
+        return new_shape
+
+    def normalize(self, obj, owned=False):
+        """
+        Returns obj with the keys normalized. If owned, obj is changed in place
+        and returned. If not, obj is not changed and a copy is returned.
+        """
+        obj_class = obj.__class__
+        if obj_class is dict:
+            return self._dict_in_place(obj) if owned else self._copy_dict(obj)
+        if obj_class is list:
+            return self._list_in_place(obj) if owned else self._copy_list(obj)
+        return obj
+
+    # The next ones are the hot path, so they avoid a call per value.
+
+    def _copy_dict(self, obj):
+        shape = tuple(obj)
+        new_shape = self.shapes.get(shape, shape)
+        if new_shape is shape:
+            new_shape = self.normalize_shape(shape)
+        new = dict(zip(new_shape or shape, obj.values()))
+        for key, value in new.items():
+            value_class = value.__class__
+            if value_class is dict:
+                new[key] = self._copy_dict(value)
+            elif value_class is list:
+                new[key] = self._copy_list(value)
+        return new
+
+    def _copy_list(self, obj):
+        new = obj.copy()
+        for n, value in enumerate(new):
+            value_class = value.__class__
+            if value_class is dict:
+                new[n] = self._copy_dict(value)
+            elif value_class is list:
+                new[n] = self._copy_list(value)
+        return new
+
+    def _dict_in_place(self, obj):
+        shape = tuple(obj)
+        new_shape = self.shapes.get(shape, shape)
+        if new_shape is shape:
+            new_shape = self.normalize_shape(shape)
+        if new_shape is not None:
+            # clean dicts are not rebuilt
+            values = list(obj.values())
+            obj.clear()
+            obj.update(zip(new_shape, values))
+        for value in obj.values():
+            value_class = value.__class__
+            if value_class is dict:
+                self._dict_in_place(value)
+            elif value_class is list:
+                self._list_in_place(value)
+        return obj
+
+    def _list_in_place(self, obj):
+        for value in obj:
+            value_class = value.__class__
+            if value_class is dict:
+                self._dict_in_place(value)
+            elif value_class is list:
+                self._list_in_place(value)
+        return obj
+
+
+# Shared by the engines and the mitigation module.
+KEY_NORMALIZER = KeyNormalizer()
+
+
+def normalize_keys(obj, owned=False):
+    return KEY_NORMALIZER.normalize(obj, owned)
+
+
+def copy_record(obj):
+    if isinstance(obj, dict):
+        return {k: copy_record(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [copy_record(v) for v in obj]
+    return obj
+
+
+def parse_select(select):
+    steps = []
+    for part in select.split("/"):
+        if not part:
+            continue
+        if part.endswith("[]"):
+            steps.append((part[:-2], True))
+        else:
+            steps.append((part, False))
+    return steps
+
+
+def select_dicts(record, steps):
+    current = [record]
+    for key, iterate in steps:
+        selected = []
+        for container in current:
+            if not isinstance(container, dict) or key not in container:
+                continue
+            value = container[key]
+            if not iterate:
+                selected.append(value)
+            elif isinstance(value, list):
+                selected.extend(value)
+        current = selected
+    return [x for x in current if isinstance(x, dict)]
+
+
+def compile_condition(rule_name, condition):
+    key = condition.get("key")
+    if key is None:
+        raise Exception(f"Mitigation rule {rule_name}: condition without key {condition}")
+    if "exists" in condition:
+        exists = bool(condition["exists"])
+        return lambda c: (key in c) == exists
+    if "equals" in condition:
+        value = condition["equals"]
+        return lambda c: key in c and c[key] == value
+    if "not_equals" in condition:
+        value = condition["not_equals"]
+        return lambda c: key in c and c[key] != value
+    if "type" in condition:
+        if condition["type"] not in TYPES:
+            raise Exception(
+                f"Mitigation rule {rule_name}: type must be one of {list(TYPES)}, got {condition['type']}"
+            )
+        value_type = TYPES[condition["type"]]
+        return lambda c: key in c and isinstance(c[key], value_type)
+    raise Exception(f"Mitigation rule {rule_name}: unknown condition {condition}")
+
+
+def compile_path_condition(rule_name, condition):
+    if condition is None:
+        return None
+    if "equals" in condition:
+        value = condition["equals"]
+        return lambda path: path == value
+    if "contains" in condition:
+        value = condition["contains"]
+        return lambda path: path is not None and value in path
+    if "prefix" in condition:
+        value = condition["prefix"]
+        return lambda path: path is not None and path.startswith(value)
+    raise Exception(f"Mitigation rule {rule_name}: unknown encoding_path condition {condition}")
+
+
+# Actions. Each one gets the rule description and returns a function that
+# changes a selected dict in place.
+
+
+def action_rename(rule):
+    from_key = rule["from"]
+    to_keys = rule["to"].split("/")
+
+    def rename(container):
+        if from_key not in container:
+            return
+        value = container.pop(from_key)
+        parent = container
+        for key in to_keys[:-1]:
+            child = parent.get(key)
+            if not isinstance(child, dict):
+                child = {}
+                parent[key] = child
+            parent = child
+        parent[to_keys[-1]] = value
+
+    return rename
+
+
+def action_set(rule):
+    key = rule["key"]
+    value = rule["value"]
+
+    def set_value(container):
+        container[key] = value
+
+    return set_value
+
+
+def action_drop(rule):
+    keys = rule["keys"]
+
+    def drop(container):
+        for key in keys:
+            container.pop(key, None)
+
+    return drop
+
+
+def action_keep(rule):
+    keys = set(rule["keys"])
+
+    def keep(container):
+        for key in [x for x in container if x not in keys]:
+            del container[key]
+
+    return keep
+
+
+def action_wrap_list(rule):
+    keys = rule["keys"]
+
+    def wrap_list(container):
+        for key in keys:
+            if isinstance(container.get(key), dict):
+                container[key] = [container[key]]
+
+    return wrap_list
+
+
+def _keys_function(rule):
+    """
+    Keys of a selected dict an action applies to: a list, or "*" for all but "except".
+    """
+    keys = rule["keys"]
+    if keys != "*":
+        return lambda container: [x for x in keys if x in container]
+    excluded = set(rule.get("except", []))
+    return lambda container: [x for x in container if x not in excluded]
+
+
+def action_int(rule):
+    get_keys = _keys_function(rule)
+    default = rule.get("default", -1)
+    # values above int64 are moved down by 2^63, as avro has no uint64
+    wrap_uint64 = rule.get("wrap_uint64", False)
+
+    def to_int(container):
+        for key in get_keys(container):
+            try:
+                value = int(container[key])
+            except (TypeError, ValueError):
+                value = default
+            if wrap_uint64 and value > INT64_MAX:
+                value -= UINT64_OFFSET
+            container[key] = value
+
+    return to_int
+
+
+def action_epoch(rule):
+    get_keys = _keys_function(rule)
+
+    def epoch(container):
+        for key in get_keys(container):
+            container[key] = timestuff2epoch(container[key])
+
+    return epoch
+
+
+def action_enum(rule):
+    # json keys are strings, values in the records are numbers
+    maps = {
+        key: {int(number): name for number, name in mapping.items()}
+        for key, mapping in rule["maps"].items()
+    }
+
+    def enum(container):
+        for key, mapping in maps.items():
+            if key not in container:
+                continue
+            value = container[key]
+            try:
+                container[key] = mapping.get(value, value)
+            except TypeError:
+                # not hashable, nothing to map
+                pass
+
+    return enum
+
+
+def action_harmonize(rule):
+    """
+    Only the listed keys are kept, converted to int or string. Missing keys get
+    the defaults.
+    """
+    int_keys = rule.get("int", [])
+    str_keys = rule.get("str", [])
+    int_default = rule.get("int_default", -1)
+    str_default = rule.get("str_default", "None")
+    types = {}
+    for key in int_keys:
+        types[key] = int
+    for key in str_keys:
+        types[key] = str
+
+    def harmonize(container):
+        new_container = {}
+        for key, value in container.items():
+            if key not in types:
+                continue
+            try:
+                new_container[key] = types[key](value)
+            except (TypeError, ValueError):
+                new_container[key] = int_default if types[key] is int else str_default
+        for key in int_keys:
+            if key not in new_container:
+                new_container[key] = int_default
+        for key in str_keys:
+            if key not in new_container:
+                new_container[key] = str_default
+        container.clear()
+        container.update(new_container)
+
+    return harmonize
+
+
+ACTIONS = {
+    "rename": action_rename,
+    "set": action_set,
+    "drop": action_drop,
+    "keep": action_keep,
+    "wrap_list": action_wrap_list,
+    "int": action_int,
+    "epoch": action_epoch,
+    "enum": action_enum,
+    "harmonize": action_harmonize,
+}
+
+
+class MitigationRule:
+    __slots__ = (
+        "name",
+        "vendor",
+        "path_condition",
+        "select",
+        "steps",
+        "where",
+        "action",
+        "function",
+        "header",
+    )
+
+    def __init__(self, description):
+        self.name = description.get("name", "noname")
+        action = description.get("action")
+        if action not in ACTIONS:
+            raise Exception(
+                f"Mitigation rule {self.name}: action must be one of {list(ACTIONS)}, got {action}"
+            )
+        when = description.get("when", {})
+        self.vendor = when.get("vendor")
+        self.path_condition = compile_path_condition(self.name, when.get("encoding_path"))
+        self.select = description.get("select", "")
+        self.steps = parse_select(self.select)
+        self.where = [compile_condition(self.name, x) for x in description.get("where", [])]
+        self.action = action
+        try:
+            self.function = ACTIONS[action](description)
+        except KeyError as e:
+            raise Exception(f"Mitigation rule {self.name}: missing parameter {e}")
+        self.header = self.select.strip("/") == "collector/data"
+        if self.header:
+            # these rules also run over the path keys when selecting the rules
+            # per path (see MitigationEngine.get_plan), so they can only look at them.
+            if action == "rename" and description["to"] in PATH_KEYS and description["from"] not in PATH_KEYS:
+                raise Exception(
+                    f"Mitigation rule {self.name}: only {PATH_KEYS} can be renamed to {PATH_KEYS}"
+                )
+            for condition in description.get("where", []):
+                if condition.get("key") not in PATH_KEYS:
+                    raise Exception(
+                        f"Mitigation rule {self.name}: conditions on collector/data can only use {PATH_KEYS}"
+                    )
+
+    def matches(self, vendor, path_keys):
+        if self.vendor is not None and self.vendor != vendor:
+            return False
+        if self.path_condition is not None:
+            return self.path_condition(path_keys.get("encoding_path"))
+        return True
+
+    def apply_to(self, container):
+        for condition in self.where:
+            if not condition(container):
+                return
+        self.function(container)
+
+    def apply(self, record):
+        for container in select_dicts(record, self.steps):
+            self.apply_to(container)
+
+
+class MitigationEngine:
+    """
+    Applies the rules to records. The rules applied to a record are chosen by
+    vendor and path keys, and cached.
+    """
+
+    def __init__(self, description, plan_cache_size=1000):
+        self.normalize_keys = description.get("normalize_keys", False)
+        self.rules = [MitigationRule(x) for x in description.get("rules", [])]
+        self.plans = LRUCache(plan_cache_size, "mitigation_plans")
+
+    @classmethod
+    def from_file(cls, filename, *args, **kargs):
+        with open(filename, "r") as fh:
+            description = json.load(fh)
+        return cls(description, *args, **kargs)
+
+    def compile_plan(self, plan_key):
+        """
+        Rules for a vendor and path keys. Rules on collector/data can change the
+        path keys (e.g. sensor_path to encoding_path), so they are replayed here
+        on a copy of the path keys.
+        """
+        vendor = plan_key[0]
+        path_keys = {
+            key: value for key, value in zip(PATH_KEYS, plan_key[1:]) if value is not None
+        }
+        plan = []
+        for rule in self.rules:
+            if not rule.matches(vendor, path_keys):
+                continue
+            plan.append(rule)
+            if rule.header:
+                rule.apply_to(path_keys)
+        return tuple(plan)
+
+    def get_plan(self, vendor, data):
+        plan_key = (vendor,) + tuple(data.get(key) for key in PATH_KEYS)
+        return self.plans.get_or_compute(plan_key, self.compile_plan)
+
+    def apply(self, record, owned=False):
+        """
+        Returns the mitigated record. Records without collector data or vendor
+        are returned as they are. If owned, the record (with all the nested
+        dicts and lists) belongs to the caller and is changed in place,
+        otherwise it is not changed.
+        """
+        collector = record.get("collector")
+        if not isinstance(collector, dict):
+            return record
+        grpc = collector.get("grpc")
+        data = collector.get("data")
+        if not isinstance(grpc, dict) or not isinstance(data, dict) or "ne_vendor" not in grpc:
+            return record
+        plan = self.get_plan(grpc["ne_vendor"], data)
+        if self.normalize_keys:
+            record = normalize_keys(record, owned)
+        elif not owned:
+            record = copy_record(record)
+        for rule in plan:
+            rule.apply(record)
+        return record
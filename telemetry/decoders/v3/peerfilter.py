@@ -0,0 +1,117 @@
+#
+#   pmacct (Promiscuous mode IP Accounting package)
+#   pmacct is Copyright (C) 2003-2019 by Paolo Lucente
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+#   pmgrpcd and its components are Copyright (C) 2018-2019 by:
+#
+#   Matthias Arnold <matthias.arnold@swisscom.com>
+#   Juan Camilo Cardona <jccardona82@gmail.com>
+#   Thomas Graf <thomas.graf@swisscom.com>
+#   Paolo Lucente <paolo@pmacct.net>
+#
+"""
+Filtering of the gRPC peers (routers) by CIDR.
+
+The decision is taken once, when a stream is opened, and a rejected stream is
+aborted before any message is read. The allow and deny networks are compiled
+into a table per IP version and prefix length, and the most specific (longest)
+matching network decides. An address not matching any network is accepted
+only if there are no allow networks.
+"""
+import ipaddress
+from urllib.parse import unquote
+from caching import LRUCache
+
+# None means all peers are accepted. It is set up by config.configure.
+PEER_FILTER = None
+
+
+def parse_peer(peer):
+    """
+    Splits a grpc peer string into (proto, address, port), e.g.
+    'ipv4:10.215.133.23:57775' or 'ipv6:[2001:db8::1]:57775'.
+    """
+    proto, _, rest = unquote(peer).partition(":")
+    if rest.startswith("["):
+        address, _, port = rest[1:].partition("]")
+        port = port.lstrip(":")
+    else:
+        address, _, port = rest.rpartition(":")
+        if not address:
+            address, port = rest, ""
+    return proto, address, port
+
+
+def parse_networks(networks):
+    """
+    Accepts a list of networks or a comma separated string.
+    """
+    if networks is None:
+        return []
+    if isinstance(networks, str):
+        networks = [network.strip() for network in networks.split(",") if network.strip()]
+    return [ipaddress.ip_network(network, strict=False) for network in networks]
+
+
+class PeerFilter:
+    def __init__(self, allow=None, deny=None, cache_size=10000):
+        self.has_allow = False
+        # version -> [(prefix length, {network address as int: accepted})], longest first
+        self.tables = {4: {}, 6: {}}
+        for networks, accepted in ((allow, True), (deny, False)):
+            for network in parse_networks(networks):
+                if accepted:
+                    self.has_allow = True
+                table = self.tables[network.version].setdefault(network.prefixlen, {})
+                network_int = int(network.network_address)
+                # deny wins if the same network is in both lists
+                table[network_int] = table.get(network_int, True) and accepted
+        self.tables = {
+            version: sorted(table.items(), reverse=True) for version, table in self.tables.items()
+        }
+        self.decisions = LRUCache(cache_size, "peer_filter")
+        self.rejected = 0
+
+    def decide(self, address):
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return not self.has_allow
+        if ip.version == 6 and ip.ipv4_mapped is not None:
+            ip = ip.ipv4_mapped
+        ip_int = int(ip)
+        bits = ip.max_prefixlen
+        for prefixlen, networks in self.tables[ip.version]:
+            accepted = networks.get(ip_int >> (bits - prefixlen) << (bits - prefixlen))
+            if accepted is not None:
+                return accepted
+        return not self.has_allow
+
+    def accept(self, address):
+        accepted = self.decisions.get_or_compute(address, self.decide)
+        if not accepted:
+            self.rejected += 1
+        return accepted
+
+
+def accept_peer(address):
+    """
+    Used by the servicers. Only a global lookup if peer filtering is disabled.
+    """
+    if PEER_FILTER is None:
+        return True
+    return PEER_FILTER.accept(address)
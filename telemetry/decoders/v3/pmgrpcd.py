@@ -53,7 +53,6 @@ from config import configure
 from file_modules.file_input import FileInput
 from pathlib import Path
 import os
-# from gnmi_pmgrpcd import GNMIClient
 from kafka_modules.kafka_avro_exporter import manually_serialize
 
 _ONE_DAY_IN_SECONDS = 60 * 60 * 24
@@ -209,18 +208,56 @@ def main():
         help="Path to configuration file",
     )
     #gnmi options
-    #parser.add_option(
-    #    "-g",
-    #    "--gnmi_enable",
-    #    default=config.getboolean("PMGRPCD", "gnmi_enable", fallback=False),
-    #    help="Boolean defining whether gnmi is enable (this disables the rest of collectrors)",
-    #)
-    #parser.add_option(
-    #    "--gnmi_target",
-    #    env_name = "GNMI_SERVER",
-    #    default=config.get("PMGRPCD", "gnmi_target", fallback=None),
-    #    help="The url of the gnmi target",
-    #)
+    parser.add_option(
+        "-g",
+        "--gnmi_enable",
+        action="store_true",
+        dest="gnmi_enable",
+        help="Boolean defining whether gnmi is enable (this disables the rest of collectrors)",
+    )
+    parser.add_option(
+        "--gnmi_target",
+        env_name = "GNMI_SERVER",
+        dest="gnmi_target",
+        help="The url of the gnmi target",
+    )
+    parser.add_option(
+        "--gnmi_paths",
+        default="",
+        dest="gnmi_paths",
+        help="Comma separated gnmi paths subscribed in gnmi_target",
+    )
+    parser.add_option(
+        "--gnmi_mode",
+        default="sample",
+        dest="gnmi_mode",
+        help="Subscription mode of gnmi_paths: sample, on_change or target_defined",
+    )
+    parser.add_option(
+        "--gnmi_sample_interval",
+        type="float",
+        default=10,
+        dest="gnmi_sample_interval",
+        help="Seconds between samples of gnmi_paths in sample mode",
+    )
+    parser.add_option(
+        "--gnmi_encoding",
+        default="json_ietf",
+        dest="gnmi_encoding",
+        help="Encoding requested to gnmi_target: json, json_ietf, proto, ascii or bytes",
+    )
+    parser.add_option(
+        "--gnmi_targets_file",
+        dest="gnmi_targets_file",
+        help="json file with many gnmi targets and their subscriptions. Replaces gnmi_target.",
+    )
+    parser.add_option(
+        "--gnmi_backoff_max",
+        type="float",
+        default=60,
+        dest="gnmi_backoff_max",
+        help="Maximum seconds between reconnections to a gnmi target",
+    )
 
     parser.add_option(
         "-T",
@@ -302,6 +339,12 @@ def main():
         help="enable plugin mitigation mod_result_dict from python module mitigation.py",
     )
 
+    parser.add_option(
+        "--mitigation_rules",
+        dest="mitigation_rules",
+        help="json file with mitigation rules. If set, it replaces the mitigation python module (see config_files/mitigation_rules.json).",
+    )
+
     parser.add_option(
         "-d",
         "--debug",
@@ -411,6 +454,37 @@ def main():
         help="define proto://ip:port of zmq socket bind",
     )
 
+    parser.add_option(
+        "--zmq_mode",
+        default="push",
+        dest="zmq_mode",
+        help="ZMQ socket type: push, or pub, with the encoding path as topic frame.",
+    )
+
+    parser.add_option(
+        "--zmq_batch_size",
+        type="int",
+        default=1,
+        dest="zmq_batch_size",
+        help="Metrics sent together as one multipart ZMQ message.",
+    )
+
+    parser.add_option(
+        "--zmq_flush_seconds",
+        type="int",
+        default=1,
+        dest="zmq_flush_seconds",
+        help="Maximum seconds a metric is buffered before sending it to ZMQ.",
+    )
+
+    parser.add_option(
+        "--zmq_sndhwm",
+        type="int",
+        default=1000,
+        dest="zmq_sndhwm",
+        help="ZMQ messages queued per peer, messages beyond it are dropped.",
+    )
+
     parser.add_option(
         "-k",
         "--kafkaavro",
@@ -428,7 +502,31 @@ def main():
     )
 
     parser.add_option(
-        "-i", "--ip", dest="ip", help="only accept pakets of this single ip"
+        "-i", "--ip", dest="ip", help="only accept streams from this single ip (added to peer_allow)"
+    )
+
+    parser.add_option(
+        "--peer_allow",
+        dest="peer_allow",
+        help="comma separated networks (CIDR) whose streams are accepted. If set, streams from other peers are rejected.",
+    )
+
+    parser.add_option(
+        "--peer_deny",
+        dest="peer_deny",
+        help="comma separated networks (CIDR) whose streams are rejected. The longest matching network of peer_allow and peer_deny decides.",
+    )
+
+    parser.add_option(
+        "--prefilter_rules",
+        dest="prefilter_rules",
+        help="json file with path and node rules checked on the message header, before decoding (see config_files/prefilter_rules.json).",
+    )
+
+    parser.add_option(
+        "--export_routes",
+        dest="export_routes",
+        help="json file with the exporters of each path and peer, optionally sampled (see config_files/export_routes.json).",
     )
 
     parser.add_option(
@@ -476,6 +574,64 @@ def main():
         help="Name of file for file exporter.",
     )
 
+    parser.add_option(
+        "--columnar_exporter_dir",
+        dest="columnar_exporter_dir",
+        help="Directory for the columnar (Arrow/Parquet) exporter. One subdirectory per encoding path.",
+    )
+
+    parser.add_option(
+        "--columnar_format",
+        default="parquet",
+        dest="columnar_format",
+        help="Format of the columnar exporter files: parquet or arrow (IPC stream).",
+    )
+
+    parser.add_option(
+        "--columnar_schemas_file",
+        dest="columnar_schemas_file",
+        help="Json file with the schema per encoding path. Schemas of other paths are inferred and unified across batches.",
+    )
+
+    parser.add_option(
+        "--columnar_compression",
+        default="zstd",
+        dest="columnar_compression",
+        help="Compression of the columnar exporter files.",
+    )
+
+    parser.add_option(
+        "--columnar_batch_size",
+        type="int",
+        default=1000,
+        dest="columnar_batch_size",
+        help="Metrics buffered per encoding path before writing them.",
+    )
+
+    parser.add_option(
+        "--columnar_flush_seconds",
+        type="int",
+        default=60,
+        dest="columnar_flush_seconds",
+        help="Maximum seconds a metric is buffered before writing it.",
+    )
+
+    parser.add_option(
+        "--columnar_roll_seconds",
+        type="int",
+        default=3600,
+        dest="columnar_roll_seconds",
+        help="Start a new file after these seconds.",
+    )
+
+    parser.add_option(
+        "--columnar_roll_mbytes",
+        type="int",
+        default=256,
+        dest="columnar_roll_mbytes",
+        help="Start a new file after it reaches this size in MB.",
+    )
+
     parser.add_option(
         "--file_importer_file",
         dest="file_importer_file",
@@ -488,10 +644,56 @@ def main():
         help="Json file detailing the transformations to execute.",
     )
 
+    parser.add_option(
+        "--transformation_workers",
+        type="int",
+        default=0,
+        dest="transformation_workers",
+        help="Number of processes running the transformations. 0 runs them in the gRPC threads.",
+    )
+
+    parser.add_option(
+        "--transformation_shard_by",
+        default="path",
+        dest="transformation_shard_by",
+        help="How metrics are assigned to transformation workers: path or node_path.",
+    )
+
     parser.add_option(
         "--file_topic_per_encoding_path",
         dest="file_topic_per_encoding_path",
-        help="Json file indentifing the topic per encoding path.",
+        help="Json file indentifing the topic per encoding path, path prefix (ending with *) or pattern. "
+        'Unmatched paths go to --topic, or to the topic of the "*" key if the file has one.',
+    )
+
+    parser.add_option(
+        "--trace_sample_rate",
+        type="int",
+        dest="trace_sample_rate",
+        help="Trace the processing stages of 1 in every N messages. 0 disables tracing.",
+    )
+
+    parser.add_option(
+        "--trace_buffer_size",
+        type="int",
+        default=1000,
+        dest="trace_buffer_size",
+        help="Number of finished traces kept in memory.",
+    )
+
+    parser.add_option(
+        "--trace_dump_file",
+        default="/tmp/pmgrpcd_traces.json",
+        dest="trace_dump_file",
+        help="File where traces are dumped (as json) when receiving USR2.",
+    )
+
+    parser.add_option(
+        "--trie_cache_size",
+        type="int",
+        default=10000,
+        dest="trie_cache_size",
+        help="Maximum number of entries in each lookup cache of the transformation tries.",
     )
 
     (lib_pmgrpcd.OPTIONS, args) = parser.parse_args()
@@ -547,16 +749,11 @@ def main():
             "manually serialize need both lib_pmgrpcd.OPTIONS avscid and jsondatafile"
         )
         parser.print_help()
-    #elif lib_pmgrpcd.OPTIONS.gnmi_enable:
-    #    if lib_pmgrpcd.OPTIONS.gnmi_target is None:
-    #        error = "gnmi target not configured, but gnmi enabled"
-    #        PMGRPCDLOG.error(error)
-    #        raise Exception(error)
-    #
-    #    PMGRPCDLOG.info("Starting contact with gnmi server %s. Other functions will be ignored", lib_pmgrpcd.OPTIONS.gnmi_target)
-    #    channel = grpc.insecure_channel(lib_pmgrpcd.OPTIONS.gnmi_target)
-    #    gnmi_client = GNMIClient(channel)
-    #    breakpoint()
+    elif lib_pmgrpcd.OPTIONS.gnmi_enable:
+        PMGRPCDLOG.info("Starting gnmi dial-in collection. Other functions will be ignored")
+        # gnmi protos are only loaded when needed
+        from gnmi_pmgrpcd import serve_gnmi
+        serve_gnmi()
 
     else:
         # make sure some important files exist
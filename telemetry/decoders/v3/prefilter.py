@@ -0,0 +1,221 @@
+#
+#   pmacct (Promiscuous mode IP Accounting package)
+#   pmacct is Copyright (C) 2003-2019 by Paolo Lucente
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+#   pmgrpcd and its components are Copyright (C) 2018-2019 by:
+#
+#   Matthias Arnold <matthias.arnold@swisscom.com>
+#   Juan Camilo Cardona <jccardona82@gmail.com>
+#   Thomas Graf <thomas.graf@swisscom.com>
+#   Paolo Lucente <paolo@pmacct.net>
+#
+"""
+Pre-filtering of the gRPC messages on their header.
+
+Decoding a message (ParseFromString, MessageToDict, mitigation and json) is
+the expensive part of the collector. The Telemetry header (node id,
+subscription and encoding/sensor path) is at the top level of the protobuf,
+so it can be read from the bytes by walking the wire format, jumping over the
+payload without parsing it. Messages of unwanted paths or nodes are dropped
+before decoding, and the decision per (path, node) is cached.
+
+Rules (see config_files/prefilter_rules.json), patterns are fnmatch patterns:
+    allow/deny: paths. If allow is not empty, a path must match it.
+    allow_nodes/deny_nodes: the same for the node id.
+    sample: {pattern: N}, keeps 1 in every N messages of a path (first match).
+    only_openconfig: drops the paths without openconfig (the onlyopenconfig option).
+"""
+from fnmatch import fnmatchcase
+import itertools
+import ujson as json
+from caching import LRUCache
+
+# None means no pre-filtering. It is set up by config.configure.
+PREFILTER = None
+
+# Field numbers of the Telemetry messages (cisco telemetry.proto and
+# huawei-telemetry.proto). Only strings are read.
+HEADER_FIELDS = {
+    "cisco": {1: "node_id", 3: "subscription_id", 6: "path"},
+    "huawei": {1: "node_id", 2: "subscription_id", 3: "path"},
+}
+
+WIRE_VARINT = 0
+WIRE_64BIT = 1
+WIRE_LENGTH = 2
+WIRE_32BIT = 5
+
+
+class HeaderError(Exception):
+    pass
+
+
+def read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise HeaderError("Truncated varint")
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+        if shift > 63:
+            raise HeaderError("Varint too long")
+
+
+def scan_header(data, fields):
+    """
+    Reads the string fields (number -> name) of the top level of a protobuf
+    message. Other fields are skipped without decoding, the scan stops once all
+    the fields are found.
+    """
+    header = {}
+    pos = 0
+    end = len(data)
+    while pos < end and len(header) < len(fields):
+        tag, pos = read_varint(data, pos)
+        number = tag >> 3
+        wire_type = tag & 0x7
+        if wire_type == WIRE_VARINT:
+            _, pos = read_varint(data, pos)
+        elif wire_type == WIRE_LENGTH:
+            length, pos = read_varint(data, pos)
+            if pos + length > end:
+                raise HeaderError("Truncated field")
+            name = fields.get(number)
+            if name is not None:
+                header[name] = bytes(data[pos : pos + length]).decode("utf-8", "replace")
+            pos += length
+        elif wire_type == WIRE_64BIT:
+            pos += 8
+        elif wire_type == WIRE_32BIT:
+            pos += 4
+        else:
+            raise HeaderError(f"Unsupported wire type {wire_type}")
+    return header
+
+
+def _matcher(patterns):
+    patterns = list(patterns or [])
+
+    def match(value):
+        for pattern in patterns:
+            if fnmatchcase(value, pattern):
+                return True
+        return False
+
+    return match
+
+
+class PreFilter:
+    """
+    Decides from the header if a message is decoded. Messages whose header
+    cannot be read are always accepted, the decoder will deal with them.
+    """
+
+    def __init__(
+        self,
+        allow=None,
+        deny=None,
+        allow_nodes=None,
+        deny_nodes=None,
+        sample=None,
+        only_openconfig=False,
+        cache_size=10000,
+    ):
+        self.only_openconfig = only_openconfig
+        self.has_allow = bool(allow)
+        self.has_allow_nodes = bool(allow_nodes)
+        self.allow = _matcher(allow)
+        self.deny = _matcher(deny)
+        self.allow_nodes = _matcher(allow_nodes)
+        self.deny_nodes = _matcher(deny_nodes)
+        self.sample = list((sample or {}).items())
+        for pattern, rate in self.sample:
+            if not isinstance(rate, int) or rate < 1:
+                raise Exception(f"Sample rate of {pattern} must be an integer of at least 1, got {rate}")
+        self.decisions = LRUCache(cache_size, "prefilter")
+        # Sampling counters per path. next() over itertools.count is atomic in
+        # CPython, no lock needed.
+        self._counters = {}
+        self.accepted = 0
+        self.dropped = 0
+
+    @classmethod
+    def from_file(cls, filename, **kwargs):
+        with open(filename) as fh:
+            rules = json.loads(fh.read())
+        rules.update(kwargs)
+        return cls(**rules)
+
+    def decide(self, key):
+        """
+        Returns the sample rate of a (path, node), 0 if it is dropped.
+        """
+        path, node = key
+        if self.only_openconfig and "openconfig" not in path:
+            return 0
+        if self.deny(path) or (self.has_allow and not self.allow(path)):
+            return 0
+        if node is not None:
+            if self.deny_nodes(node) or (self.has_allow_nodes and not self.allow_nodes(node)):
+                return 0
+        for pattern, rate in self.sample:
+            if fnmatchcase(path, pattern):
+                return rate
+        return 1
+
+    def accept_header(self, path, node):
+        if path is None:
+            return True
+        rate = self.decisions.get_or_compute((path, node), self.decide)
+        if rate == 1:
+            return True
+        if rate == 0:
+            return False
+        counter = self._counters.get(path)
+        if counter is None:
+            counter = self._counters.setdefault(path, itertools.count())
+        return next(counter) % rate == 0
+
+    def accept(self, vendor, data):
+        """
+        True if the message (the protobuf bytes of a Telemetry of vendor) has to be decoded.
+        """
+        try:
+            header = scan_header(data, HEADER_FIELDS[vendor])
+        except HeaderError:
+            return True
+        accepted = self.accept_header(header.get("path"), header.get("node_id"))
+        # the counters are only statistics, races are not important
+        if accepted:
+            self.accepted += 1
+        else:
+            self.dropped += 1
+        return accepted
+
+
+def accept_message(vendor, data):
+    """
+    Used by the servicers. Only a global lookup if pre-filtering is disabled.
+    """
+    if PREFILTER is None:
+        return True
+    return PREFILTER.accept(vendor, data)
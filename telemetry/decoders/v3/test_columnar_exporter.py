@@ -0,0 +1,80 @@
+import pytest
+
+pyarrow = pytest.importorskip("pyarrow")
+import pyarrow.ipc
+import pyarrow.parquet
+
+from file_modules.columnar_exporter import ColumnarExporter
+
+PATH = "openconfig-interfaces:interfaces/interface"
+
+
+def metric(**content):
+    return {"collector": {"data": {"encoding_path": PATH}}, "content": content}
+
+
+def read_files(directory, file_format, rejected=False):
+    tables = []
+    for filename in sorted(directory.iterdir()):
+        if filename.stem.endswith("-rejected") != rejected:
+            continue
+        if file_format == "parquet":
+            tables.append(pyarrow.parquet.read_table(filename))
+        else:
+            with pyarrow.ipc.open_stream(pyarrow.OSFile(str(filename))) as reader:
+                tables.append(reader.read_all())
+    return tables
+
+
+@pytest.mark.parametrize("file_format", ["arrow", "parquet"])
+def test_diverging_schemas(tmp_path, file_format):
+    exporter = ColumnarExporter(str(tmp_path), file_format=file_format, batch_size=2, compression=None)
+    # first batch: counter is an int
+    exporter.process_dict(metric(name="eth0", counter=1))
+    exporter.process_dict(metric(name="eth1", counter=2))
+    # second batch: counter is promoted to double, speed is a new field
+    exporter.process_dict(metric(name="eth0", counter=1.5, speed=1000))
+    exporter.process_dict(metric(name="eth1", counter=2.5, speed=None))
+    # third batch: a string does not fit the double column
+    exporter.process_dict(metric(name="eth2", counter="broken"))
+    exporter.close()
+
+    directory = tmp_path / PATH.replace(":", ".").replace("/", ".")
+    first, second = read_files(directory, file_format)
+    assert first.schema.field("content.counter").type == pyarrow.int64()
+    assert first.column("content.counter").to_pylist() == [1, 2]
+    # the schema changed, so the second batch starts a new file with the unified schema
+    assert second.schema.field("content.counter").type == pyarrow.float64()
+    assert second.column("content.counter").to_pylist() == [1.5, 2.5]
+    assert second.column("content.speed").to_pylist() == [1000, None]
+    assert second.column("content.name").to_pylist() == ["eth0", "eth1"]
+
+    (rejected,) = read_files(directory, file_format, rejected=True)
+    assert rejected.to_pylist() == [
+        {"collector.data.encoding_path": PATH, "content.name": "eth2", "content.counter": "broken"}
+    ]
+
+
+def test_without_type_promotion(tmp_path, monkeypatch):
+    unify_schemas = pyarrow.unify_schemas
+
+    def old_unify_schemas(schemas, **kargs):
+        # pyarrow < 14
+        if kargs:
+            raise TypeError("unify_schemas() got an unexpected keyword argument")
+        return unify_schemas(schemas)
+
+    monkeypatch.setattr(pyarrow, "unify_schemas", old_unify_schemas)
+    exporter = ColumnarExporter(str(tmp_path), file_format="arrow", batch_size=1, compression=None)
+    exporter.process_dict(metric(name="eth0", counter=1))
+    exporter.process_dict(metric(name="eth0", counter=2, speed=1000))
+    exporter.process_dict(metric(name="eth0", counter=1.5))
+    exporter.close()
+
+    directory = tmp_path / PATH.replace(":", ".").replace("/", ".")
+    first, second = read_files(directory, "arrow")
+    assert first.column("content.counter").to_pylist() == [1]
+    # new fields are still added
+    assert second.column("content.speed").to_pylist() == [1000]
+    (rejected,) = read_files(directory, "arrow", rejected=True)
+    assert rejected.column("content.counter").to_pylist() == [1.5]
@@ -0,0 +1,37 @@
+import ujson as json
+from envelope import PeerEnvelope
+from export_pmgrpcd import ExportData, RowExportData
+
+
+def test_encode_matches_dict():
+    peer = PeerEnvelope("10.0.0.1", "Cisco")
+    envelope = peer.message({"node_id_str": "r1", "encoding_path": "a/b", "collection_timestamp": 1})
+    fields = {"a/b": {"z": 1, "a": [1, 2]}}
+    assert envelope.encode(fields) == json.dumps(envelope.message_dict(fields), sort_keys=True)
+    # cached collector part
+    assert envelope.encode(fields) == json.dumps(envelope.message_dict(fields), sort_keys=True)
+
+    row_data = {"timestamp": 5, "node_id_str": "other"}
+    encoded = envelope.encode(fields, row_data)
+    assert encoded == json.dumps(envelope.message_dict(fields, row_data), sort_keys=True)
+    assert json.loads(encoded)["collector"]["data"]["node_id_str"] == "other"
+    assert envelope.get("node_id_str", row_data) == "other"
+    assert envelope.get("encoding_path", row_data) == "a/b"
+
+
+def test_message_dict_is_owned():
+    envelope = PeerEnvelope("10.0.0.1", "Huawei").message({"proto": "x"})
+    message = envelope.message_dict({"content": {}})
+    message["collector"]["data"]["proto"] = "changed"
+    message["collector"]["grpc"]["ne_vendor"] = "changed"
+    assert envelope.message_dict({})["collector"] == {
+        "grpc": {"grpcPeer": "10.0.0.1", "ne_vendor": "Huawei"},
+        "data": {"proto": "x"},
+    }
+
+
+def test_row_and_dict_exports_have_the_same_format():
+    envelope = PeerEnvelope("10.0.0.1", "Cisco").message({"encoding_path": "a/b"})
+    fields = {"a/b": {"z": 1}}
+    row = RowExportData(envelope, fields)
+    assert row.json() == ExportData(dictdata=envelope.message_dict(fields)).json()
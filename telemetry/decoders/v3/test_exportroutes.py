@@ -0,0 +1,115 @@
+import os
+import pytest
+import export_pmgrpcd
+import exportroutes
+from export_pmgrpcd import Exporter, ExportData, export_data
+from exportroutes import ExportRoutes
+
+CONFIG_FILES = os.path.join(os.path.dirname(__file__), "config_files")
+EXPORTER_NAMES = ["zmq", "kafkaavro", "kafka", "file"]
+
+
+def test_routes():
+    routes = ExportRoutes.from_file(os.path.join(CONFIG_FILES, "export_routes.json"), EXPORTER_NAMES)
+    # the first metric of each path is also sampled to file
+    assert routes.exporters_for("openconfig-interfaces:interfaces", "10.1.1.1") == ["zmq", "kafkaavro", "file"]
+    assert routes.exporters_for("openconfig-interfaces:interfaces", "10.1.1.1") == ["zmq", "kafkaavro"]
+    assert routes.exporters_for("Cisco-IOS-XR-qos-ma-oper:qos", "10.1.1.1") == ["zmq", "kafka", "file"]
+    assert routes.exporters_for("Cisco-IOS-XR-qos-ma-oper:qos", "192.168.1.1") == ["zmq"]
+    assert routes.exporters_for(None, None) == ["zmq", "file"]
+    # 1 in 100 to the file exporter, counted per path
+    selected = [routes.exporters_for("Cisco-IOS-XR-qos-ma-oper:other", "192.168.1.1") for _ in range(200)]
+    assert sum("file" in names for names in selected) == 2
+    assert routes.selections.stats()["misses"] == 5
+
+
+def test_routes_peer_patterns():
+    routes = ExportRoutes([{"exporters": ["kafka"], "peers": ["2001:db8::/32", "lab-*"]}], EXPORTER_NAMES)
+    assert "kafka" in routes.exporters_for("a", "2001:db8::1")
+    assert "kafka" in routes.exporters_for("a", "lab-r1")
+    assert "kafka" not in routes.exporters_for("a", "10.0.0.1")
+
+
+def test_invalid_routes():
+    with pytest.raises(Exception):
+        ExportRoutes([{"exporters": ["unknown"]}], EXPORTER_NAMES)
+    with pytest.raises(Exception):
+        ExportRoutes([{"exporters": ["file"], "sample": 0}], EXPORTER_NAMES)
+
+
+class JsonExporter(Exporter):
+    def __init__(self):
+        self.metrics = []
+
+    def process_metric(self, metric):
+        self.metrics.append(metric)
+
+
+class DictExporter(JsonExporter):
+    def export(self, data):
+        self.metrics.append(data.dict())
+
+
+class CountingData(ExportData):
+    __slots__ = ()
+    encoded = 0
+
+    def encode(self):
+        CountingData.encoded += 1
+        return super().encode()
+
+
+@pytest.fixture
+def exporters(monkeypatch):
+    exporters = {"zmq": JsonExporter(), "columnar": DictExporter()}
+    monkeypatch.setattr(export_pmgrpcd, "EXPORTERS", exporters)
+    monkeypatch.setattr(
+        exportroutes,
+        "EXPORT_ROUTES",
+        ExportRoutes([{"exporters": ["zmq"], "paths": ["openconfig-*"]}], exporters),
+    )
+    CountingData.encoded = 0
+    return exporters
+
+
+def message(path):
+    return {"collector": {"grpc": {"grpcPeer": "10.0.0.1"}, "data": {"encoding_path": path}}, "a": 1}
+
+
+def test_export_data_serializes_only_if_needed(exporters):
+    export_data(CountingData(dictdata=message("Cisco-IOS-XR-qos-ma-oper:qos")))
+    assert CountingData.encoded == 0
+    assert exporters["columnar"].metrics == [message("Cisco-IOS-XR-qos-ma-oper:qos")]
+    assert exporters["zmq"].metrics == []
+
+    export_data(CountingData(dictdata=message("openconfig-interfaces:interfaces")))
+    assert CountingData.encoded == 1
+    assert len(exporters["zmq"].metrics) == 1
+
+    exporters["columnar"].metrics.clear()
+    exportroutes.EXPORT_ROUTES = ExportRoutes([{"exporters": ["zmq", "columnar"], "paths": ["x*"]}], exporters)
+    export_data(CountingData(dictdata=message("openconfig-interfaces:interfaces")))
+    assert CountingData.encoded == 1
+    assert exporters["columnar"].metrics == []
+
+
+def test_route_fills_peer_with_path():
+    data = ExportData(dictdata=message("a"), path="openconfig-interfaces:interfaces")
+    data.route()
+    assert (data.path, data.peer) == ("openconfig-interfaces:interfaces", "10.0.0.1")
+
+
+def test_transformed_metrics_keep_grpc_peer(exporters, monkeypatch):
+    exporters["zmq"].metrics.clear()
+    monkeypatch.setattr(
+        exportroutes,
+        "EXPORT_ROUTES",
+        ExportRoutes([{"exporters": ["zmq"], "peers": ["10.0.0.1"]}], exporters),
+    )
+    metric = {"encodingPath": "a/b", "node_id": "r1", "content": {"x": 1}, "keys": {}, "grpcPeer": "10.0.0.1"}
+    export_pmgrpcd.export_transformed(metric)
+    # routed by the gRPC peer, not by the node name
+    assert len(exporters["zmq"].metrics) == 1
+    assert '"grpcPeer":"10.0.0.1"' in exporters["zmq"].metrics[0]
+    export_pmgrpcd.export_transformed({"encodingPath": "a/b", "node_id": "10.0.0.1", "content": {}, "keys": {}})
+    assert len(exporters["zmq"].metrics) == 2
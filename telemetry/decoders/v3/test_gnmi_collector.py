@@ -0,0 +1,174 @@
+import asyncio
+import importlib.util
+import os
+import pytest
+import ujson as json
+
+# the generated protos are only importable with protos in PYTHONPATH
+gnmi_pb2 = pytest.importorskip("gnmi_pb2")
+grpc = pytest.importorskip("grpc")
+import gnmi_pb2_grpc
+import gnmi_pmgrpcd
+from gnmi_pmgrpcd import (
+    GNMIClient,
+    GNMIConfigError,
+    build_subscribe_request,
+    configure_targets,
+    load_targets_file,
+    parse_path,
+)
+from gnmi_utils import PathNotSupported
+
+
+def load_stub_server():
+    # utils is not a package (and utils.py shadows it)
+    filename = os.path.join(os.path.dirname(__file__), "utils", "gnmi_stub_server.py")
+    spec = importlib.util.spec_from_file_location("gnmi_stub_server", filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def elems(path):
+    return [(elem.name, dict(elem.key)) for elem in path.elem]
+
+
+def test_parse_path():
+    path = parse_path("openconfig:/interfaces/interface[name=Ethernet1/1]/state")
+    assert path.origin == "openconfig"
+    assert elems(path) == [("interfaces", {}), ("interface", {"name": "Ethernet1/1"}), ("state", {})]
+
+    path = parse_path("/network-instances/network-instance[name=a:b]/protocols/protocol[identifier=BGP][name=bgp]")
+    assert path.origin == ""
+    assert elems(path) == [
+        ("network-instances", {}),
+        ("network-instance", {"name": "a:b"}),
+        ("protocols", {}),
+        ("protocol", {"identifier": "BGP", "name": "bgp"}),
+    ]
+
+    # ] and \\ are escaped in the keys, a / in a key needs no escaping
+    path = parse_path(r"/a/b[name=x\]/\\y]/c")
+    assert elems(path) == [("a", {}), ("b", {"name": "x]/\\y"}), ("c", {})]
+    with pytest.raises(PathNotSupported):
+        parse_path(r"/a/b[name=x\y]")
+
+
+def test_build_subscribe_request():
+    request = build_subscribe_request(
+        [
+            "/interfaces/interface/state/counters",
+            {"path": "/interfaces/interface/state/oper-status", "mode": "on_change", "heartbeat_interval": 60},
+            {"path": "/system/memory", "sample_interval": 0.5, "suppress_redundant": True},
+        ],
+        encoding="json",
+        prefix="openconfig:/",
+    )
+    subscription_list = request.subscribe
+    assert subscription_list.mode == gnmi_pb2.SubscriptionList.STREAM
+    assert subscription_list.encoding == gnmi_pb2.JSON
+    assert subscription_list.prefix.origin == "openconfig"
+    counters, oper_status, memory = subscription_list.subscription
+    assert elems(counters.path)[-1] == ("counters", {})
+    assert counters.mode == gnmi_pb2.SAMPLE
+    assert not counters.suppress_redundant
+    assert oper_status.mode == gnmi_pb2.ON_CHANGE
+    assert oper_status.heartbeat_interval == 60 * 10 ** 9
+    assert memory.sample_interval == 5 * 10 ** 8
+    assert memory.suppress_redundant
+
+    with pytest.raises(GNMIConfigError):
+        build_subscribe_request(["/a"], encoding="xml")
+    with pytest.raises(GNMIConfigError):
+        build_subscribe_request([{"path": "/a", "mode": "poll"}])
+
+
+def test_targets_file(tmp_path):
+    targets_file = tmp_path / "targets.json"
+    targets_file.write_text(
+        json.dumps(
+            {
+                "defaults": {"subscriptions": ["/interfaces"], "username": "admin", "backoff_max": 30},
+                "targets": [
+                    {"address": "r1:57400"},
+                    {"address": "r2:57400", "name": "r2", "subscriptions": ["/system"], "encoding": "json"},
+                ],
+            }
+        )
+    )
+    targets = load_targets_file(str(targets_file))
+    assert targets[0] == {"address": "r1:57400", "subscriptions": ["/interfaces"], "username": "admin", "backoff_max": 30}
+    assert targets[1]["subscriptions"] == ["/system"]
+
+    r1, r2 = configure_targets(targets)
+    assert "subscriptions" not in r1 and "encoding" not in r2
+    assert r1["request"].subscribe.encoding == gnmi_pb2.JSON_IETF
+    assert r2["request"].subscribe.encoding == gnmi_pb2.JSON
+    assert elems(r2["request"].subscribe.subscription[0].path) == [("system", {})]
+    # every target is a valid GNMIClient
+    GNMIClient(handler=None, **r2)
+
+    with pytest.raises(GNMIConfigError):
+        configure_targets([{"subscriptions": ["/interfaces"]}])
+    with pytest.raises(GNMIConfigError):
+        configure_targets([{"address": "r1:57400"}])
+    targets_file.write_text(json.dumps({"defaults": {}}))
+    with pytest.raises(GNMIConfigError):
+        load_targets_file(str(targets_file))
+
+
+async def start_stub(stub_server, port=0):
+    server = grpc.aio.server()
+    gnmi_pb2_grpc.add_gNMIServicer_to_server(stub_server.GNMIStub(2, 0), server)
+    port = server.add_insecure_port(f"127.0.0.1:{port}")
+    await server.start()
+    return server, port
+
+
+async def wait_for(condition, timeout=10):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("timeout")
+
+
+def test_client_reconnects(monkeypatch):
+    stub_server = load_stub_server()
+    delays = []
+
+    def uniform(low, high):
+        delays.append(high)
+        return high
+
+    monkeypatch.setattr(gnmi_pmgrpcd.random, "uniform", uniform)
+
+    async def run():
+        server, port = await start_stub(stub_server)
+        updates = []
+
+        async def handler(client, notification):
+            updates.append(notification)
+
+        request = build_subscribe_request(
+            [{"path": "openconfig:/interfaces/interface/state/counters", "sample_interval": 0.01}]
+        )
+        client = GNMIClient(f"127.0.0.1:{port}", request, handler, backoff_initial=0.1, backoff_max=0.2)
+        task = asyncio.ensure_future(client.run())
+        await wait_for(lambda: len(updates) >= 4)
+        # a notification per interface, with the interface as key
+        assert {dict(update.prefix.elem[-1].key)["name"] for update in updates} == {"eth0", "eth1"}
+
+        await server.stop(None)
+        await wait_for(lambda: client.reconnections >= 3)
+        received = len(updates)
+        server, _ = await start_stub(stub_server, port)
+        await wait_for(lambda: len(updates) > received)
+
+        client.stop()
+        await asyncio.wait_for(task, 5)
+        await server.stop(None)
+
+    asyncio.run(run())
+    # the backoff doubles up to backoff_max while the target is down
+    assert delays[:3] == [0.1, 0.2, 0.2]
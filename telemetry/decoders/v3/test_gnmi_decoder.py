@@ -0,0 +1,80 @@
+import pytest
+
+# the generated protos are only importable with protos in PYTHONPATH
+gnmi_pb2 = pytest.importorskip("gnmi_pb2")
+from encoders.gnmi import GNMIDecoder, typed_value_to_python
+
+
+def path(*elems, origin=""):
+    return gnmi_pb2.Path(
+        origin=origin, elem=[gnmi_pb2.PathElem(name=name, key=keys) for name, keys in elems]
+    )
+
+
+def update(value, *elems):
+    return gnmi_pb2.Update(path=path(*elems), val=value)
+
+
+def test_typed_values():
+    assert typed_value_to_python(gnmi_pb2.TypedValue(uint_val=2 ** 64 - 1)) == 2 ** 64 - 1
+    assert typed_value_to_python(gnmi_pb2.TypedValue(string_val="UP")) == "UP"
+    assert typed_value_to_python(gnmi_pb2.TypedValue(json_ietf_val=b'{"a": 1}')) == {"a": 1}
+    decimal = gnmi_pb2.Decimal64(digits=1234, precision=2)
+    assert typed_value_to_python(gnmi_pb2.TypedValue(decimal_val=decimal)) == 12.34
+    leaflist = gnmi_pb2.ScalarArray(element=[gnmi_pb2.TypedValue(int_val=1), gnmi_pb2.TypedValue(bool_val=True)])
+    assert typed_value_to_python(gnmi_pb2.TypedValue(leaflist_val=leaflist)) == [1, True]
+    assert typed_value_to_python(gnmi_pb2.TypedValue()) is None
+
+
+def test_decode_groups_updates():
+    decoder = GNMIDecoder()
+    notification = gnmi_pb2.Notification(
+        timestamp=1577836800123456789,
+        prefix=path(("interfaces", {}), ("interface", {"name": "eth0"}), origin="openconfig"),
+        update=[
+            update(gnmi_pb2.TypedValue(uint_val=10), ("state", {}), ("counters", {}), ("in-octets", {})),
+            update(gnmi_pb2.TypedValue(uint_val=20), ("state", {}), ("counters", {}), ("out-octets", {})),
+            update(gnmi_pb2.TypedValue(string_val="UP"), ("state", {}), ("oper-status", {})),
+            update(
+                gnmi_pb2.TypedValue(uint_val=5),
+                ("subinterfaces", {}),
+                ("subinterface", {"index": "0"}),
+                ("state", {}),
+                ("name", {}),
+            ),
+        ],
+        delete=[path(("state", {}), ("description", {}))],
+    )
+    metrics = decoder.decode(notification, "r1")
+    assert [(m.path, m.keys, m.content) for m in metrics] == [
+        (
+            "openconfig:interfaces/interface/state/counters",
+            {"name": "eth0"},
+            {"in-octets": 10, "out-octets": 20},
+        ),
+        ("openconfig:interfaces/interface/state", {"name": "eth0"}, {"oper-status": "UP", "deleted": ["description"]}),
+        (
+            "openconfig:interfaces/interface/subinterfaces/subinterface/state",
+            {"name": "eth0", "index": "0"},
+            {"name": 5},
+        ),
+    ]
+    assert metrics[0].node == "r1"
+    assert metrics[0].timestamp == 1577836800123
+
+    # a repeated notification hits the caches, and the metrics do not share keys
+    decoder.decode(notification, "r1")[0].keys["name"] = "changed"
+    assert decoder.prefixes.stats()["hits"] == 1
+    assert decoder.paths.stats()["hits"] == 5
+    assert decoder.decode(notification, "r1")[0].keys == {"name": "eth0"}
+
+
+def test_repeated_key_names():
+    decoder = GNMIDecoder()
+    notification = gnmi_pb2.Notification(
+        prefix=path(("a", {"name": "x"})),
+        update=[update(gnmi_pb2.TypedValue(int_val=1), ("b", {"name": "y"}), ("leaf", {}))],
+    )
+    [metric] = decoder.decode(notification, "r1")
+    assert metric.path == "a/b"
+    assert metric.keys == {"name": "x", "b_name": "y"}
@@ -0,0 +1,106 @@
+from encoders.base import InternalMetric
+from transformations import transformation_factory
+
+
+def metric():
+    return InternalMetric(
+        {
+            "encodingPath": "path/here",
+            "node_id": "r1",
+            "timestamp": 1000,
+            "keys": {"if": "eth0"},
+            "content": {"a": {"x": 1, "y": 2}, "b": {"z": [{"v": 1}]}, "c": 3},
+            "grpcPeer": "10.0.0.1",
+        }
+    )
+
+
+def test_replace_is_copy_on_write():
+    original = metric()
+    content = dict(original.content, c=4)
+    replaced = original.replace(content=content, path="other/path")
+    assert replaced.content == {"a": {"x": 1, "y": 2}, "b": {"z": [{"v": 1}]}, "c": 4}
+    assert replaced.path == "other/path"
+    # the entries that were not replaced are shared
+    assert replaced.keys is original.keys
+    assert replaced.content["a"] is original.content["a"]
+    assert replaced.data["grpcPeer"] == "10.0.0.1"
+
+    replaced.content["d"] = 5
+    assert "d" not in original.content
+    original.content["e"] = 6
+    assert "e" not in replaced.content
+    assert original.content["c"] == 3
+    assert original.path == "path/here"
+
+
+def test_content_transformations_copy_on_write():
+    original = metric()
+    transformation = transformation_factory("rename_content", {"rename_content": {"path/here/a/x": "new_x"}})
+    (renamed,) = transformation.transform(original)
+    assert renamed.content["a"] == {"new_x": 1, "y": 2}
+    assert original.content["a"] == {"x": 1, "y": 2}
+    # only the dicts on the way to the change are copied
+    assert renamed.content is not original.content
+    assert renamed.content["a"] is not original.content["a"]
+    assert renamed.content["b"] is original.content["b"]
+    assert renamed.keys is original.keys
+
+    renamed.content["a"]["w"] = 0
+    assert "w" not in original.content["a"]
+    original.content["a"]["x"] = 10
+    assert renamed.content["a"] == {"new_x": 1, "y": 2, "w": 0}
+
+    # nothing changed, nothing copied
+    untouched = metric()
+    (same,) = transformation.transform(untouched.replace(path="other/path"))
+    assert same.content is untouched.content
+
+
+def test_split_copy_on_write():
+    original = metric()
+    transformation = transformation_factory("split_lists", {"split_lists": ["path/here/b/z"]})
+    rest, split = sorted(transformation.transform(original), key=lambda m: m.path)
+    assert split.path == "path/here/b/z"
+    assert split.content is original.content["b"]["z"][0]
+    # b is empty after the split, so it is dropped
+    assert rest.content == {"a": {"x": 1, "y": 2}, "c": 3}
+    assert rest.content["a"] is original.content["a"]
+    # the list is removed from a copy, the original keeps it
+    assert original.content["b"] == {"z": [{"v": 1}]}
+
+
+def test_data_round_trip():
+    original = metric()
+    data = original.data
+    assert data == {
+        "encodingPath": "path/here",
+        "node_id": "r1",
+        "timestamp": 1000,
+        "keys": {"if": "eth0"},
+        "content": {"a": {"x": 1, "y": 2}, "b": {"z": [{"v": 1}]}, "c": 3},
+        "grpcPeer": "10.0.0.1",
+    }
+    assert (original.path, original.node, original.timestamp) == ("path/here", "r1", 1000)
+    assert InternalMetric(data).data == data
+    # entries that are not there are not added
+    del data["timestamp"]
+    assert "timestamp" not in InternalMetric(data).data
+
+
+def test_data_assignment():
+    changed = metric()
+    changed.data = dict(changed.data, encodingPath="other/path", node_id="r2", timestamp=2000, extra=1)
+    assert (changed.path, changed.node, changed.timestamp) == ("other/path", "r2", 2000)
+    assert changed.load_from_data("extra") == 1
+    assert changed.data["extra"] == 1
+
+
+def test_data_is_a_copy():
+    # data is built on every access: changing it is silently lost
+    original = metric()
+    original.data["timestamp"] = 2000
+    original.data["grpcPeer"] = "10.0.0.2"
+    assert original.timestamp == 1000
+    assert original.data["grpcPeer"] == "10.0.0.1"
+    assert original.data is not original.data
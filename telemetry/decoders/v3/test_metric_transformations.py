@@ -1,7 +1,8 @@
 import pytest
 import json
 from encoders.base import InternalMetric
-from transformations import transformation_factory, MetricExceptionBase, load_transformtions_from_file
+from transformations import transformation_factory, MetricExceptionBase, load_transformtions_from_file, CacheCharTrie
+from transformations import MetricTransformationBase, SplitLists
 from pprint import pprint
 import copy
 
@@ -92,8 +93,271 @@ class TestEncodingTransformation:
         #now, the original data MUST remain the same
         assert data == original_data
 
+    @pytest.mark.parametrize("n, name", TESTS.keys())
+    def test_transform_batch(self, n, name):
+        config, data, expected = TESTS[(n, name)]
+        if "exception" in config:
+            return
+        keys = [x for x in config if x not in IGNORED_KEYS]
+        transformation = transformation_factory(keys[0], config)
+        metrics = [InternalMetric(data), InternalMetric(data)]
+        results = transformation.transform_batch(metrics)
+        gotten_data = [x.data for x in results]
+        assert sort_data(gotten_data) == sort_data(expected + expected)
+
+    def test_transform_columns(self):
+        config = {"split_lists": ["path/here/a"]}
+        transformation = transformation_factory("split_lists", config)
+        data = {
+            "encodingPath": "path/here",
+            "node_id": "router",
+            "timestamp": 10,
+            "keys": {"k": "v"},
+            "content": {"a": [{"name": "x", "n": 1}, {"name": "y", "n": 2**64 - 1, "m": "s"}]},
+        }
+        columns = transformation.transform_columns([InternalMetric(data)])
+        assert list(columns) == ["path/here/a"]
+        path_columns = columns["path/here/a"]
+        assert path_columns.length == 2
+        assert list(path_columns.content["n"]) == [1, 2**64 - 1]
+        assert list(path_columns.content["m"]) == [None, "s"]
+        assert list(path_columns.keys["k"]) == ["v", "v"]
+        assert list(path_columns.rows())[0] == ({"k": "v"}, {"name": "x", "n": 1})
+
+    def test_batch_resolves_plans_once_per_path(self):
+        for key, config, n_results in (
+            ("split_lists", {"split_lists": ["path/here/a"]}, 20),
+            ("field_to_str", {"field_to_str": {"options": [], "paths": ["path/here/b"]}}, 10),
+        ):
+            transformation = transformation_factory(key, config)
+            resolved = []
+            get_plan = transformation.get_plan
+            transformation.get_plan = lambda path: resolved.append(path) or get_plan(path)
+            data = {
+                "encodingPath": "path/here",
+                "node_id": "router",
+                "keys": {},
+                "content": {"a": [{"name": "x"}], "b": 1},
+            }
+            results = transformation.transform_batch([InternalMetric(data) for _ in range(10)])
+            assert len(results) == n_results
+            assert len(resolved) == len(set(resolved))
+
     def test_load_transfomations_from_file(self):
         transformations = load_transformtions_from_file("data_test_load_transformations.json")
         assert len(transformations) == 2
 
 
+
+    def test_plans_only_include_touched_fields(self):
+        config = {"rename_content": {"path/here/a/b": "new_b", "path/here/c": "new_c"}}
+        transformation = transformation_factory("rename_content", config)
+        plan = transformation.get_plan("path/here/")
+        assert set(plan.children) == {"a", "c"}
+        assert plan.children["c"] == ("path/here/c", True, "path/here/c")
+        assert plan.children["a"][1] is False
+        assert set(transformation.get_plan("path/here/a").children) == {"b"}
+        assert not transformation.get_plan("other/path").covered
+        # plans are compiled once per path
+        assert transformation.get_plan("path/here/") is plan
+
+    def test_keys_without_static_part(self):
+        class PerValue(SplitLists):
+            # the base static_key: has_key is checked for every field
+            static_key = MetricTransformationBase.static_key
+
+        data = {
+            "encodingPath": "path/here",
+            "node_id": "router",
+            "keys": {},
+            "content": {"a": [{"name": "x"}, {"name": "y"}], "b": 1},
+        }
+        static = transformation_factory("split_lists", {"split_lists": ["path/here/a"]})
+        dynamic = PerValue(static.data_per_path)
+        assert [m.data for m in dynamic.transform_batch([InternalMetric(data)])] == [
+            m.data for m in static.transform_batch([InternalMetric(data)])
+        ]
+        assert dynamic.get_plan("path/here").children["a"][1] is None
+
+    def test_trie_caches_are_bounded(self):
+        trie = CacheCharTrie({"a/b": True, "a/c": True}, cache_size=2)
+        for path in ["a", "a/b", "a/c", "a/d", "a"]:
+            trie.has_node(path)
+        stats = trie.cache_node.stats()
+        assert stats["size"] == 2
+        assert stats["misses"] == 5
+        assert stats["evictions"] == 3
+        assert "a/b" in trie
+        assert "a/b" in trie
+        assert trie.cache_item.hits == 1
+        # changes in the trie invalidate the caches
+        trie["a/d"] = True
+        assert len(trie.cache_item) == 0
+        assert trie.has_node("a/d")
+
+    def test_change_only(self):
+        now = [0]
+        config = {"change_only": {"paths": {"state": ["oper_status"], "all": None}, "heartbeat": 60}}
+        transformation = transformation_factory("change_only", config)
+        transformation.clock = lambda: now[0]
+
+        def metric(path, content, keys=None):
+            return InternalMetric(
+                {"encodingPath": path, "node_id": "r1", "keys": keys or {"if": "eth0"}, "content": content}
+            )
+
+        def exported(metrics):
+            return len(transformation.transform_batch(metrics))
+
+        assert exported([metric("state", {"oper_status": "UP", "rate": 1})]) == 1
+        # only oper_status is compared for state
+        assert exported([metric("state", {"oper_status": "UP", "rate": 2})]) == 0
+        assert exported([metric("state", {"oper_status": "UP"}, {"if": "eth1"})]) == 1
+        assert exported([metric("state", {"oper_status": "DOWN"})]) == 1
+        assert exported([metric("all", {"a": 1}), metric("all", {"a": 1})]) == 1
+        assert exported([metric("all", {"a": 2})]) == 1
+        assert exported([metric("other", {"a": 2}), metric("other", {"a": 2})]) == 2
+        # heartbeat
+        now[0] = 61
+        assert exported([metric("all", {"a": 2})]) == 1
+        assert exported([metric("all", {"a": 2})]) == 0
+
+    def test_window_aggregation(self):
+        config = {
+            "window_aggregation": {
+                "window": 60,
+                "paths": {"counters": {"in_octets": ["rate", "max"], "errors": ["sum", "min", "last"]}},
+            }
+        }
+        transformation = transformation_factory("window_aggregation", config)
+
+        def metric(timestamp, content, node="r1"):
+            return InternalMetric(
+                {"encodingPath": "counters", "node_id": node, "timestamp": timestamp, "keys": {"if": "eth0"}, "content": content}
+            )
+
+        first_window = [
+            metric(60000, {"in_octets": 100, "errors": 2, "name": "a"}),
+            metric(70000, {"in_octets": 300, "errors": 1}),
+            metric(110000, {"in_octets": 600, "errors": 3, "name": "b"}),
+        ]
+        assert transformation.transform_batch(first_window) == []
+        other = metric(0, {"a": 1}).replace(path="other")
+        # a late metric is dropped, other paths pass through
+        assert transformation.transform_batch([metric(50000, {"in_octets": 1}), other]) == [other]
+        assert transformation.late == 1
+
+        result = transformation.transform_batch([metric(120000, {"in_octets": 700, "errors": 0})])
+        assert len(result) == 1
+        assert result[0].content == {
+            "in_octets": 600,
+            "errors": 3,
+            "name": "b",
+            "in_octets_rate": 10.0,
+            "in_octets_max": 600,
+            "errors_sum": 6,
+            "errors_min": 1,
+            "errors_last": 3,
+        }
+        # a series that stopped is closed when the metrics are two windows ahead
+        assert transformation.transform_batch([metric(180000, {"in_octets": 1}, "r2")]) == []
+        result = transformation.transform_batch([metric(240000, {"in_octets": 1}, "r3")])
+        assert [m.node for m in result] == ["r1"]
+        assert sorted(m.node for m in transformation.flush()) == ["r2", "r3"]
+
+    def test_window_aggregation_expire_and_bound(self):
+        now = [0]
+        config = {"window_aggregation": {"window": 60, "max_series": 10, "paths": {"counters": {"in_octets": ["max"]}}}}
+        transformation = transformation_factory("window_aggregation", config)
+        transformation.clock = lambda: now[0]
+
+        def metric(timestamp, interface):
+            return InternalMetric(
+                {"encodingPath": "counters", "node_id": "r1", "timestamp": timestamp, "keys": {"if": interface}, "content": {"in_octets": 1}}
+            )
+
+        assert transformation.transform_batch([metric(60000, "eth0"), metric(70000, "eth1")]) == []
+        # windows are closed by the clock when no metric comes
+        now[0] = 150
+        assert transformation.expire() == []
+        now[0] = 180
+        assert sorted(m.keys["if"] for m in transformation.expire()) == ["eth0", "eth1"]
+        assert transformation.windows == {}
+
+        # the oldest windows are closed early when there are too many
+        closed = transformation.transform_batch([metric(180000 + n, f"if{n}") for n in range(10)])
+        assert closed == []
+        closed = transformation.transform_batch([metric(240000, "if10")])
+        assert [m.keys["if"] for m in closed] == ["if0"]
+        assert len(transformation.windows) == 10
+        assert transformation.evicted == 1
+
+    def test_pipeline_flush_goes_through_later_transformations(self):
+        config = {
+            "pipeline": {
+                "window_aggregation": {"window": 60, "paths": {"counters": {"in_octets": ["max"]}}},
+                "filter": ["counters"],
+            }
+        }
+        transformation = transformation_factory("pipeline", config)
+        data = {"encodingPath": "counters", "node_id": "r1", "timestamp": 0, "keys": {}, "content": {"in_octets": 1}}
+        assert transformation.transform_batch([InternalMetric(data)]) == []
+        # the closed window is dropped by the filter
+        assert transformation.flush() == []
+
+    def test_counter_rate(self, tmp_path):
+        snapshot_file = str(tmp_path / "counters.json")
+        config = {"counter_rate": {"paths": {"counters": ["in_octets", "out_octets"]}, "snapshot_file": snapshot_file}}
+        transformation = transformation_factory("counter_rate", config)
+
+        def rates(timestamp, content):
+            data = {"encodingPath": "counters", "node_id": "r1", "timestamp": timestamp, "keys": {"if": "eth0"}, "content": content}
+            [result] = transformation.transform_batch([InternalMetric(data)])
+            return {name: value for name, value in result.content.items() if name.endswith("_rate")}
+
+        assert rates(0, {"in_octets": 1000, "out_octets": 2 ** 64 - 100, "last_clear": "a"}) == {}
+        assert rates(10000, {"in_octets": 2000, "out_octets": 900, "last_clear": "a"}) == {
+            "in_octets_rate": 100.0,
+            "out_octets_rate": 100.0,
+        }
+        # without the counter width, a high counter going down is a reset
+        assert rates(20000, {"in_octets": 2 ** 32 - 1000, "last_clear": "a"}) == {"in_octets_rate": (2 ** 32 - 3000) / 10}
+        assert rates(30000, {"in_octets": 1000, "last_clear": "a"}) == {}
+        # a low counter going down was reset, as is any change of last_clear
+        assert rates(40000, {"in_octets": 10, "last_clear": "a"}) == {}
+        assert rates(50000, {"in_octets": 20, "last_clear": "b"}) == {}
+
+        # the state survives a restart
+        transformation.save()
+        transformation = transformation_factory("counter_rate", config)
+        assert rates(60000, {"in_octets": 620, "last_clear": "b"}) == {"in_octets_rate": 60.0}
+
+    def test_counter_rate_width_and_eviction(self):
+        config = {"counter_rate": {"paths": {"counters": ["in_octets"]}, "counter_bits": 32, "max_series": 10}}
+        transformation = transformation_factory("counter_rate", config)
+
+        def rates(timestamp, value, interface="eth0"):
+            data = {
+                "encodingPath": "counters",
+                "node_id": "r1",
+                "timestamp": timestamp,
+                "keys": {"if": interface},
+                "content": {"in_octets": value},
+            }
+            [result] = transformation.transform_batch([InternalMetric(data)])
+            return result.content.get("in_octets_rate")
+
+        assert rates(0, 2 ** 32 - 1000) is None
+        # 32 bits wrap
+        assert rates(10000, 1000) == 200.0
+        # above the counter width, it is not a wrap
+        assert rates(20000, 2 ** 33) == (2 ** 33 - 1000) / 10
+        assert rates(30000, 10) is None
+
+        table = transformation.tables["counters"]
+        for n in range(20):
+            rates(40000 + n, n, f"if{n}")
+        assert len(table.rows) <= 10
+        # the rows of the evicted series are reused
+        assert len(table.times) == 10
+        assert rates(50000, 10, "eth0") is None
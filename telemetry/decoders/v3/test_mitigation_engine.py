@@ -0,0 +1,158 @@
+import pytest
+import copy
+import importlib.util
+from mitigation_engine import MitigationEngine, KeyNormalizer
+
+RULES_FILE = "config_files/mitigation_rules.json"
+
+
+def load_legacy_mitigation():
+    spec = importlib.util.spec_from_file_location("mitigation", "config_files/mitigation.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+HUAWEI_RECORD = {
+    "collector": {
+        "grpc": {"grpcPeer": "10.0.0.1", "ne_vendor": "Huawei"},
+        "data": {
+            "sensor_path": "openconfig-interfaces:interfaces/interface/state/counters",
+            "node_id_str": "router-1",
+            "subscription_id_str": "sub",
+            "msg_timestamp": "1548319798831",
+            "collection_timestamp": 1548319798900,
+            "encoding_type": 2,
+            "not-needed": "x",
+        },
+    },
+    "interface": [
+        {
+            "name": "Eth0",
+            "state": {
+                "ifindex": 0,
+                "admin-status": 1,
+                "counters": {"in-octets": "10", "last-clear": "2019-01-08T12:53:02Z"},
+            },
+        },
+        {
+            "name": "Eth1",
+            "state": {
+                "ifindex": 3,
+                "admin-status": 1,
+                "oper-status": 7,
+                "last-change": "1234567890",
+                "counters": {
+                    "in-pkts": "18446744073709551615",
+                    "out-pkts": "not a number",
+                    "last-clear": "never",
+                },
+            },
+            "subinterfaces": {
+                "subinterface": [
+                    {
+                        "index": 0,
+                        "state": {
+                            "ifindex": 5,
+                            "admin-status": 2,
+                            "oper-status": 5,
+                            "last-change": "2019-01-08T12:53:02Z",
+                            "counters": {"in-octets": "5", "last-clear": 7},
+                        },
+                    }
+                ]
+            },
+        },
+    ],
+}
+
+CISCO_RECORD = {
+    "collector": {
+        "grpc": {"grpcPeer": "10.0.0.2", "ne_vendor": "Cisco"},
+        "data": {
+            "encoding_path": "openconfig-interfaces:interfaces",
+            "node_id_str": "router-2",
+            "collection_id": 3007,
+            "collection_start_time": "1548319798741",
+            "collection_end_time": 1548319798771,
+        },
+    },
+    "interfaces": {
+        "interface": {
+            "name": "Gi0/0/0/0",
+            "state": {
+                "last-change": "2019-01-08T12:53:02Z",
+                "counters": {"in-octets": "595769", "last-clear": "2019-01-08T12:53:02Z"},
+            },
+            "subinterfaces": {
+                "subinterface": {"index": 0, "state": {"counters": {"out-octets": "1"}}}
+            },
+        }
+    },
+}
+
+CISCO_OTHER_RECORD = {
+    "collector": {
+        "grpc": {"grpcPeer": "10.0.0.2", "ne_vendor": "Cisco"},
+        "data": {"encoding_path": "Cisco-IOS-XR-infra-statsd-oper:infra-statistics", "node_id_str": "r"},
+    },
+    "infra-statistics": {"some-counter": "1", "list-of": [{"a-b": 1}]},
+}
+
+NO_VENDOR_RECORD = {"collector": {"data": {"encoding_path": "a-b"}}, "a-b": 1}
+
+
+class TestMitigationEngine:
+    @pytest.mark.parametrize(
+        "record", [HUAWEI_RECORD, CISCO_RECORD, CISCO_OTHER_RECORD, NO_VENDOR_RECORD]
+    )
+    def test_rules_match_legacy_mitigation(self, record):
+        legacy = load_legacy_mitigation()
+        engine = MitigationEngine.from_file(RULES_FILE)
+        original = copy.deepcopy(record)
+        # twice, the second time the plan is cached
+        for _ in range(2):
+            result = engine.apply(record)
+            assert record == original
+            assert result == legacy.mod_all_json_data(copy.deepcopy(record))
+
+    def test_owned_records_are_changed_in_place(self):
+        engine = MitigationEngine.from_file(RULES_FILE)
+        record = copy.deepcopy(HUAWEI_RECORD)
+        expected = engine.apply(record)
+        assert engine.apply(record, owned=True) is record
+        assert record == expected
+
+    def test_key_normalizer(self):
+        normalizer = KeyNormalizer(maxsize=2)
+        clean = {"a": 1, "b": [{"c": 2}]}
+        record = {"x-y": clean, "z": [{"d-e": 1}, {"d-e": 2}]}
+        original = copy.deepcopy(record)
+        copied = normalizer.normalize(record)
+        assert copied == {"x_y": {"a": 1, "b": [{"c": 2}]}, "z": [{"d_e": 1}, {"d_e": 2}]}
+        assert record == original
+        assert normalizer.normalize(record, owned=True) is record
+        assert record == copied
+        # clean dicts are not rebuilt
+        assert record["x_y"] is clean
+        assert normalizer.stats()["resets"] > 0
+
+    def test_invalid_rules(self):
+        with pytest.raises(Exception) as excinfo:
+            MitigationEngine({"rules": [{"name": "bad", "action": "explode"}]})
+        assert "action must be one of" in str(excinfo.value)
+        with pytest.raises(Exception) as excinfo:
+            MitigationEngine(
+                {
+                    "rules": [
+                        {
+                            "name": "bad",
+                            "select": "collector/data",
+                            "action": "rename",
+                            "from": "node_id_str",
+                            "to": "encoding_path",
+                        }
+                    ]
+                }
+            )
+        assert "can be renamed" in str(excinfo.value)
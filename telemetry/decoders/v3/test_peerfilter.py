@@ -0,0 +1,40 @@
+import pytest
+from peerfilter import PeerFilter, parse_peer
+
+
+@pytest.mark.parametrize(
+    "peer,expected",
+    [
+        ("ipv4:10.215.133.23:57775", ("ipv4", "10.215.133.23", "57775")),
+        ("ipv6:[2001:db8::1]:57775", ("ipv6", "2001:db8::1", "57775")),
+        ("ipv6:%5B2001:db8::1%5D:57775", ("ipv6", "2001:db8::1", "57775")),
+        ("unix:/tmp/socket", ("unix", "/tmp/socket", "")),
+    ],
+)
+def test_parse_peer(peer, expected):
+    assert parse_peer(peer) == expected
+
+
+def test_longest_prefix():
+    peer_filter = PeerFilter(
+        allow="10.0.0.0/8, 192.168.1.0/24, 2001:db8::/32",
+        deny=["10.1.0.0/16", "2001:db8:1::/48"],
+    )
+    assert peer_filter.accept("10.2.3.4")
+    assert not peer_filter.accept("10.1.3.4")
+    assert peer_filter.accept("192.168.1.200")
+    assert not peer_filter.accept("192.168.2.1")
+    assert peer_filter.accept("2001:db8:2::1")
+    assert not peer_filter.accept("2001:db8:1::1")
+    assert peer_filter.accept("::ffff:10.2.3.4")
+    assert not peer_filter.accept("/tmp/socket")
+    assert peer_filter.rejected == 4
+
+
+def test_more_specific_allow_and_deny_only():
+    peer_filter = PeerFilter(allow=["10.1.2.3/32"], deny=["10.0.0.0/8"])
+    assert peer_filter.accept("10.1.2.3")
+    assert not peer_filter.accept("10.1.2.4")
+    peer_filter = PeerFilter(deny=["10.0.0.0/8"])
+    assert peer_filter.accept("172.16.0.1")
+    assert not peer_filter.accept("10.0.0.1")
@@ -0,0 +1,87 @@
+import pytest
+from prefilter import PreFilter, scan_header, HEADER_FIELDS, HeaderError
+
+
+def varint(value):
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+
+def string_field(number, value):
+    value = value.encode()
+    return varint(number << 3 | 2) + varint(len(value)) + value
+
+
+def cisco_message(path, node="r1"):
+    return b"".join(
+        [
+            string_field(1, node),
+            string_field(3, "sub1"),
+            string_field(6, path),
+            # collection_id and msg_timestamp (varints)
+            varint(8 << 3) + varint(300),
+            varint(10 << 3) + varint(1577836800000),
+            # data_gpbkv, not parsed
+            string_field(11, "x" * 200),
+        ]
+    )
+
+
+def huawei_message(path, node="r2"):
+    return b"".join(
+        [
+            string_field(1, node),
+            string_field(2, "sub2"),
+            string_field(3, path),
+            varint(6 << 3) + varint(1577836800000),
+            string_field(7, "rows"),
+        ]
+    )
+
+
+def test_scan_header():
+    assert scan_header(cisco_message("openconfig-interfaces:interfaces"), HEADER_FIELDS["cisco"]) == {
+        "node_id": "r1",
+        "subscription_id": "sub1",
+        "path": "openconfig-interfaces:interfaces",
+    }
+    assert scan_header(huawei_message("huawei-ifm:ifm/interfaces"), HEADER_FIELDS["huawei"]) == {
+        "node_id": "r2",
+        "subscription_id": "sub2",
+        "path": "huawei-ifm:ifm/interfaces",
+    }
+    # the header can come after the payload
+    message = string_field(11, "payload") + string_field(6, "a:b")
+    assert scan_header(message, {6: "path"}) == {"path": "a:b"}
+    with pytest.raises(HeaderError):
+        scan_header(cisco_message("a:b")[:-10], {6: "path", 99: "never"})
+
+
+def test_prefilter_rules():
+    prefilter = PreFilter(
+        deny=["Cisco-IOS-XR-wdsysmon-fd-oper:*"],
+        deny_nodes=["lab-*"],
+        sample={"Cisco-IOS-XR-infra-statsd-oper:*": 3},
+    )
+    assert prefilter.accept("cisco", cisco_message("openconfig-interfaces:interfaces"))
+    assert not prefilter.accept("cisco", cisco_message("Cisco-IOS-XR-wdsysmon-fd-oper:system-monitoring"))
+    assert not prefilter.accept("huawei", huawei_message("huawei-ifm:ifm", node="lab-1"))
+    sampled = [prefilter.accept("cisco", cisco_message("Cisco-IOS-XR-infra-statsd-oper:infra")) for _ in range(6)]
+    assert sampled == [True, False, False, True, False, False]
+    # unreadable headers are left to the decoder
+    assert prefilter.accept("cisco", b"\xff")
+    assert (prefilter.accepted, prefilter.dropped) == (3, 6)
+
+
+def test_prefilter_allow_and_openconfig():
+    prefilter = PreFilter(allow=["openconfig-*", "huawei-*"], only_openconfig=True)
+    assert prefilter.accept("cisco", cisco_message("openconfig-interfaces:interfaces"))
+    assert not prefilter.accept("huawei", huawei_message("huawei-ifm:ifm"))
+    assert not prefilter.accept("cisco", cisco_message("Cisco-IOS-XR-openconfig-x:y"))
@@ -0,0 +1,72 @@
+import os
+import pytest
+from kafka_modules.topic_router import TopicRouter, load_topics_file
+
+CONFIG_FILES = os.path.join(os.path.dirname(__file__), "config_files")
+
+
+def test_rule_precedence():
+    router = TopicRouter(
+        "default",
+        {
+            "Cisco-IOS-XR-ipv4-bgp-oper:bgp/instances": "exact",
+            "Cisco-IOS-XR-ipv4-bgp-oper:*": "bgp",
+            "Cisco-IOS-XR-ipv4-bgp-oper:bgp/*": "bgp_long",
+            "*:interfaces/*": "interfaces",
+            "*:interfaces/interface": "never",
+        },
+    )
+    assert len(router) == 5
+    assert router.topic("Cisco-IOS-XR-ipv4-bgp-oper:bgp/instances") == "exact"
+    assert router.topic("Cisco-IOS-XR-ipv4-bgp-oper:bgp/instances/instance") == "bgp_long"
+    assert router.topic("Cisco-IOS-XR-ipv4-bgp-oper:other") == "bgp"
+    # patterns in order
+    assert router.topic("openconfig-interfaces:interfaces/interface") == "interfaces"
+    assert router.topic("openconfig-bgp:bgp") == "default"
+    assert router.topic(None) == "default"
+
+
+def test_derived_topics():
+    router = TopicRouter(
+        "default",
+        {"openconfig-*:*": "oc.{module}", "*": "telemetry.{path}"},
+    )
+    assert router.topic("openconfig-interfaces:interfaces/interface") == "oc.openconfig-interfaces"
+    assert router.topic("Cisco-IOS-XR-ipv4-bgp-oper:bgp/instances") == "telemetry.Cisco-IOS-XR-ipv4-bgp-oper.bgp.instances"
+    with pytest.raises(Exception):
+        TopicRouter("default", {"*": "telemetry.{unknown}"})
+
+
+def test_cached_topics():
+    router = TopicRouter("default", {"a*": "a"})
+    for _ in range(3):
+        assert router.topic("abc") == "a"
+    stats = router.cache.stats()
+    assert (stats["hits"], stats["misses"]) == (2, 1)
+
+
+def test_topics_file():
+    topics = load_topics_file(os.path.join(CONFIG_FILES, "kafka_topics.json"))
+    router = TopicRouter("myproject.prod.device-metric-raw", topics)
+    assert router.topic("Cisco-IOS-XR-ipv4-bgp-oper:bgp") == "myproject.prod.device-metric-bgp"
+    assert router.topic("openconfig-interfaces:interfaces") == "myproject.prod.device-metric-openconfig-interfaces"
+    # no fallback in the example, other paths go to the default topic
+    assert router.topic("Cisco-IOS-XR-qos-ma-oper:qos") == "myproject.prod.device-metric-raw"
+
+
+def test_exporter_routes_both_entry_points(monkeypatch):
+    pytest.importorskip("confluent_kafka")
+    from export_pmgrpcd import ExportData
+    from kafka_modules import kafka_simple_exporter
+
+    # no broker, nothing is produced
+    monkeypatch.setattr(kafka_simple_exporter, "Producer", lambda config: None)
+    exporter = kafka_simple_exporter.KafkaExporter("localhost:9092", "default", {"openconfig-interfaces:*": "interfaces"})
+    sent = []
+    monkeypatch.setattr(exporter, "send", lambda text, topic=None: sent.append(topic))
+    for key in ("encoding_path", "sensor_path", "encodingPath"):
+        data = {"collector": {"data": {key: "openconfig-interfaces:interfaces"}}}
+        exporter.export(ExportData(dictdata=data))
+        exporter.process_metric(ExportData(dictdata=data).json())
+    exporter.process_metric(ExportData(dictdata={"collector": {"data": {}}}).json())
+    assert sent == ["interfaces"] * 6 + ["default"]
@@ -0,0 +1,64 @@
+import types
+import ujson as json
+import pytest
+import lib_pmgrpcd
+import tracing
+from tracing import StageTracer
+
+
+@pytest.fixture
+def tracer(monkeypatch):
+    tracer = StageTracer(3, buffer_size=2)
+    monkeypatch.setattr(tracing, "TRACER", tracer)
+    return tracer
+
+
+def trace_message(peer, rows=0):
+    tracing.start_trace(peer)
+    tracing.annotate(msg_timestamp="1000", encoding_path="a/b")
+    tracing.mark("decode")
+    for _ in range(rows):
+        tracing.mark("decode_row")
+        tracing.mark("exporter:zmq")
+    tracing.finish_trace()
+
+
+def test_sampling_and_eviction(tracer):
+    for n in range(7):
+        trace_message(f"10.0.0.{n}")
+    # messages 0, 3 and 6 are sampled, the buffer keeps the last two
+    traces = tracer.snapshot()
+    assert [trace["trace_id"] for trace in traces] == [3, 6]
+    assert [trace["peer"] for trace in traces] == ["10.0.0.3", "10.0.0.6"]
+    assert traces[0]["msg_timestamp"] == 1000
+    assert traces[0]["encoding_path"] == "a/b"
+
+
+def test_marks_are_aggregated_per_stage(tracer):
+    trace_message("10.0.0.1", rows=1000)
+    (trace,) = tracer.snapshot()
+    assert [stage["stage"] for stage in trace["stages"]] == ["receive", "decode", "decode_row", "exporter:zmq"]
+    assert [stage["count"] for stage in trace["stages"]] == [1, 1, 1000, 1000]
+    assert trace["router_delay"] > 0
+
+
+def test_not_sampled_is_not_traced(tracer):
+    trace_message("10.0.0.0")
+    trace_message("10.0.0.1")
+    tracing.mark("decode")
+    assert len(tracer.snapshot()) == 1
+
+
+def test_usr2_dump(tracer, tmp_path, monkeypatch):
+    dump_file = tmp_path / "traces.json"
+    monkeypatch.setattr(lib_pmgrpcd, "OPTIONS", types.SimpleNamespace(trace_dump_file=str(dump_file)))
+    trace_message("10.0.0.1", rows=2)
+    lib_pmgrpcd.signalhandler(12, None)
+    traces = json.loads(dump_file.read_text())
+    assert len(traces) == 1
+    assert traces[0]["stages"][-1] == {
+        "stage": "exporter:zmq",
+        "time": traces[0]["stages"][-1]["time"],
+        "count": 2,
+        "elapsed": traces[0]["stages"][-1]["elapsed"],
+    }
@@ -0,0 +1,82 @@
+import os
+import time
+import ujson as json
+from encoders.base import InternalMetric
+from transformation_workers import TransformationWorkers
+
+
+def metric(timestamp, path, value):
+    return InternalMetric(
+        {
+            "encodingPath": path,
+            "node_id": "r1",
+            "timestamp": timestamp,
+            "keys": {"if": "eth0"},
+            "content": {"in_octets": value},
+            "grpcPeer": "10.0.0.1",
+        }
+    )
+
+
+def write_transformations(tmp_path, snapshot_file):
+    file_transformations = tmp_path / "transformations.json"
+    file_transformations.write_text(
+        json.dumps(
+            {
+                "pipeline": {
+                    "counter_rate": {
+                        "paths": {"a": ["in_octets"], "b": ["in_octets"]},
+                        "snapshot_file": snapshot_file,
+                    }
+                }
+            }
+        )
+    )
+    return str(file_transformations)
+
+
+def test_submit_through_workers(tmp_path):
+    snapshot_file = str(tmp_path / "counters.json")
+    exported = []
+    workers = TransformationWorkers(write_transformations(tmp_path, snapshot_file), 2, exported.append)
+    workers.start()
+    for path in ("a", "b"):
+        workers.submit([metric(0, path, 100)])
+        workers.submit([metric(10000, path, 200)])
+    workers.stop()
+
+    assert len(exported) == 4
+    rates = {data["encodingPath"]: data["content"].get("in_octets_rate") for data in exported if data["timestamp"]}
+    assert rates == {"a": 10.0, "b": 10.0}
+    # the extra entries of the metric survive the workers
+    assert all(data["grpcPeer"] == "10.0.0.1" for data in exported)
+    # every worker saved its own snapshot when it was stopped
+    assert sorted(os.listdir(tmp_path)) == ["counters.json.0", "counters.json.1", "transformations.json"]
+    assert not os.path.exists(snapshot_file)
+
+
+def test_dead_worker(tmp_path):
+    exported = []
+    workers = TransformationWorkers(
+        write_transformations(tmp_path, str(tmp_path / "counters.json")),
+        2,
+        exported.append,
+        queue_size=1,
+        stop_seconds=5,
+    )
+    workers.start()
+    dead = workers.workers[workers.shard(None, "a")]
+    dead.kill()
+    dead.join()
+    # the metrics of the dead worker are dropped, submit does not block on its full queue
+    for timestamp in range(3):
+        workers.submit([metric(timestamp, "a", 100)])
+    assert workers.stats() == {"dropped": 3, "dead_workers": 1}
+
+    alive_path = next(path for path in "bcdefgh" if workers.shard(None, path) != workers.shard(None, "a"))
+    workers.submit([metric(0, alive_path, 100)])
+    started = time.time()
+    workers.stop()
+    assert time.time() - started < 5
+    assert not workers.exporter.is_alive()
+    assert [data["encodingPath"] for data in exported] == [alive_path]
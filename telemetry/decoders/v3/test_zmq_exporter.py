@@ -0,0 +1,86 @@
+import itertools
+import time
+import pytest
+
+zmq = pytest.importorskip("zmq")
+
+import caching
+from export_pmgrpcd import ExportData
+from zmq_modules.zmq_exporter import ZmqExporter
+
+ADDRESSES = (f"inproc://test-zmq-exporter-{n}" for n in itertools.count())
+
+
+def message(path, n=0):
+    return ExportData(dictdata={"collector": {"data": {"encoding_path": path}}, "n": n})
+
+
+def connect(exporter, address, socket_type, subscribe=None):
+    socket = zmq.Context.instance().socket(socket_type)
+    socket.setsockopt(zmq.RCVTIMEO, 2000)
+    if subscribe is not None:
+        socket.setsockopt(zmq.SUBSCRIBE, subscribe)
+    socket.connect(address)
+    return socket
+
+
+@pytest.fixture
+def exporters():
+    created = []
+
+    def create(*args, **kargs):
+        address = next(ADDRESSES)
+        exporter = ZmqExporter(address, *args, **kargs)
+        created.append(exporter)
+        return exporter, address
+
+    yield create
+    for exporter in created:
+        exporter.close()
+
+
+def test_push_batches(exporters):
+    exporter, address = exporters("push", batch_size=3, flush_seconds=60)
+    consumer = connect(exporter, address, zmq.PULL)
+    for n in range(4):
+        exporter.export(message("a/b", n))
+    frames = consumer.recv_multipart()
+    assert [b'"n":%d' % n in frame for n, frame in enumerate(frames)] == [True] * 3
+    assert exporter.stats() == {"sent": 3, "dropped": 0, "buffered": 1}
+    consumer.close()
+
+
+def test_timer_flushes_partial_batches(exporters):
+    exporter, address = exporters("push", batch_size=100, flush_seconds=0.1)
+    consumer = connect(exporter, address, zmq.PULL)
+    exporter.export(message("a/b"))
+    assert len(consumer.recv_multipart()) == 1
+    assert exporter.stats()["buffered"] == 0
+    consumer.close()
+
+
+def test_pub_topic_frames(exporters):
+    exporter, address = exporters("pub", batch_size=2, flush_seconds=60)
+    subscriber = connect(exporter, address, zmq.SUB, subscribe=b"openconfig")
+    # subscriptions are asynchronous
+    time.sleep(0.2)
+    for path in ("openconfig-interfaces:interfaces", "Cisco-IOS-XR-qos-ma-oper:qos") * 2:
+        exporter.export(message(path))
+    frames = subscriber.recv_multipart()
+    assert frames[0] == b"openconfig-interfaces:interfaces"
+    assert len(frames) == 3
+    # the other path was sent, but not to this subscriber
+    assert exporter.stats()["sent"] == 4
+    subscriber.setsockopt(zmq.RCVTIMEO, 200)
+    with pytest.raises(zmq.Again):
+        subscriber.recv_multipart()
+    subscriber.close()
+
+
+def test_push_drops_are_counted(exporters):
+    exporter, _ = exporters("push", sndhwm=1)
+    # no consumer connected, push sends fail right away
+    for n in range(3):
+        exporter.export(message("a/b", n))
+    assert exporter.stats() == {"sent": 0, "dropped": 3, "buffered": 0}
+    assert caching.caches_stats()["zmq_exporter"]["dropped"] >= 3
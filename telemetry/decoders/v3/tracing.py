@@ -0,0 +1,180 @@
+#
+#   pmacct (Promiscuous mode IP Accounting package)
+#   pmacct is Copyright (C) 2003-2019 by Paolo Lucente
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+#   pmgrpcd and its components are Copyright (C) 2018-2019 by:
+#
+#   Matthias Arnold <matthias.arnold@swisscom.com>
+#   Juan Camilo Cardona <jccardona82@gmail.com>
+#   Thomas Graf <thomas.graf@swisscom.com>
+#   Paolo Lucente <paolo@pmacct.net>
+#
+"""
+Per message stage tracing.
+
+When enabled, one in every N gRPC messages is followed through the collector.
+Every stage (receive, decode, mitigation, transformation and each exporter)
+marks the time (epoch in milliseconds) at which it finished, and the time
+since the previous mark is spent on that stage. Stages that run once per row
+(decode_row, mitigation, transformation, exporters) are marked many times per
+message, so a trace keeps a single entry per stage, with the number of marks
+(rows) and the total time. The router msg_timestamp is kept together with the
+marks, which gives the delay between the router and the collector.
+
+A message is processed end to end by the gRPC thread that received it, so the
+trace in flight is kept in a thread local. Finished traces go to a ring buffer
+that can be dumped as json (see signalhandler in lib_pmgrpcd).
+"""
+import collections
+import itertools
+import threading
+import time
+import ujson as json
+
+# None means tracing is disabled. It is set up by config.configure.
+TRACER = None
+
+_CURRENT = threading.local()
+
+
+def now_ms():
+    return time.time() * 1000
+
+
+class MessageTrace:
+    __slots__ = ("trace_id", "peer", "msg_timestamp", "encoding_path", "started", "last", "stages")
+
+    def __init__(self, trace_id, peer):
+        self.trace_id = trace_id
+        self.peer = peer
+        self.msg_timestamp = None
+        self.encoding_path = None
+        self.started = None
+        self.last = None
+        # stage -> [time of the last mark, marks, total elapsed], in the order they were first marked
+        self.stages = {}
+
+    def mark(self, stage):
+        mark_time = now_ms()
+        elapsed = 0 if self.last is None else mark_time - self.last
+        if self.started is None:
+            self.started = mark_time
+        self.last = mark_time
+        entry = self.stages.get(stage)
+        if entry is None:
+            self.stages[stage] = [mark_time, 1, elapsed]
+        else:
+            entry[0] = mark_time
+            entry[1] += 1
+            entry[2] += elapsed
+
+    def to_dict(self):
+        stages = [
+            {"stage": stage, "time": mark_time, "count": count, "elapsed": elapsed}
+            for stage, (mark_time, count, elapsed) in self.stages.items()
+        ]
+        router_delay = None
+        if self.msg_timestamp is not None and self.started is not None:
+            router_delay = self.started - self.msg_timestamp
+        return {
+            "trace_id": self.trace_id,
+            "peer": self.peer,
+            "msg_timestamp": self.msg_timestamp,
+            "encoding_path": self.encoding_path,
+            "router_delay": router_delay,
+            "stages": stages,
+        }
+
+
+class StageTracer:
+    """
+    Samples messages and keeps the last buffer_size finished traces.
+    """
+
+    def __init__(self, sample_rate, buffer_size=1000):
+        if sample_rate < 1:
+            raise Exception(f"Trace sample rate must be at least 1, got {sample_rate}")
+        self.sample_rate = sample_rate
+        self.traces = collections.deque(maxlen=buffer_size)
+        # next() over itertools.count is atomic in CPython, no lock needed.
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def start(self, peer):
+        n = next(self._counter)
+        if n % self.sample_rate:
+            _CURRENT.trace = None
+            return None
+        trace = MessageTrace(n, peer)
+        trace.mark("receive")
+        _CURRENT.trace = trace
+        return trace
+
+    def finish(self):
+        trace = getattr(_CURRENT, "trace", None)
+        if trace is None:
+            return
+        _CURRENT.trace = None
+        with self._lock:
+            self.traces.append(trace)
+
+    def snapshot(self):
+        with self._lock:
+            traces = list(self.traces)
+        return [trace.to_dict() for trace in traces]
+
+    def dump(self, filename):
+        traces = self.snapshot()
+        with open(filename, "w") as fh:
+            fh.write(json.dumps(traces))
+        return len(traces)
+
+
+# The next functions are the ones used in the processing path. They do nothing
+# (besides a global lookup) when tracing is disabled or the message was not sampled.
+
+
+def start_trace(peer):
+    if TRACER is None:
+        return
+    TRACER.start(peer)
+
+
+def finish_trace():
+    if TRACER is None:
+        return
+    TRACER.finish()
+
+
+def mark(stage):
+    trace = getattr(_CURRENT, "trace", None)
+    if trace is None:
+        return
+    trace.mark(stage)
+
+
+def annotate(msg_timestamp=None, encoding_path=None):
+    trace = getattr(_CURRENT, "trace", None)
+    if trace is None:
+        return
+    if msg_timestamp is not None:
+        try:
+            trace.msg_timestamp = int(msg_timestamp)
+        except (TypeError, ValueError):
+            pass
+    if encoding_path is not None:
+        trace.encoding_path = encoding_path
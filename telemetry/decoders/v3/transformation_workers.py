@@ -0,0 +1,242 @@
+#
+#   pmacct (Promiscuous mode IP Accounting package)
+#   pmacct is Copyright (C) 2003-2019 by Paolo Lucente
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+#   pmgrpcd and its components are Copyright (C) 2018-2019 by:
+#
+#   Matthias Arnold <matthias.arnold@swisscom.com>
+#   Juan Camilo Cardona <jccardona82@gmail.com>
+#   Thomas Graf <thomas.graf@swisscom.com>
+#   Paolo Lucente <paolo@pmacct.net>
+#
+"""
+Transformation worker processes.
+
+Decoded metrics are sent to a pool of worker processes, chosen by a hash of the
+encoding path (or node and encoding path). Every worker loads its own
+transformations, so the compiled plans and trie caches of a path stay warm in
+a single process, and expensive paths do not hold the gRPC threads or the GIL
+of the collector. The results come back on a queue, and an exporter thread
+in the collector sends them to the exporters.
+
+The transformations, and the state of the stateful ones, only live in the
+workers. Each worker writes its own snapshot files (with the worker number as
+suffix), and flushes its transformation when it is stopped, since atexit does
+not run in the worker processes.
+
+A worker that dies is not restarted: the metrics of its paths are dropped (and
+counted) instead of blocking the gRPC threads, and stop does not wait for it.
+"""
+import multiprocessing
+import queue
+import threading
+import time
+import zlib
+from caching import register_cache
+from lib_pmgrpcd import PMGRPCDLOG
+
+SHARD_BY = ("path", "node_path")
+# seconds between the calls to the expire of the transformation of a worker
+EXPIRE_SECONDS = 1
+# seconds a put waits on a full queue before checking that the worker is alive
+PUT_SECONDS = 1
+# A warning is logged every time this many more metrics are dropped.
+DROPPED_LOG_EVERY = 1000
+
+
+def worker_main(n_worker, file_transformations, trie_cache_size, in_queue, out_queue):
+    """
+    Runs in the worker process. Receives lists of metric data (one per message),
+    and returns the data of the transformed metrics.
+    """
+    # imported here, the process is started with spawn
+    import transformations
+    from encoders.base import InternalMetric
+
+    transformations.TRIE_CACHE_SIZE = trie_cache_size
+    transformations.SNAPSHOT_SUFFIX = f".{n_worker}"
+    transformation = transformations.load_transformtions_from_file(file_transformations)[0]
+    next_expire = time.time() + EXPIRE_SECONDS
+    while True:
+        try:
+            batch = in_queue.get(timeout=EXPIRE_SECONDS)
+        except queue.Empty:
+            batch = []
+        if batch is None:
+            break
+        try:
+            metrics = [InternalMetric(data) for data in batch]
+            results = [metric.data for metric in transformation.transform_batch(metrics)]
+            if time.time() >= next_expire:
+                next_expire = time.time() + EXPIRE_SECONDS
+                results.extend(metric.data for metric in transformation.expire())
+        except Exception as e:
+            out_queue.put(("error", str(e)))
+            continue
+        if results:
+            out_queue.put(("ok", results))
+    try:
+        out_queue.put(("ok", [metric.data for metric in transformation.flush()]))
+    except Exception as e:
+        out_queue.put(("error", str(e)))
+    out_queue.put(("stopped", n_worker))
+
+
+class TransformationWorkers:
+    # stats are reported by caching.caches_stats under this name
+    name = "transformation_workers"
+
+    def __init__(
+        self,
+        file_transformations,
+        n_workers,
+        export_function,
+        shard_by="path",
+        trie_cache_size=10000,
+        queue_size=1000,
+        stop_seconds=30,
+    ):
+        if n_workers < 1:
+            raise Exception(f"Transformation workers must be at least 1, got {n_workers}")
+        if shard_by not in SHARD_BY:
+            raise Exception(f"Transformation shard must be one of {SHARD_BY}, got {shard_by}")
+        self.shard_by = shard_by
+        self.export_function = export_function
+        self.stop_seconds = stop_seconds
+        self.dropped = 0
+        # submit is called from the gRPC threads, the lock only covers dropped.
+        self.lock = threading.Lock()
+        context = multiprocessing.get_context("spawn")
+        # bounded, so the gRPC threads wait when the workers are behind.
+        self.in_queues = [context.Queue(queue_size) for _ in range(n_workers)]
+        self.out_queue = context.Queue(queue_size)
+        self.workers = [
+            context.Process(
+                target=worker_main,
+                args=(n, file_transformations, trie_cache_size, in_queue, self.out_queue),
+                name=f"transformation-worker-{n}",
+                daemon=True,
+            )
+            for n, in_queue in enumerate(self.in_queues)
+        ]
+        self.exporter = threading.Thread(
+            target=self.export_results, name="transformation-exporter", daemon=True
+        )
+        self.started = False
+        register_cache(self)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        self.exporter.start()
+        self.started = True
+
+    def shard(self, node, path):
+        key = path if self.shard_by == "path" else f"{node}/{path}"
+        return zlib.crc32(key.encode()) % len(self.in_queues)
+
+    def submit(self, metrics):
+        """
+        Sends the metrics of one message to the worker of their path.
+        """
+        if not metrics:
+            return
+        first = metrics[0]
+        try:
+            node = first.node
+        except Exception:
+            node = None
+        n_worker = self.shard(node, first.path)
+        if self.put(n_worker, [metric.data for metric in metrics]):
+            return
+        with self.lock:
+            before = self.dropped
+            self.dropped += len(metrics)
+            if before // DROPPED_LOG_EVERY != self.dropped // DROPPED_LOG_EVERY or not before:
+                PMGRPCDLOG.warning(
+                    "Transformation worker %s is dead: dropped %s metrics so far",
+                    n_worker,
+                    self.dropped,
+                )
+
+    def put(self, n_worker, item, deadline=None):
+        """
+        Puts item in the queue of a worker, waiting while the queue is full.
+        False if the worker is dead (or the deadline passed).
+        """
+        while self.workers[n_worker].is_alive():
+            if deadline is not None and time.time() >= deadline:
+                return False
+            try:
+                self.in_queues[n_worker].put(item, timeout=PUT_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def stats(self):
+        dead = sum(1 for worker in self.workers if self.started and not worker.is_alive())
+        return {"dropped": self.dropped, "dead_workers": dead}
+
+    def export_results(self):
+        stopped = set()
+        while len(stopped) < len(self.workers):
+            try:
+                status, results = self.out_queue.get(timeout=EXPIRE_SECONDS)
+            except queue.Empty:
+                # the queue is empty, so a dead worker has nothing left in it
+                for n_worker, worker in enumerate(self.workers):
+                    if n_worker not in stopped and not worker.is_alive():
+                        PMGRPCDLOG.error(
+                            "Transformation worker %s died (exit code %s)", n_worker, worker.exitcode
+                        )
+                        stopped.add(n_worker)
+                continue
+            if status == "stopped":
+                stopped.add(results)
+                continue
+            if status == "error":
+                PMGRPCDLOG.error("Error in transformation worker: %s", results)
+                continue
+            for data in results:
+                try:
+                    self.export_function(data)
+                except Exception as e:
+                    PMGRPCDLOG.error("Error exporting transformed metric: %s", e)
+
+    def stop(self):
+        """
+        Stops the workers, after they transform what is in their queues and flush
+        their transformations, and waits until the results are exported. Workers
+        that do not stop in stop_seconds are terminated.
+        """
+        if not self.started:
+            return
+        deadline = time.time() + self.stop_seconds
+        for n_worker in range(len(self.workers)):
+            self.put(n_worker, None, deadline)
+        for n_worker, worker in enumerate(self.workers):
+            worker.join(max(deadline - time.time(), 0))
+            if worker.is_alive():
+                PMGRPCDLOG.error("Transformation worker %s did not stop, terminating it", n_worker)
+                worker.terminate()
+                worker.join(EXPIRE_SECONDS)
+        # a terminated worker is noticed after EXPIRE_SECONDS without results
+        self.exporter.join(max(deadline - time.time(), 2 * EXPIRE_SECONDS))
+        if self.exporter.is_alive():
+            PMGRPCDLOG.error("Transformation results were not all exported")
+        self.started = False
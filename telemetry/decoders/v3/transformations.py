@@ -1,44 +1,79 @@
-from encoders.base import ValueField, Field, InternalMetric, MetricExceptionBase
+from encoders.base import ValueField, Field, InternalMetric, MetricExceptionBase, GetData
 from typing import Iterable, Sequence, Dict, Union, Any, Generator, Tuple
 from abc import ABC, abstractmethod
 from enum import Flag, auto
 import ujson as json
+from array import array
+import atexit
+import heapq
+import os
+import threading
+import time
 from pygtrie import CharTrie
+from caching import LRUCache, DEFAULT_CACHE_SIZE
+from columnar import to_columns, MetricColumns
 
 RANGE_NUMERS = [str(x) for x in range(0, 100)]
 HIERARCHICAL_TYPES = (dict, list)
 
-# TODO: First try to use caching in a trie, since this domites
-# some tests. More work is needed
-# key here was to cache __contains__
+# Size of each of the lookup caches of a CacheCharTrie. Set up by config.configure
+# before the transformations are loaded.
+TRIE_CACHE_SIZE = DEFAULT_CACHE_SIZE
+
+# Added to the snapshot files of the stateful transformations. Each transformation
+# worker sets its own (see transformation_workers), so they do not overwrite each
+# other's snapshot.
+SNAPSHOT_SUFFIX = ""
+
+# Lookups in the tries dominate the transformations, so they are cached.
+# Field paths can include variable components, so the caches are bounded.
+# The tries are shared by the gRPC threads, LRUCache takes care of the locking.
 class CacheCharTrie(CharTrie):
-    def __init__(self, *args, **kargs):
+    def __init__(self, *args, cache_size=None, **kargs):
+        if cache_size is None:
+            cache_size = TRIE_CACHE_SIZE
+        self.cache = LRUCache(cache_size, "trie_get_node")
+        self.cache_node = LRUCache(cache_size, "trie_has_node")
+        self.cache_item = LRUCache(cache_size, "trie_contains")
         super().__init__(*args, **kargs)
-        self.cache_node = {}
-        self.cache = {}
-        self.cache_item = {}
         self.complain = False
 
-    def _get_node(self, key, *args, **kargs):
-        if key in self.cache:
-            return self.cache[key]
-        value = super()._get_node(key, *args, **kargs)
-        self.cache[key] = value
+    def _clear_caches(self):
+        self.cache.clear()
+        self.cache_node.clear()
+        self.cache_item.clear()
+
+    # Anything that changes the trie invalidates the caches.
+    def _set_node(self, *args, **kargs):
+        node = super()._set_node(*args, **kargs)
+        self._clear_caches()
+        return node
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._clear_caches()
+
+    def pop(self, *args, **kargs):
+        value = super().pop(*args, **kargs)
+        self._clear_caches()
         return value
 
+    def merge(self, *args, **kargs):
+        super().merge(*args, **kargs)
+        self._clear_caches()
+
+    def clear(self):
+        super().clear()
+        self._clear_caches()
+
+    def _get_node(self, key):
+        return self.cache.get_or_compute(key, super()._get_node)
+
     def has_node(self, key):
-        if key in self.cache_node:
-            return self.cache_node[key]
-        value = super().has_node(key)
-        self.cache_node[key] = value
-        return value
+        return self.cache_node.get_or_compute(key, super().has_node)
 
     def __contains__(self, key):
-        if key in self.cache_item:
-            return self.cache_item[key]
-        value = super().__contains__(key)
-        self.cache_item[key] = value
-        return value
+        return self.cache_item.get_or_compute(key, super().__contains__)
 
 def get_trie(config, key):
     paths = config[key]
@@ -50,6 +85,56 @@ def get_trie(config, key):
     extra_keys_trie.update(paths)
     return extra_keys_trie
 
+def trie_child_names(trie, path):
+    """
+    Names of the fields under path that lead to a configured path in the trie.
+    The path of a child is formed with form_encoding_path, so we do the same here.
+    """
+    if path and path[-1] == "/":
+        path = path[:-1]
+    prefix = path + "/" if path else ""
+    try:
+        keys = list(trie.iterkeys(prefix=prefix))
+    except KeyError:
+        return set()
+    names = set()
+    for key in keys:
+        name = key[len(prefix):].split("/", 1)[0]
+        if name:
+            names.add(name)
+    return names
+
+
+class PathPlan:
+    """
+    Compiled view of what a transformation does with the fields under a path.
+    children maps the field names under path that the transformation touches
+    to (child path, has_key, key state), has_key being None if it depends on the
+    value of the field (see static_key). Other fields are never joined into a
+    path nor looked up, unless the transformation inspects all hierarchies
+    (e.g. flattening everything), in which case only lists and dicts are.
+    """
+
+    __slots__ = ("path", "covered", "children", "inspect_hierarchies", "_child_paths")
+
+    def __init__(self, path, covered, children, inspect_hierarchies):
+        self.path = path
+        self.covered = covered
+        self.children = children
+        self.inspect_hierarchies = inspect_hierarchies
+        self._child_paths = {}
+
+    def child_path(self, name):
+        child = self.children.get(name)
+        if child is not None:
+            return child[0]
+        n_path = self._child_paths.get(name)
+        if n_path is None:
+            n_path = InternalMetric.form_encoding_path(self.path, [name])
+            self._child_paths[name] = n_path
+        return n_path
+
+
 def transformation_factory(key, data):
     transformation = None
     if "extra_keys" in key:
@@ -109,6 +194,12 @@ def transformation_factory(key, data):
                 raise Exception(f"Ilelgal key {skey} in combine_series")
             transformations.append(stransformation)
         transformation = CombineContentTransformation(transformations)
+    if "change_only" in key:
+        transformation = ChangeOnly(**data[key])
+    if "window_aggregation" in key:
+        transformation = WindowAggregation(**data[key])
+    if "counter_rate" in key:
+        transformation = CounterRate(**data[key])
     if "pipeline" in key:
         config = data[key]
         transformations = []
@@ -141,6 +232,8 @@ class MetricTransformationBase(ABC):
     def __init__(self, data_per_path):
         self.data_per_path = data_per_path
         self._warning = None
+        # field names can be variable, so the plans are bounded like the trie caches
+        self._plans = LRUCache(TRIE_CACHE_SIZE, "transformation_plans")
 
     def set_warning_function(self, warning_function):
         self._warning = warning_function
@@ -162,6 +255,50 @@ class MetricTransformationBase(ABC):
     def transform(self, metric) -> Sequence["InternalMetric"]:
         pass
 
+    def get_plan(self, path) -> PathPlan:
+        """
+        Returns the plan for a path, compiling it the first time the path is seen.
+        """
+        return self._plans.get_or_compute(path, self.compile_plan)
+
+    def batch_plan(self, path, plans) -> PathPlan:
+        """
+        get_plan through plans, a dict local to a batch (or a metric), so the
+        shared cache is only used once per path of the batch. Plans are kept per
+        transformation, since combined transformations share the dict.
+        """
+        key = (self, path)
+        plan = plans.get(key)
+        if plan is None:
+            plan = plans[key] = self.get_plan(path)
+        return plan
+
+    def compile_plan(self, path) -> PathPlan:
+        covered = bool(self.has_node(path))
+        children = {}
+        if covered:
+            for name in self.child_names(path):
+                n_path = InternalMetric.form_encoding_path(path, [name])
+                has_key, state = self.static_key(n_path, name)
+                children[name] = (n_path, has_key, state)
+        return PathPlan(path, covered, children, self.inspects_hierarchies())
+
+    def child_names(self, path):
+        return trie_child_names(self.data_per_path, path)
+
+    def inspects_hierarchies(self) -> bool:
+        """
+        True if every list or dict must be checked, independently of its path.
+        """
+        return False
+
+    def static_key(self, path, key):
+        """
+        has_key for a field, for the part that only depends on its path. None (the
+        default) if it also depends on the value, has_key is then called for every field.
+        """
+        return (None, None)
+
     def transform_list(self, generator):
         """
         Takes a generator of metrics and transforms. It keeps the value in case one needs
@@ -172,6 +309,35 @@ class MetricTransformationBase(ABC):
             yield from self.transform(metric)
         return generagtor_with_return.value
 
+    def transform_batch(self, metrics: Iterable[InternalMetric]) -> Sequence[InternalMetric]:
+        """
+        Transforms a batch of metrics (e.g. all rows of a message) at once.
+        """
+        transformed = []
+        for metric in metrics:
+            transformed.extend(self.transform(metric))
+        return transformed
+
+    def transform_columns(self, metrics: Iterable[InternalMetric]) -> Dict[str, MetricColumns]:
+        """
+        Transforms a batch of metrics, returning the results as columns per encoding path.
+        """
+        return to_columns(self.transform_batch(metrics))
+
+    def flush(self) -> Sequence[InternalMetric]:
+        """
+        Called on shutdown. Returns the metrics the transformation still holds, and
+        saves its state, if it keeps one.
+        """
+        return []
+
+    def expire(self) -> Sequence[InternalMetric]:
+        """
+        Called every second or so. Returns the metrics the transformation releases
+        because of the time passed, not because of new metrics.
+        """
+        return []
+
 
 class TransformationPerEncodingPath(MetricTransformationBase):
     """
@@ -190,6 +356,38 @@ class TransformationPerEncodingPath(MetricTransformationBase):
         else:
             yield metric
 
+    def transform_batch(self, metrics):
+        """
+        Consecutive metrics with the same transformation (e.g. the rows of a message)
+        are passed on as one batch, keeping the order.
+        """
+        transformed = []
+        run, run_transformation = [], None
+        for metric in metrics:
+            transformation = self.transformation_per_path.get(metric.path, self.default)
+            if run and transformation is not run_transformation:
+                transformed.extend(run_transformation.transform_batch(run) if run_transformation else run)
+                run = []
+            run.append(metric)
+            run_transformation = transformation
+        if run:
+            transformed.extend(run_transformation.transform_batch(run) if run_transformation else run)
+        return transformed
+
+    def flush(self):
+        flushed = []
+        for transformation in [*self.transformation_per_path.values(), self.default]:
+            if transformation:
+                flushed.extend(transformation.flush())
+        return flushed
+
+    def expire(self):
+        expired = []
+        for transformation in [*self.transformation_per_path.values(), self.default]:
+            if transformation:
+                expired.extend(transformation.expire())
+        return expired
+
 
 class FilterMetric(MetricTransformationBase):
     """
@@ -240,21 +438,41 @@ class ContentTransformation(MetricTransformationBase):
             return (True, path)
         return (False, path)
 
+    def static_key(self, path, key):
+        return self.has_key(path, key, None)
+
+    def inspects_hierarchies(self):
+        return self.options.value > 0
+
     def transform(self, metric):
-        fields = self._transform_contents(metric, metric.content, metric.path)
-        yield metric.replace(content=fields)
+        yield self._transform_metric(metric, {})
+
+    def transform_batch(self, metrics):
+        """
+        The plans are resolved once per path of the batch, not once per metric.
+        """
+        plans = {}
+        return [self._transform_metric(metric, plans) for metric in metrics]
+
+    def _transform_metric(self, metric, plans):
+        content = metric.content
+        fields = self._transform_contents(metric, content, metric.path, plans)
+        if fields is content:
+            return metric
+        return metric.replace(content=fields)
 
     def _transform_contents(
-        self, metric, fields: Union[Sequence[Field], Field], path: str
+        self, metric, fields: Union[Sequence[Field], Field], path: str, plans
     ):
         """
-        This function is a generator that also returns values.
-        The return includes the new set of fields, and a bool marking whether
-        the fields changed from the input.
+        Returns the transformed fields. The input is never modified, and it is
+        returned as is when nothing changed, so unchanged hierarchies are shared
+        with the original metric. Only the dicts and lists on the way to a change are copied.
         """
 
         # if the path is not included just return
-        if not self.has_node(path):
+        plan = self.batch_plan(path, plans)
+        if not plan.covered:
             return fields
 
         # if we are in a list, we check one by one the elements and create a new list with
@@ -263,27 +481,44 @@ class ContentTransformation(MetricTransformationBase):
             if not self.transform_list_elements:
                 return fields
             nlist = []
+            changed = False
             for field in fields:
                 if not isinstance(field, HIERARCHICAL_TYPES):
                     nlist.append(field)
                     continue
-                ncontents = self._transform_contents(metric, field, path)
+                ncontents = self._transform_contents(metric, field, path, plans)
+                if ncontents is not field:
+                    changed = True
                 if ncontents:
                     nlist.append(ncontents)
             # nothing else to do
+            if not changed:
+                return fields
             return nlist
 
         # from here, fields is a "field"
         new_keys = {}
         key_state = {}
         fields_with_children = {}
-        fields = fields.copy()
 
         # we go over the fields, checking whether we have a new key.
-        # We add them all at the end
-        for fname, fcontent in fields.items():
-            n_path = metric.form_encoding_path(path, [fname])
-            has_key, state = self.has_key(n_path, fname, fcontent)
+        # We add them all at the end. Only the fields in the plan are checked,
+        # unless we need to look at every hierarchy.
+        if plan.inspect_hierarchies:
+            candidates = list(fields.items())
+        else:
+            candidates = [(x, fields[x]) for x in plan.children if x in fields]
+        for fname, fcontent in candidates:
+            hierarchical = isinstance(fcontent, HIERARCHICAL_TYPES)
+            child = plan.children.get(fname)
+            if child is not None and child[1] is not None and not (plan.inspect_hierarchies and hierarchical):
+                n_path, has_key, state = child
+            elif hierarchical or child is not None:
+                n_path = plan.child_path(fname)
+                has_key, state = self.has_key(n_path, fname, fcontent)
+            else:
+                # a value field that no configured path touches
+                continue
             if has_key:
                 # we are in a new key here.
                 # we dont even check for type of content.
@@ -291,25 +526,35 @@ class ContentTransformation(MetricTransformationBase):
                 new_keys[fname] = fcontent
                 key_state[fname] = state
 
-            if isinstance(fcontent, HIERARCHICAL_TYPES):
+            if hierarchical:
                 fields_with_children[fname] = n_path
 
         # first convert the children
-        if fields_with_children:
-            # if we have children, this means we have children
-            # lists or composed fields.
-            for fname, n_path in fields_with_children.items():
-                fcontent = fields[fname]
-                # if there is no content we ignore.
-                if not fcontent:
-                    continue
-                # we yield all internal keys, then we replace
-                # the value if there was any change.
-                ncontents = self._transform_contents(metric, fcontent, n_path)
-                fields.pop(fname, None)
-                # not write the new field if empty
-                if ncontents:
-                    fields[fname] = ncontents
+        new_children = []
+        changed = bool(new_keys)
+        for fname, n_path in fields_with_children.items():
+            fcontent = fields[fname]
+            # if there is no content we ignore.
+            if not fcontent:
+                continue
+            ncontents = self._transform_contents(metric, fcontent, n_path, plans)
+            if ncontents is not fcontent:
+                changed = True
+            new_children.append((fname, ncontents))
+
+        if not changed:
+            return fields
+
+        # the children are placed at the end of the field, as they always were
+        # (this shows when the field is later converted to a string).
+        # transform_content copies the fields by itself.
+        if new_children:
+            fields = fields.copy()
+        for fname, ncontents in new_children:
+            fields.pop(fname, None)
+            # not write the new field if empty
+            if ncontents:
+                fields[fname] = ncontents
 
         # now convert the fields, only if there are matches.
         if new_keys:
@@ -402,6 +647,35 @@ class TransformationPipeline(MetricTransformationBase):
             gen = trf.transform_list(gen)
         yield from gen
 
+    def transform_batch(self, metrics):
+        """
+        Each transformation goes over the whole batch before the next one starts,
+        instead of chaining generators per metric.
+        """
+        batch = list(metrics)
+        for trf in self.transformations:
+            batch = trf.transform_batch(batch)
+        return batch
+
+    def flush(self):
+        """
+        The metrics flushed by a transformation go through the next ones.
+        """
+        flushed = []
+        for trf in self.transformations:
+            if flushed:
+                flushed = trf.transform_batch(flushed)
+            flushed.extend(trf.flush())
+        return flushed
+
+    def expire(self):
+        expired = []
+        for trf in self.transformations:
+            if expired:
+                expired = trf.transform_batch(expired)
+            expired.extend(trf.expire())
+        return expired
+
 
 class KeysFlattenOverlap(MetricExceptionBase):
     pass
@@ -545,6 +819,15 @@ class CombineContentTransformation(ContentTransformation):
                 global_state[n] = state
         return (global_has_key, global_state)
 
+    def child_names(self, path):
+        names = set()
+        for t in self.transformations:
+            names.update(t.child_names(path))
+        return names
+
+    def inspects_hierarchies(self):
+        return any(t.inspects_hierarchies() for t in self.transformations)
+
     def transform_content(self, metric, fields, path, new_keys, key_state):
         new_fields = fields.copy()
         # we need to do a conversion here, which is a pity
@@ -651,7 +934,20 @@ class MetricSpliting(MetricTransformationBase):
     """
 
     def transform(self, metric):
-        fields, changed = yield from self._split(metric, metric.content, metric.path)
+        yield from self._transform_metric(metric, {})
+
+    def transform_batch(self, metrics):
+        """
+        The plans are resolved once per path of the batch, not once per metric.
+        """
+        plans = {}
+        transformed = []
+        for metric in metrics:
+            transformed.extend(self._transform_metric(metric, plans))
+        return transformed
+
+    def _transform_metric(self, metric, plans):
+        fields, changed = yield from self._split(metric, metric.content, metric.path, plans)
         if changed:
             if fields:
                 yield metric.replace(content=fields)
@@ -670,11 +966,14 @@ class MetricSpliting(MetricTransformationBase):
         """
         return (path in self.data_per_path, path)
 
+    def static_key(self, path, key):
+        return self.has_key(path)
+
     @abstractmethod
-    def split(self, metric, fields, path, keys, key_state) -> Sequence[InternalMetric]:
+    def split(self, metric, fields, path, keys, key_state, plans) -> Sequence[InternalMetric]:
         pass
 
-    def _split(self, metric, fields: Union[Sequence[Field], Field], path: str):
+    def _split(self, metric, fields: Union[Sequence[Field], Field], path: str, plans):
         """
         This function is a generator that also returns values.
         The return includes the new set of fields, and a bool marking whether
@@ -683,7 +982,8 @@ class MetricSpliting(MetricTransformationBase):
         changed = False
 
         # if the path is not included just return
-        if not self.has_node(path):
+        plan = self.batch_plan(path, plans)
+        if not plan.covered:
             return fields, changed
 
         # if we are in a list, we check one by one the elements and create a new list with
@@ -691,7 +991,7 @@ class MetricSpliting(MetricTransformationBase):
         if isinstance(fields, list):
             nlist = []
             for field in fields:
-                ncontents, cchanged = yield from self._split(metric, field, path)
+                ncontents, cchanged = yield from self._split(metric, field, path, plans)
                 if cchanged:
                     changed = True
                 if ncontents:
@@ -703,13 +1003,16 @@ class MetricSpliting(MetricTransformationBase):
         new_keys = {}
         key_state = {}
         fields_with_children = {}
-        fields = fields.copy()
+        original = fields
 
-        # we go over the fields, checking whether we have a new key.
+        # we go over the fields in the plan, checking whether we have a new key.
         # We add them all at the end
-        for fname, fcontent in fields.items():
-            n_path = metric.form_encoding_path(path, [fname])
-            has_key, state = self.has_key(n_path)
+        for fname, (n_path, has_key, state) in plan.children.items():
+            if fname not in fields:
+                continue
+            fcontent = fields[fname]
+            if has_key is None:
+                has_key, state = self.has_key(n_path)
             if has_key:
                 # we are in a new key here.
                 # we dont even check for type of content.
@@ -724,8 +1027,9 @@ class MetricSpliting(MetricTransformationBase):
         # anything new from the new metric (we ignore the fields_with_children
         if new_keys:
             # we need to split the metric here.
+            # split works on its own copy of the fields, since it removes the keys
             new_content, changed = yield from self.split(
-                metric, fields, path, new_keys, key_state
+                metric, fields.copy(), path, new_keys, key_state, plans
             )
             # we return empty.
             return new_content, changed
@@ -740,9 +1044,11 @@ class MetricSpliting(MetricTransformationBase):
                     continue
                 # we yield all internal splits, then we replace
                 # the value if there was any change.
-                ncontents, cchanged = yield from self._split(metric, fcontent, n_path)
+                ncontents, cchanged = yield from self._split(metric, fcontent, n_path, plans)
                 if cchanged:
                     changed = True
+                    if fields is original:
+                        fields = fields.copy()
                     fields.pop(fname, None)
                     # not write the new field if empty
                     if ncontents:
@@ -752,7 +1058,7 @@ class MetricSpliting(MetricTransformationBase):
 
 
 class ExtraKeysTransformation(MetricSpliting):
-    def split(self, metric, fields, path, new_keys, key_state):
+    def split(self, metric, fields, path, new_keys, key_state, plans):
         current_keys = metric.keys
         new_keys = metric.add_keys(current_keys, new_keys)
         current_content = fields
@@ -760,7 +1066,7 @@ class ExtraKeysTransformation(MetricSpliting):
             current_content.pop(key, None)
         new_metric = metric.replace(content=current_content, keys=new_keys, path=path)
         # now, we need to apply the change also here
-        yield from self.transform(new_metric)
+        yield from self._transform_metric(new_metric, plans)
         return {}, True
 
 
@@ -769,7 +1075,7 @@ class NotAList(MetricExceptionBase):
 
 
 class SplitLists(MetricSpliting):
-    def split(self, metric, fields, path, new_keys, key_state):
+    def split(self, metric, fields, path, new_keys, key_state, plans):
         current_content = fields
         for key in new_keys:
             kpath = key_state[key]
@@ -783,7 +1089,7 @@ class SplitLists(MetricSpliting):
                 continue
             for element in elements:
                 new_metric = metric.replace(content=element, path=kpath)
-                yield from self.transform(new_metric)
+                yield from self._transform_metric(new_metric, plans)
         return current_content, True
 
 
@@ -794,6 +1100,7 @@ class CombineTransformationSeries(MetricSpliting):
     """
 
     def __init__(self, transformations: Sequence["MetricSplit"]):
+        super().__init__(None)
         self.transformations = transformations
 
     def set_warning_function(self, warning_function):
@@ -820,7 +1127,13 @@ class CombineTransformationSeries(MetricSpliting):
                 return (True, (n, state))
         return (False, (None, None))
 
-    def split(self, metric, fields, path, keys, key_state) -> Sequence[InternalMetric]:
+    def child_names(self, path):
+        names = set()
+        for t in self.transformations:
+            names.update(t.child_names(path))
+        return names
+
+    def split(self, metric, fields, path, keys, key_state, plans) -> Sequence[InternalMetric]:
         # here we apply only the first operation
         state_per_transform = {}
         for key, (n, state) in key_state.items():
@@ -829,11 +1142,488 @@ class CombineTransformationSeries(MetricSpliting):
         state = state_per_transform[min_n]
         keys_content = {x: y for x, y in keys.items() if x in state}
         value = yield from self.transform_list(
-            self.transformations[min_n].split(metric, fields, path, keys_content, state)
+            self.transformations[min_n].split(metric, fields, path, keys_content, state, plans)
         )
         return value
 
 
+def series_key(metric):
+    """
+    Identifies the series of a metric: node, path and keys.
+    """
+    try:
+        node = metric.node
+    except GetData:
+        node = None
+    return (node, metric.path, json.dumps(metric.keys, sort_keys=True))
+
+
+def event_time(metric, timestamp_scale, clock):
+    """
+    Timestamp of a metric, or the current time (in the same units) if it has none.
+    """
+    try:
+        timestamp = metric.timestamp
+    except GetData:
+        timestamp = None
+    if isinstance(timestamp, (int, float)):
+        return timestamp
+    return clock() * timestamp_scale
+
+
+class ChangeOnly(MetricTransformationBase):
+    """
+    Drops metrics whose content did not change since the last one exported for the
+    same series (node, path and keys). A metric is still exported every heartbeat
+    seconds. paths maps encoding paths to the fields compared (null compares the
+    whole content). Metrics of other paths are not touched.
+    The last values are kept in a bounded LRU cache, a series evicted from it
+    is exported again with its next metric.
+    """
+
+    def __init__(self, paths, heartbeat=300, cache_size=100000, clock=time.time):
+        super().__init__(paths)
+        self.heartbeat = heartbeat
+        self.clock = clock
+        self.last_values = LRUCache(cache_size, "change_only")
+
+    def transform(self, metric):
+        path = metric.path
+        if path not in self.data_per_path:
+            yield metric
+            return
+        fields = self.data_per_path[path]
+        content = metric.content
+        if fields is None:
+            value = content
+        else:
+            value = tuple(content.get(field) for field in fields)
+        series = series_key(metric)
+        now = self.clock()
+        last = self.last_values.get(series)
+        if last is not None:
+            last_value, last_export = last
+            if last_value == value and now - last_export < self.heartbeat:
+                return
+        self.last_values.set(series, (value, now))
+        yield metric
+
+
+AGGREGATION_OPERATIONS = ("last", "min", "max", "sum", "rate")
+
+# Values kept per field for each operation. rate needs the first and the last value.
+_AGGREGATION_SLOTS = {
+    "last": ("last",),
+    "min": ("min",),
+    "max": ("max",),
+    "sum": ("sum",),
+    "rate": ("first", "last"),
+}
+
+
+class InvalidAggregation(MetricExceptionBase):
+    pass
+
+
+class AggregationLayout:
+    """
+    Position of the values of each field in the state of a series of one path.
+    """
+
+    __slots__ = ("operations", "slots", "size")
+
+    def __init__(self, fields):
+        self.operations = []
+        slot_index = {}
+        for field, operations in fields.items():
+            for operation in operations:
+                if operation not in _AGGREGATION_SLOTS:
+                    raise InvalidAggregation(
+                        f"Unknown aggregation {operation} for field {field}",
+                        {"field": field, "operation": operation},
+                    )
+                indexes = []
+                for slot in _AGGREGATION_SLOTS[operation]:
+                    indexes.append(slot_index.setdefault((field, slot), len(slot_index)))
+                self.operations.append((field, operation, indexes))
+        self.slots = [(field, slot, n) for (field, slot), n in slot_index.items()]
+        self.size = len(slot_index)
+
+
+class SeriesWindow:
+    """
+    State of a series in the open window. values is a flat list, see AggregationLayout.
+    """
+
+    __slots__ = ("start", "first_time", "last_time", "values", "metric")
+
+    def __init__(self, start, size):
+        self.start = start
+        self.first_time = None
+        self.last_time = None
+        self.values = [None] * size
+        self.metric = None
+
+
+class WindowAggregation(MetricTransformationBase):
+    """
+    Downsamples metrics over tumbling windows of window seconds, per series (node,
+    path and keys). paths maps encoding paths to {field: [operations]}, with
+    operations from AGGREGATION_OPERATIONS. When a window of a series closes, one
+    metric is exported with the content of the last metric of the window plus
+    the field_operation values. rate is per second, between the first and the
+    last value of the window.
+    Windows follow the metric timestamp (timestamp_scale units per second, the
+    router timestamps are in milliseconds). A window closes with the first metric
+    of the series in a later window, or, for series that stopped, when the
+    metrics of any series or the clock (see expire) are two windows ahead.
+    Metrics older than the open window of their series are dropped. Other paths
+    are not touched.
+    At most max_series windows are open: when there are more, the oldest tenth of
+    them is closed early.
+    """
+
+    def __init__(self, paths, window=60, timestamp_scale=1000, max_series=100000, clock=time.time):
+        super().__init__(paths)
+        if window <= 0:
+            raise Exception(f"Aggregation window must be positive, got {window}")
+        self.window = window * timestamp_scale
+        self.timestamp_scale = timestamp_scale
+        self.clock = clock
+        self.layouts = {path: AggregationLayout(fields) for path, fields in paths.items()}
+        self.max_series = max_series
+        self.windows = {}
+        self.late = 0
+        self.evicted = 0
+        self._swept = None
+        self._lock = threading.Lock()
+
+    def transform(self, metric):
+        path = metric.path
+        layout = self.layouts.get(path)
+        if layout is None:
+            yield metric
+            return
+        timestamp = event_time(metric, self.timestamp_scale, self.clock)
+        start = timestamp - timestamp % self.window
+        series = series_key(metric)
+        closed = []
+        with self._lock:
+            state = self.windows.get(series)
+            if state is not None and state.start != start:
+                if start < state.start:
+                    self.late += 1
+                    return
+                closed.append(state)
+                state = None
+            if state is None:
+                if self.max_series is not None and len(self.windows) >= self.max_series:
+                    closed.extend(self.evict())
+                state = SeriesWindow(start, layout.size)
+                self.windows[series] = state
+            self.update(state, layout, metric, timestamp)
+            if self._swept is None or start > self._swept:
+                self._swept = start
+                closed.extend(self.sweep(start - self.window))
+        for state in closed:
+            yield self.emit(state)
+
+    @staticmethod
+    def update(state, layout, metric, timestamp):
+        content = metric.content
+        values = state.values
+        if state.first_time is None:
+            state.first_time = timestamp
+        state.last_time = timestamp
+        state.metric = metric
+        for field, slot, n in layout.slots:
+            value = content.get(field)
+            if value.__class__ is not int and value.__class__ is not float:
+                continue
+            current = values[n]
+            if slot == "last" or current is None and slot != "sum":
+                values[n] = value
+            elif slot == "min":
+                if value < current:
+                    values[n] = value
+            elif slot == "max":
+                if value > current:
+                    values[n] = value
+            elif slot == "sum":
+                values[n] = value if current is None else current + value
+            # first keeps the first value
+
+    def sweep(self, before):
+        """
+        Removes the windows that started before before, returning them.
+        """
+        closed = [series for series, state in self.windows.items() if state.start < before]
+        return [self.windows.pop(series) for series in closed]
+
+    def evict(self):
+        """
+        Removes the oldest tenth of the windows, returning them.
+        """
+        n_evicted = max(1, len(self.windows) // 10)
+        oldest = heapq.nsmallest(n_evicted, self.windows.items(), key=lambda item: item[1].start)
+        self.evicted += n_evicted
+        return [self.windows.pop(series) for series, _ in oldest]
+
+    def expire(self):
+        """
+        Closes the windows two windows behind the clock, so the last window of the
+        series that stopped is not kept until a later metric comes.
+        """
+        now = self.clock() * self.timestamp_scale
+        with self._lock:
+            closed = self.sweep(now - now % self.window - self.window)
+        return [self.emit(state) for state in closed]
+
+    def flush(self):
+        """
+        Closes all open windows (e.g. on shutdown), returning the aggregated metrics.
+        """
+        with self._lock:
+            closed = list(self.windows.values())
+            self.windows.clear()
+        return [self.emit(state) for state in closed]
+
+    def emit(self, state):
+        metric = state.metric
+        layout = self.layouts[metric.path]
+        values = state.values
+        content = dict(metric.content)
+        for field, operation, indexes in layout.operations:
+            if operation == "rate":
+                first, last = (values[n] for n in indexes)
+                elapsed = (state.last_time - state.first_time) / self.timestamp_scale
+                if first is None or elapsed <= 0:
+                    continue
+                value = (last - first) / elapsed
+            else:
+                value = values[indexes[0]]
+                if value is None:
+                    continue
+            content[f"{field}_{operation}"] = value
+        return metric.replace(content=content)
+
+
+COUNTER32_MAX = 2 ** 32 - 1
+COUNTER64_MAX = 2 ** 64 - 1
+
+
+class CounterTable:
+    """
+    Last values of the counters of one path. Every series has a row, the counters
+    of a row are stored next to each other in an unsigned 64 bits array.
+    With max_series, the least recently updated tenth of the series is evicted
+    when the table is full, and their rows are reused.
+    """
+
+    __slots__ = ("fields", "max_series", "rows", "free", "times", "clears", "values", "valid")
+
+    def __init__(self, fields, max_series=None):
+        self.fields = list(fields)
+        self.max_series = max_series
+        self.rows = {}
+        self.free = []
+        self.times = array("d")
+        self.clears = []
+        self.values = array("Q")
+        self.valid = array("B")
+
+    def row(self, series):
+        row = self.rows.get(series)
+        if row is not None:
+            return row
+        if self.max_series is not None and len(self.rows) >= self.max_series:
+            self.evict()
+        n_fields = len(self.fields)
+        if self.free:
+            row = self.free.pop()
+            self.times[row] = 0
+            self.clears[row] = None
+            base = row * n_fields
+            for position in range(base, base + n_fields):
+                self.valid[position] = 0
+        else:
+            row = len(self.times)
+            self.times.append(0)
+            self.clears.append(None)
+            self.values.extend([0] * n_fields)
+            self.valid.extend([0] * n_fields)
+        self.rows[series] = row
+        return row
+
+    def evict(self):
+        n_evicted = max(1, len(self.rows) // 10)
+        times = self.times
+        oldest = heapq.nsmallest(n_evicted, self.rows.items(), key=lambda item: times[item[1]])
+        for series, row in oldest:
+            del self.rows[series]
+            self.free.append(row)
+
+    def to_dict(self):
+        n_fields = len(self.fields)
+        series = []
+        for key, row in self.rows.items():
+            base = row * n_fields
+            values = [
+                self.values[base + n] if self.valid[base + n] else None for n in range(n_fields)
+            ]
+            series.append([list(key), self.times[row], self.clears[row], values])
+        return {"fields": self.fields, "series": series}
+
+    @classmethod
+    def from_dict(cls, data, max_series=None):
+        table = cls(data["fields"], max_series)
+        n_fields = len(table.fields)
+        for key, timestamp, clear, values in data["series"]:
+            row = table.row(tuple(key))
+            table.times[row] = timestamp
+            table.clears[row] = clear
+            base = row * n_fields
+            for n, value in enumerate(values):
+                if value is not None:
+                    table.values[base + n] = value
+                    table.valid[base + n] = 1
+        return table
+
+
+class CounterRate(MetricTransformationBase):
+    """
+    Adds field_rate (per second) for the counters of the configured paths. paths
+    maps encoding paths to the counter fields.
+    A counter lower than its last value was reset and no rate is computed, unless
+    it wrapped: the last value was in the upper half of the counter range. The
+    range is the one of counter_bits (e.g. 32) if the width of the counters is
+    known, otherwise only 64 bits wraps are detected. A change of reset_field
+    (last_clear) is always a reset.
+    The last values are kept per series (node, path and keys), up to max_series
+    per path. If snapshot_file is set, they are written there every
+    snapshot_seconds, on flush and at exit, and loaded back on start, so a restart
+    does not lose a rate sample. Every transformation worker has its own file,
+    with the worker number as suffix.
+    """
+
+    def __init__(
+        self,
+        paths,
+        timestamp_scale=1000,
+        reset_field="last_clear",
+        snapshot_file=None,
+        snapshot_seconds=60,
+        counter_bits=None,
+        max_series=100000,
+        clock=time.time,
+    ):
+        super().__init__(paths)
+        if counter_bits is not None and not 1 < counter_bits <= 64:
+            raise Exception(f"Counter bits must be between 2 and 64, got {counter_bits}")
+        self.timestamp_scale = timestamp_scale
+        self.reset_field = reset_field
+        if snapshot_file is not None:
+            snapshot_file += SNAPSHOT_SUFFIX
+        self.snapshot_file = snapshot_file
+        self.snapshot_seconds = snapshot_seconds
+        self.counter_max = COUNTER64_MAX if counter_bits is None else 2 ** counter_bits - 1
+        self.max_series = max_series
+        self.clock = clock
+        self.tables = {path: CounterTable(fields, max_series) for path, fields in paths.items()}
+        self._lock = threading.Lock()
+        # a single save at a time
+        self._save_lock = threading.Lock()
+        self._last_snapshot = clock()
+        if snapshot_file is not None:
+            self.load()
+            atexit.register(self.save)
+
+    def wrap_delta(self, last, value):
+        maximum = self.counter_max
+        if maximum // 2 < last <= maximum and value <= maximum:
+            return value + maximum + 1 - last
+        return None
+
+    def transform(self, metric):
+        table = self.tables.get(metric.path)
+        if table is None:
+            yield metric
+            return
+        timestamp = event_time(metric, self.timestamp_scale, self.clock)
+        content = metric.content
+        clear = content.get(self.reset_field)
+        rates = {}
+        with self._lock:
+            row = table.row(series_key(metric))
+            elapsed = (timestamp - table.times[row]) / self.timestamp_scale
+            reset = clear != table.clears[row]
+            table.times[row] = timestamp
+            table.clears[row] = clear
+            base = row * len(table.fields)
+            for n, field in enumerate(table.fields):
+                position = base + n
+                value = content.get(field)
+                if value.__class__ is not int or not 0 <= value <= COUNTER64_MAX:
+                    table.valid[position] = 0
+                    continue
+                if table.valid[position] and not reset and elapsed > 0:
+                    last = table.values[position]
+                    delta = value - last if value >= last else self.wrap_delta(last, value)
+                    if delta is not None:
+                        rates[f"{field}_rate"] = delta / elapsed
+                table.values[position] = value
+                table.valid[position] = 1
+        if self.snapshot_file is not None:
+            self.maybe_save()
+        if rates:
+            new_content = dict(content)
+            new_content.update(rates)
+            metric = metric.replace(content=new_content)
+        yield metric
+
+    def maybe_save(self):
+        now = self.clock()
+        if now - self._last_snapshot < self.snapshot_seconds:
+            return
+        # other threads go on while one of them saves
+        if not self._save_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_snapshot = now
+            self._save()
+        finally:
+            self._save_lock.release()
+
+    def save(self):
+        with self._save_lock:
+            self._save()
+
+    def flush(self):
+        if self.snapshot_file is not None:
+            self.save()
+        return []
+
+    def _save(self):
+        with self._lock:
+            snapshot = {path: table.to_dict() for path, table in self.tables.items()}
+        # unique per writer, so two writers never rename each other's file
+        tmp_file = f"{self.snapshot_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_file, "w") as fh:
+            fh.write(json.dumps(snapshot))
+        os.replace(tmp_file, self.snapshot_file)
+
+    def load(self):
+        if not os.path.exists(self.snapshot_file):
+            return
+        with open(self.snapshot_file) as fh:
+            snapshot = json.loads(fh.read())
+        with self._lock:
+            for path, data in snapshot.items():
+                # a snapshot taken with other fields is ignored for that path
+                if path in self.tables and data["fields"] == self.tables[path].fields:
+                    self.tables[path] = CounterTable.from_dict(data, self.max_series)
+
+
 class MetricWarningDummy(MetricExceptionBase):
     pass
 
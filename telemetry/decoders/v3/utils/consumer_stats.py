@@ -0,0 +1,275 @@
+#
+#   pmacct (Promiscuous mode IP Accounting package)
+#   pmacct is Copyright (C) 2003-2019 by Paolo Lucente
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+#   pmgrpcd and its components are Copyright (C) 2018-2019 by:
+#
+#   Matthias Arnold <matthias.arnold@swisscom.com>
+#   Juan Camilo Cardona <jccardona82@gmail.com>
+#   Thomas Graf <thomas.graf@swisscom.com>
+#   Paolo Lucente <paolo@pmacct.net>
+#
+"""
+Throughput statistics of the consumer tools (zmq_puller.py, kafka_consumer.py),
+used to benchmark the collector.
+
+Every received metric is counted (messages and bytes). Decoded metrics (json
+or avro) are also counted per encoding path, and their end to end latency is
+the time since their collection_timestamp (set by the collector, in ms).
+Decoding errors are counted, the metric is not printed.
+"""
+import io
+import random
+import struct
+import sys
+import time
+import ujson as json
+
+# Latencies kept to compute percentiles (reservoir sampling).
+LATENCY_SAMPLES = 100000
+
+PATH_KEYS = ("encoding_path", "sensor_path", "encodingPath")
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+def metric_info(metric):
+    """
+    (path, collection_timestamp) of a decoded metric.
+    """
+    data = metric.get("collector", {}).get("data", {})
+    path = None
+    for key in PATH_KEYS:
+        if key in data:
+            path = data[key]
+            break
+    return path, data.get("collection_timestamp")
+
+
+def json_decoder(payload):
+    return json.loads(payload)
+
+
+class AvroDecoder:
+    """
+    Decodes the confluent wire format of the kafkaavro exporter (magic byte,
+    schema id and avro record). Schemas are read from the registry once.
+    """
+
+    def __init__(self, registry_url):
+        # only needed for avro
+        from confluent_kafka.avro.cached_schema_registry_client import CachedSchemaRegistryClient
+        import avro.io
+
+        self.avro_io = avro.io
+        self.registry = CachedSchemaRegistryClient(registry_url)
+        self.readers = {}
+
+    def __call__(self, payload):
+        if len(payload) < 5 or payload[0] != 0:
+            raise ValueError("Not an avro message of the schema registry")
+        schema_id = struct.unpack(">I", payload[1:5])[0]
+        reader = self.readers.get(schema_id)
+        if reader is None:
+            schema = self.registry.get_by_id(schema_id)
+            reader = self.readers[schema_id] = self.avro_io.DatumReader(schema)
+        decoder = self.avro_io.BinaryDecoder(io.BytesIO(payload[5:]))
+        return reader.read(decoder)
+
+
+def get_decoder(decode, registry_url=None):
+    if decode == "none":
+        return None
+    if decode == "json":
+        return json_decoder
+    if decode == "avro":
+        if registry_url is None:
+            raise Exception("avro decoding needs the schema registry url")
+        return AvroDecoder(registry_url)
+    raise Exception(f"Unknown decoding {decode}, use none, json or avro")
+
+
+class ConsumerStats:
+    def __init__(self, decoder=None, interval=10, clock=time.time):
+        self.decoder = decoder
+        self.interval = interval
+        self.clock = clock
+        self.started = clock()
+        self.last_report = self.started
+        self.last_messages = 0
+        self.last_bytes = 0
+        self.messages = 0
+        self.bytes = 0
+        self.errors = 0
+        self.per_path = {}
+        self.latency_count = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.latencies = []
+
+    def add_latency(self, latency):
+        self.latency_count += 1
+        self.latency_sum += latency
+        if latency > self.latency_max:
+            self.latency_max = latency
+        if len(self.latencies) < LATENCY_SAMPLES:
+            self.latencies.append(latency)
+        else:
+            index = random.randrange(self.latency_count)
+            if index < LATENCY_SAMPLES:
+                self.latencies[index] = latency
+
+    def add(self, payload, now_ms=None):
+        """
+        Counts a metric (bytes). Returns the decoded metric, None if it was
+        not decoded or is not valid.
+        """
+        self.messages += 1
+        self.bytes += len(payload)
+        if self.decoder is None:
+            return None
+        try:
+            metric = self.decoder(payload)
+        except Exception:
+            self.errors += 1
+            return None
+        if not isinstance(metric, dict):
+            self.errors += 1
+            return None
+        path, collection_timestamp = metric_info(metric)
+        self.per_path[path] = self.per_path.get(path, 0) + 1
+        if collection_timestamp:
+            if now_ms is None:
+                now_ms = self.clock() * 1000
+            self.add_latency(now_ms - collection_timestamp)
+        return metric
+
+    def maybe_report(self):
+        now = self.clock()
+        if now - self.last_report < self.interval:
+            return
+        elapsed = now - self.last_report
+        eprint(
+            "%.0f msg/s %.0f bytes/s, %s messages, %s errors%s"
+            % (
+                (self.messages - self.last_messages) / elapsed,
+                (self.bytes - self.last_bytes) / elapsed,
+                self.messages,
+                self.errors,
+                self.latency_text(),
+            )
+        )
+        self.last_report = now
+        self.last_messages = self.messages
+        self.last_bytes = self.bytes
+
+    def latency_text(self):
+        if not self.latency_count:
+            return ""
+        latency = self.latency_summary()
+        return ", latency ms avg %.1f p50 %.1f p99 %.1f max %.1f" % (
+            latency["avg"],
+            latency["p50"],
+            latency["p99"],
+            latency["max"],
+        )
+
+    def latency_summary(self):
+        if not self.latency_count:
+            return None
+        latencies = sorted(self.latencies)
+
+        def percentile(value):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * value))]
+
+        return {
+            "count": self.latency_count,
+            "avg": self.latency_sum / self.latency_count,
+            "p50": percentile(0.5),
+            "p90": percentile(0.9),
+            "p99": percentile(0.99),
+            "max": self.latency_max,
+        }
+
+    def summary(self):
+        elapsed = max(self.clock() - self.started, 1e-9)
+        return {
+            "seconds": elapsed,
+            "messages": self.messages,
+            "bytes": self.bytes,
+            "messages_per_second": self.messages / elapsed,
+            "bytes_per_second": self.bytes / elapsed,
+            "errors": self.errors,
+            "latency_ms": self.latency_summary(),
+            "per_path": {str(path): count for path, count in self.per_path.items()},
+        }
+
+    def write_summary(self, filename):
+        summary = self.summary()
+        if filename:
+            with open(filename, "w") as fh:
+                fh.write(json.dumps(summary, indent=2, sort_keys=True))
+                fh.write("\n")
+        eprint(
+            "%s messages in %.1f seconds (%.0f msg/s, %.0f bytes/s), %s errors%s"
+            % (
+                summary["messages"],
+                summary["seconds"],
+                summary["messages_per_second"],
+                summary["bytes_per_second"],
+                summary["errors"],
+                self.latency_text(),
+            )
+        )
+        return summary
+
+
+def add_stats_options(parser):
+    parser.add_option(
+        "--decode",
+        default="json",
+        dest="decode",
+        help="Decoding of the metrics for validation, per path counts and latency: json, avro or none.",
+    )
+    parser.add_option(
+        "--quiet",
+        action="store_true",
+        default=False,
+        dest="quiet",
+        help="Do not print the metrics, only the statistics.",
+    )
+    parser.add_option(
+        "--interval",
+        type="float",
+        default=10,
+        dest="interval",
+        help="Seconds between statistics reports (in stderr).",
+    )
+    parser.add_option(
+        "--duration",
+        type="float",
+        default=0,
+        dest="duration",
+        help="Stop after these seconds, 0 runs until interrupted.",
+    )
+    parser.add_option(
+        "--summary_file",
+        dest="summary_file",
+        help="JSON file with the statistics, written at the end.",
+    )
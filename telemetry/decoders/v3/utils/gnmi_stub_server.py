@@ -0,0 +1,111 @@
+# Imitates a gNMI target, to test the gnmi dial-in collection.
+# Every Subscribe stream gets, for each subscribed path, an interface counter
+# (SAMPLE and TARGET_DEFINED) or an oper-status (ON_CHANGE) per interface.
+# Use for testing, e.g.:
+#   PYTHONPATH=protos python utils/gnmi_stub_server.py --port 57400 --interfaces 100
+import argparse
+import asyncio
+import itertools
+import random
+import time
+import grpc
+import ujson as json
+import gnmi_pb2
+import gnmi_pb2_grpc
+
+
+def now_ns():
+    return time.time_ns()
+
+
+class GNMIStub(gnmi_pb2_grpc.gNMIServicer):
+    def __init__(self, interfaces, change_probability):
+        self.interfaces = interfaces
+        self.change_probability = change_probability
+        self.counters = itertools.count(1000)
+
+    async def Capabilities(self, request, context):
+        return gnmi_pb2.CapabilityResponse(
+            supported_encodings=[gnmi_pb2.JSON, gnmi_pb2.JSON_IETF],
+            gNMI_version="0.7.0",
+        )
+
+    def notification(self, subscription, name, value):
+        prefix = gnmi_pb2.Path(origin=subscription.path.origin)
+        prefix.elem.extend(subscription.path.elem[:2])
+        # keep the interface name as key of the interface element
+        if len(prefix.elem) > 1:
+            prefix.elem[-1].key["name"] = name
+        path = gnmi_pb2.Path(elem=subscription.path.elem[2:])
+        return gnmi_pb2.Notification(
+            timestamp=now_ns(),
+            prefix=prefix,
+            update=[gnmi_pb2.Update(path=path, val=value)],
+        )
+
+    def sample(self, subscription):
+        for n in range(self.interfaces):
+            value = gnmi_pb2.TypedValue(
+                json_ietf_val=json.dumps({"in-octets": next(self.counters), "out-octets": next(self.counters)}).encode()
+            )
+            yield self.notification(subscription, f"eth{n}", value)
+
+    def changes(self, subscription, initial):
+        for n in range(self.interfaces):
+            if initial or random.random() < self.change_probability:
+                status = random.choice(["UP", "DOWN"])
+                yield self.notification(subscription, f"eth{n}", gnmi_pb2.TypedValue(string_val=status))
+
+    async def stream(self, subscription, queue):
+        interval = subscription.sample_interval / 1e9 or 1
+        initial = True
+        while True:
+            if subscription.mode == gnmi_pb2.ON_CHANGE:
+                notifications = self.changes(subscription, initial)
+            else:
+                notifications = self.sample(subscription)
+            for notification in notifications:
+                await queue.put(gnmi_pb2.SubscribeResponse(update=notification))
+            if initial:
+                await queue.put(gnmi_pb2.SubscribeResponse(sync_response=True))
+                initial = False
+            await asyncio.sleep(interval)
+
+    async def Subscribe(self, request_iterator, context):
+        request = await request_iterator.__anext__()
+        print(f"Subscription from {context.peer()}: {request}")
+        queue = asyncio.Queue(maxsize=10000)
+        tasks = [
+            asyncio.ensure_future(self.stream(subscription, queue))
+            for subscription in request.subscribe.subscription
+        ]
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+async def serve(port, interfaces, change_probability):
+    server = grpc.aio.server()
+    gnmi_pb2_grpc.add_gNMIServicer_to_server(GNMIStub(interfaces, change_probability), server)
+    server.add_insecure_port(f"[::]:{port}")
+    await server.start()
+    print(f"gNMI stub listening on port {port}")
+    await server.wait_for_termination()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="gNMI stub target")
+    parser.add_argument("--port", type=int, default=57400)
+    parser.add_argument("--interfaces", type=int, default=10, help="interfaces per subscription")
+    parser.add_argument(
+        "--change_probability", type=float, default=0.1, help="probability of an on_change update per interval"
+    )
+    args = parser.parse_args()
+    asyncio.run(serve(args.port, args.interfaces, args.change_probability))
+
+
+if __name__ == "__main__":
+    main()
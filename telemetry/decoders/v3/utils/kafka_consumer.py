@@ -23,9 +23,15 @@
 #   Thomas Graf <thomas.graf@swisscom.com>
 #   Paolo Lucente <paolo@pmacct.net>
 #
+# Consumes the metrics of the kafka exporters, prints them and reports the
+# throughput in stderr. For benchmarking, e.g.:
+#   python utils/kafka_consumer.py -s localhost:9092 -t metrics --quiet --summary_file kafka.json
+#   python utils/kafka_consumer.py -s localhost:9092 -t metrics --decode avro -r http://localhost:8081 --quiet
 from confluent_kafka import Consumer, KafkaError
 import sys
+import time
 from optparse import OptionParser
+from consumer_stats import ConsumerStats, add_stats_options, get_decoder, eprint
 
 parser = OptionParser()
 parser.add_option(
@@ -33,7 +39,7 @@ parser.add_option(
     "--topic",
     #default=str(DEFAULT_TOPIC),
     dest="topic",
-    help="Topic to listen",
+    help="Topic to listen, or comma separated topics",
 )
 parser.add_option(
     "-s",
@@ -42,28 +48,65 @@ parser.add_option(
     dest="servers",
     help="Kafka servers",
 )
+parser.add_option(
+    "-g",
+    "--group",
+    default="mygroup",
+    dest="group",
+    help="Consumer group",
+)
+parser.add_option(
+    "--offset",
+    default="earliest",
+    dest="offset",
+    help="auto.offset.reset of the consumer: earliest or latest",
+)
+parser.add_option(
+    "-b",
+    "--batch",
+    type="int",
+    default=1000,
+    dest="batch",
+    help="Messages read with each consume() call",
+)
+parser.add_option(
+    "-r",
+    "--registry",
+    dest="registry",
+    help="Schema registry url, for --decode avro",
+)
+add_stats_options(parser)
 
 (options, _) = parser.parse_args()
 
 c = Consumer({
     'bootstrap.servers': options.servers,
-    'group.id': 'mygroup',
-    'auto.offset.reset': 'earliest'
+    'group.id': options.group,
+    'auto.offset.reset': options.offset
 })
 
-c.subscribe([options.topic])
+c.subscribe([topic.strip() for topic in options.topic.split(",")])
 #c.subscribe(['Cisco-IOS-XR-qos-ma-oper.qos.nodes.node.policy-map.interface-table.interface.member-interfaces.member-interface.output.service-policy-names.service-policy-instance.statistics'])
 
-print("waiting for packets")
-while True:
-    msg = c.poll(1.0)
-
-    if msg is None:
-        continue
-    if msg.error():
-        print("Consumer error: {}".format(msg.error()))
-        continue
-
-    print('Received message: {}'.format(msg.value().decode('utf-8')))
-
-c.close()
+stats = ConsumerStats(get_decoder(options.decode, options.registry), options.interval)
+eprint("waiting for packets")
+try:
+    while not options.duration or time.time() - stats.started < options.duration:
+        msgs = c.consume(options.batch, 1.0)
+        now_ms = time.time() * 1000
+        for msg in msgs:
+            if msg.error():
+                if msg.error().code() != KafkaError._PARTITION_EOF:
+                    eprint("Consumer error: {}".format(msg.error()))
+                continue
+            value = msg.value()
+            stats.add(value, now_ms)
+            if not options.quiet:
+                print('Received message: {}'.format(value.decode('utf-8', 'replace')))
+        stats.maybe_report()
+except KeyboardInterrupt:
+    pass
+finally:
+    c.close()
+    sys.stdout.flush()
+    stats.write_summary(options.summary_file)
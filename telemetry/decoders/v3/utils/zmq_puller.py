@@ -23,18 +23,19 @@
 #   Thomas Graf <thomas.graf@swisscom.com>
 #   Paolo Lucente <paolo@pmacct.net>
 #
-from __future__ import print_function
-from zmq import ZMQError
+# Receives the metrics of the zmq exporter (push or pub mode, batched or not),
+# prints them (one line per metric) and reports the throughput in stderr.
+# For benchmarking, e.g.:
+#   python utils/zmq_puller.py --quiet --duration 60 --summary_file zmq.json
+import sys
+import time
 import zmq
 from optparse import OptionParser
-import sys
-
-def eprint(*args, **kwargs):
-    print(*args, file=sys.stderr, **kwargs)
-
+from consumer_stats import ConsumerStats, add_stats_options, get_decoder, eprint
 
 
 DEFAULT_PORT = "tcp://127.0.0.1:50000"
+DRAIN = 1000
 
 parser = OptionParser()
 parser.add_option(
@@ -44,14 +45,60 @@ parser.add_option(
     dest="port",
     help="Port to setup the server",
 )
+parser.add_option(
+    "--mode",
+    default="pull",
+    dest="mode",
+    help="pull (zmq exporter in push mode) or sub (pub mode)",
+)
+parser.add_option(
+    "--subscribe",
+    default="",
+    dest="subscribe",
+    help="Comma separated encoding path prefixes to subscribe to (sub mode), all by default",
+)
+add_stats_options(parser)
 (options, _) = parser.parse_args()
 
 zmqContext = zmq.Context()
-zmqSock = zmqContext.socket(zmq.PULL)
+if options.mode == "sub":
+    zmqSock = zmqContext.socket(zmq.SUB)
+    for prefix in options.subscribe.split(","):
+        zmqSock.setsockopt(zmq.SUBSCRIBE, prefix.strip().encode("utf-8"))
+else:
+    zmqSock = zmqContext.socket(zmq.PULL)
 zmqSock.connect(options.port)
+poller = zmq.Poller()
+poller.register(zmqSock, zmq.POLLIN)
+stats = ConsumerStats(get_decoder(options.decode), options.interval)
 eprint("zmq ready")
 
-while True:
-    work = zmqSock.recv_json().strip()
-    if work:
-        print(work)
+
+def receive():
+    # every frame is a metric, but the topic frame in sub mode
+    frames = zmqSock.recv_multipart(zmq.NOBLOCK, copy=False)
+    if options.mode == "sub":
+        frames = frames[1:]
+    now_ms = time.time() * 1000
+    for frame in frames:
+        payload = frame.bytes
+        stats.add(payload, now_ms)
+        if not options.quiet:
+            print(payload.decode("utf-8").replace("\n", ""))
+
+
+try:
+    while not options.duration or time.time() - stats.started < options.duration:
+        if poller.poll(200):
+            # drain what is queued (up to DRAIN messages) before polling again
+            for _ in range(DRAIN):
+                try:
+                    receive()
+                except zmq.Again:
+                    break
+        stats.maybe_report()
+except KeyboardInterrupt:
+    pass
+finally:
+    sys.stdout.flush()
+    stats.write_summary(options.summary_file)
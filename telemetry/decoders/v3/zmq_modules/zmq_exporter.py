@@ -23,23 +23,153 @@
 #   Thomas Graf <thomas.graf@swisscom.com>
 #   Paolo Lucente <paolo@pmacct.net>
 #
+"""
+ZMQ exporter, the metrics are sent as JSON.
+
+In push mode (the default) every message has the JSON of one metric per
+frame. In pub mode the first frame is the encoding path (the topic), so the
+subscribers can filter by path prefix, and the rest are the metrics of that
+path.
+
+With batch_size > 1 the metrics are buffered (per path in pub mode) and sent
+as a multipart message, once there are batch_size of them or the oldest one
+is older than flush_seconds (checked with every metric and by a timer thread,
+so a path that stops sending is not held). Consumers must read all the frames
+of a message (recv_multipart); with the default batch size of 1, a push
+message has a single frame, as before.
+
+Sends never block. In push mode, when the high water mark (sndhwm) is reached
+(or there is no consumer) the message is dropped and counted. In pub mode ZMQ
+drops the messages of a subscriber at its high water mark silently, without
+an error, so those drops are not counted: dropped only counts the sends that
+failed. The counters (stats) are logged with the cache stats on USR1.
+"""
+import atexit
+import threading
+import time
 from zmq import ZMQError
 import zmq
 import lib_pmgrpcd
-from export_pmgrpcd import Exporter
+from lib_pmgrpcd import PMGRPCDLOG
+from export_pmgrpcd import Exporter, ExportData
+from caching import register_cache
+
+MODES = {"push": zmq.PUSH, "pub": zmq.PUB}
+
+# A warning is logged every time this many more messages are dropped.
+DROPPED_LOG_EVERY = 1000
+
 
 class ZmqExporter(Exporter):
-    def __init__(self):
-        zmqContext = zmq.Context()
-        self.zmqSock = zmqContext.socket(zmq.PUSH)
-        self.zmqSock.bind(lib_pmgrpcd.OPTIONS.zmqipport)
+    # stats are reported by caching.caches_stats under this name
+    name = "zmq_exporter"
+
+    def __init__(self, address=None, mode="push", batch_size=1, flush_seconds=1, sndhwm=1000):
+        if address is None:
+            address = lib_pmgrpcd.OPTIONS.zmqipport
+        if mode not in MODES:
+            raise Exception(f"ZMQ mode must be one of {list(MODES)}, got {mode}")
+        if batch_size < 1:
+            raise Exception(f"ZMQ batch size must be at least 1, got {batch_size}")
+        self.mode = mode
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        zmqContext = zmq.Context.instance()
+        self.zmqSock = zmqContext.socket(MODES[mode])
+        self.zmqSock.setsockopt(zmq.SNDHWM, sndhwm)
+        self.zmqSock.setsockopt(zmq.LINGER, 0)
+        self.zmqSock.bind(address)
         self.flags = zmq.NOBLOCK
+        # topic (None in push mode) -> (time of the first buffered metric, frames)
+        self.buffers = {}
+        self.sent = 0
+        self.dropped = 0
+        # ZMQ sockets are not thread safe, and process_metric is called from
+        # the gRPC threads.
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        if batch_size > 1:
+            threading.Thread(target=self.flush_timer, name="zmq-flush", daemon=True).start()
+        register_cache(self)
+        atexit.register(self.close)
+
+    def topic(self, path):
+        if self.mode != "pub":
+            return None
+        return (path or "").encode("utf-8")
+
+    def export(self, data):
+        if self.mode == "pub":
+            data.route()
+        self.send(self.topic(data.path), data.json())
 
     def process_metric(self, datajsonstring):
-        if not self.zmqSock.closed:
-            try:
-                self.zmqSock.send_string("%s" % datajsonstring, self.flags)
-            except ZMQError:
-                lib_pmgrpcd.SERIALIZELOG.debug(
-                    "ZMQError: %s" % (lib_pmgrpcd.OPTIONS.jsondatafile)
+        self.export(ExportData(jsondata=datajsonstring))
+
+    def send(self, topic, datajsonstring):
+        frame = datajsonstring.encode("utf-8")
+        with self.lock:
+            if self.zmqSock.closed:
+                return
+            if self.batch_size == 1:
+                self.send_frames(topic, [frame])
+                return
+            buffered = self.buffers.get(topic)
+            if buffered is None:
+                buffered = self.buffers[topic] = (time.time(), [])
+            started, frames = buffered
+            frames.append(frame)
+            if len(frames) >= self.batch_size or time.time() - started >= self.flush_seconds:
+                del self.buffers[topic]
+                self.send_frames(topic, frames)
+
+    def send_frames(self, topic, frames):
+        if topic is not None:
+            frames = [topic] + frames
+            metrics = len(frames) - 1
+        else:
+            metrics = len(frames)
+        try:
+            # the frames are not copied into ZMQ messages
+            self.zmqSock.send_multipart(frames, self.flags, copy=False)
+            self.sent += metrics
+        except ZMQError as e:
+            before = self.dropped
+            self.dropped += metrics
+            if before // DROPPED_LOG_EVERY != self.dropped // DROPPED_LOG_EVERY or not before:
+                PMGRPCDLOG.warning(
+                    "ZMQ %s: dropped %s metrics so far (%s sent), error was %s",
+                    self.mode,
+                    self.dropped,
+                    self.sent,
+                    e,
                 )
+
+    def flush(self, older_than=None):
+        """
+        Sends the buffers started before older_than, all of them if None.
+        """
+        with self.lock:
+            if self.zmqSock.closed:
+                return
+            for topic, (started, frames) in list(self.buffers.items()):
+                if older_than is None or started < older_than:
+                    del self.buffers[topic]
+                    self.send_frames(topic, frames)
+
+    def flush_timer(self):
+        interval = min(max(self.flush_seconds / 2, 0.01), 1)
+        while not self.closed.wait(interval):
+            self.flush(time.time() - self.flush_seconds)
+
+    def stats(self):
+        with self.lock:
+            buffered = sum(len(frames) for _, frames in self.buffers.values())
+        return {"sent": self.sent, "dropped": self.dropped, "buffered": buffered}
+
+    def close(self):
+        self.closed.set()
+        self.flush()
+        with self.lock:
+            if not self.zmqSock.closed:
+                self.zmqSock.close()